@@ -0,0 +1,122 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import requests
+
+import get_knee_parameters
+from harvest_http import AdaptiveHTTP
+from knee_marker_history import HISTORY_FIELDNAMES, HISTORY_NUMERIC, HistoryCollector, revision_history
+from knee_output import open_writer
+from scan_spacing import ScanSpacingCache
+from mock_services import MockDataset, MockServer, MockXNATConnection
+
+
+def peak_rss():
+    # Peak resident set size of this process, ru_maxrss never goes down so every worker count is
+    # benchmarked in a process of its own
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def harvest(server, workers, output, stream=False, spacing=True, bulk=False, adaptive=False, history=False):
+    # Run collect_info and write_info against the mock server, like get_knee_parameters.main does. In
+    # stream mode writing overlaps the harvest and is included in the harvest time. The scan spacing
+    # is looked up with an empty cache, like a first run. With history the revision history is written
+    # next to the output and included in the write time.
+    get_knee_parameters.TASKMANAGER = server.url
+    with MockXNATConnection(server.url) as xnat_connection:
+        taskman_connection = requests.Session()
+        http = None
+        if adaptive:
+            http = AdaptiveHTTP(workers)
+            http.mount(taskman_connection)
+            http.mount(xnat_connection.interface)
+        spacing = ScanSpacingCache() if spacing else None
+        start = time.perf_counter()
+        if stream:
+            rows = get_knee_parameters.write_info(
+                get_knee_parameters.stream_info(taskman_connection, xnat_connection, workers=workers,
+                                                spacing=spacing), output)
+            return rows, time.perf_counter() - start, 0.0, http
+
+        collector = HistoryCollector() if history else None
+        info = get_knee_parameters.collect_info(taskman_connection, xnat_connection, workers=workers,
+                                                spacing=spacing, bulk=bulk, history=collector)
+        harvested = time.perf_counter()
+        get_knee_parameters.write_info(info, output)
+        if collector is not None:
+            base, extension = os.path.splitext(output)
+            with open_writer(f'{base}.history{extension}', HISTORY_FIELDNAMES, numeric=HISTORY_NUMERIC) as writer:
+                writer.write_rows(revision_history(collector.files))
+        written = time.perf_counter()
+    return len(info), harvested - start, written - harvested, http
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark get_knee_parameters end-to-end against the local '
+                                                 'TASKMANAGER/XNAT stand-in')
+    parser.add_argument('--tasks', type=int, default=1000, help='number of mock tasks (default: 1000)')
+    parser.add_argument('--workers', default='1,4,16',
+                        help='comma separated worker counts to benchmark (default: 1,4,16)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds every mock request waits (default: 0.005)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='additional random wait of up to this many seconds (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability that a mock request fails (default: 0)')
+    parser.add_argument('--output', default='csv', help='output format to write (default: csv)')
+    parser.add_argument('--stream', action='store_true', help='use the streaming pipeline of get_knee_parameters')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='send the requests through the adaptive client of get_knee_parameters, which retries '
+                             'the failed requests of --error-rate')
+    parser.add_argument('--bulk', action='store_true', help='download the field files in archives')
+    parser.add_argument('--no-spacing', action='store_true', help='do not look up the voxel spacing of the scans')
+    parser.add_argument('--revisions', type=int, default=1,
+                        help='maximum number of timestamped revisions per mock field file (default: 1)')
+    parser.add_argument('--history', action='store_true',
+                        help='also download and analyse every revision, like get_knee_parameters --history')
+    parser.add_argument('--no-header', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.bulk and args.stream:
+        parser.error('--bulk cannot be combined with --stream')
+    if args.history and args.stream:
+        parser.error('--history is only benchmarked without --stream')
+
+    if not args.no_header:
+        print(f'{"workers":>7} {"tasks":>7} {"harvest s":>10} {"tasks/s":>9} {"write s":>8} {"peak RSS MB":>12}')
+    worker_counts = [int(x) for x in args.workers.split(',')]
+    if len(worker_counts) > 1:
+        # One process per worker count, so the peak RSS of a row is that of its own harvest
+        for workers in worker_counts:
+            sys.stdout.flush()
+            subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+                           + ['--workers', str(workers), '--no-header'], check=True)
+        return
+
+    workers = worker_counts[0]
+    dataset = MockDataset(args.tasks, max_revisions=args.revisions)
+    with MockServer(dataset, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate) as server:
+        with tempfile.TemporaryDirectory() as directory:
+            rows, harvest_seconds, write_seconds, http = harvest(
+                server, workers, os.path.join(directory, f'output.{args.output}'), args.stream,
+                not args.no_spacing, args.bulk, args.adaptive, args.history)
+        print(f'{workers:>7} {rows:>7} {harvest_seconds:>10.2f} {rows / harvest_seconds:>9.1f} '
+              f'{write_seconds:>8.2f} {peak_rss() / 2**20:>12.1f}')
+        if http is not None:
+            for host, stats in http.stats().items():
+                print(f'        {host}: {stats["requests_per_second"]:.1f} requests/s, {stats["retries"]} retries, '
+                      f'concurrency limit {stats["limit"]}')
+        print(f'        requests: {dict(server.requests)}, errors: {dict(server.errors)}')
+
+
+if __name__ == '__main__':
+    main()
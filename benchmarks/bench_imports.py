@@ -0,0 +1,79 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules whose import time matters: the analysis core is imported by every worker process, the
+# command line tools on every call
+MODULES = [
+    'numpy',
+    'knee_marker_layout',
+    'knee_marker_batch',
+    'knee_marker_analysis',
+    'knee_marker_offline',
+    'knee_marker_snapshot',
+    'knee_marker_service',
+    'knee_uncertainty',
+    'knee_marker_history',
+    'knee_reliability',
+    'get_knee_parameters',
+]
+
+# Optional dependencies that must not be imported by importing the modules above
+HEAVY = ['yaml', 'xlsxwriter', 'pyarrow', 'pandas', 'requests', 'xnat', 'orjson', 'simdjson']
+
+PROBE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = sorted(x for x in {heavy!r} if x in sys.modules)
+print(seconds, ','.join(heavy))
+'''
+
+
+def measure(module, repeat):
+    # Fastest import of module in a fresh interpreter and the heavy dependencies it loaded
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)], cwd=ROOT,
+                                check=True, capture_output=True, text=True).stdout.split()
+        times.append(float(output[0]))
+    return min(times), output[1] if len(output) > 1 else ''
+
+
+def startup(repeat):
+    # Wall time of starting an interpreter that imports nothing, the floor for every process
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of the knee marker modules')
+    parser.add_argument('--repeat', type=int, default=5, help='imports per module, the fastest counts (default: 5)')
+    parser.add_argument('--modules', default=','.join(MODULES),
+                        help='comma separated modules to import (default: all)')
+    parser.add_argument('--importtime', metavar='MODULE', help='show the python -X importtime breakdown of MODULE')
+    args = parser.parse_args()
+
+    if args.importtime:
+        subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {args.importtime}'], cwd=ROOT)
+        return
+
+    print(f'interpreter startup: {startup(args.repeat) * 1000:.1f} ms')
+    print(f'{"module":<24} {"import ms":>10}  heavy dependencies loaded')
+    for module in args.modules.split(','):
+        seconds, heavy = measure(module, args.repeat)
+        print(f'{module:<24} {seconds * 1000:>10.1f}  {heavy or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knee_marker_analysis import knee_marker_analysis
+from knee_marker_synthetic import generate_sessions
+
+
+def measure(sessions, level):
+    logging.getLogger('knee_marker_analysis').setLevel(level)
+    start = time.perf_counter()
+    for data in sessions:
+        knee_marker_analysis(data)
+    return len(sessions) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark knee_marker_analysis throughput with logging off and on')
+    parser.add_argument('--sessions', type=int, default=5000, help='number of sessions (default: 5000)')
+    parser.add_argument('--missing-rate', type=float, default=0.05,
+                        help='probability that a marker is missing (default: 0.05)')
+    args = parser.parse_args()
+
+    sessions = generate_sessions(args.sessions, args.missing_rate)
+
+    # Records go to the null device, so only the cost of producing and formatting them is measured
+    with open(os.devnull, 'w') as devnull:
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging.Formatter('[%(levelname)s] %(name)s: %(message)s'))
+        logging.getLogger().addHandler(handler)
+
+        off = measure(sessions, logging.WARNING)
+        on = measure(sessions, logging.DEBUG)
+
+    print(f'logging off: {off:10.0f} sessions/s')
+    print(f'logging on:  {on:10.0f} sessions/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knee_marker_batch import PARAMETERS
+from knee_output import FIELDNAMES, open_writer
+
+
+BACKENDS = ['csv', 'xlsx', 'parquet', 'arrow', 'pandas-xlsx']
+
+
+def generate_rows(count, seed=0):
+    # Synthetic result rows with the 32-column schema of get_knee_parameters, about 2% missing values
+    rng = random.Random(seed)
+    for index in range(count):
+        row = {
+            'label': f'GENR_{index:06d}',
+            'id': f'GENR_E{index:06d}',
+            'user': f'rater{index % 5}',
+            'timestamp': '2021-06-01T12:00:00',
+        }
+        for name in PARAMETERS:
+            row[name] = rng.gauss(10, 3) if rng.random() > 0.02 else None
+        yield row
+
+
+def peak_rss():
+    # Peak resident set size of this process in bytes
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def run_backend(backend, rows, directory, queue):
+    filename = os.path.join(directory, 'output.{}'.format(backend.replace('pandas-', '')))
+    start_rss = peak_rss()
+    start = time.perf_counter()
+
+    if backend == 'pandas-xlsx':
+        # The previous write_info implementation, for reference
+        import pandas
+
+        pandas.DataFrame(list(generate_rows(rows))).to_excel(filename, columns=FIELDNAMES, index=False)
+    else:
+        with open_writer(filename) as writer:
+            writer.write_rows(generate_rows(rows))
+
+    queue.put({
+        'backend': backend,
+        'seconds': time.perf_counter() - start,
+        'peak_rss_increase': peak_rss() - start_rss,
+        'file_size': os.path.getsize(filename),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark write time and peak memory of the output backends')
+    parser.add_argument('--rows', type=int, default=100000, help='number of rows to write (default: 100000)')
+    parser.add_argument('--backend', action='append', choices=BACKENDS,
+                        help='backend to benchmark, can be repeated (default: all)')
+    args = parser.parse_args()
+
+    # Every backend runs in a fresh process so the peak RSS of one does not hide another
+    context = multiprocessing.get_context('spawn')
+    print(f'{"backend":<12} {"seconds":>9} {"peak RSS +MB":>13} {"size MB":>9}')
+    for backend in args.backend or BACKENDS:
+        queue = context.Queue()
+        with tempfile.TemporaryDirectory() as directory:
+            process = context.Process(target=run_backend, args=(backend, args.rows, directory, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f'{backend:<12} failed with exit code {process.exitcode}')
+                continue
+            result = queue.get()
+        print(f'{backend:<12} {result["seconds"]:>9.2f} {result["peak_rss_increase"] / 2**20:>13.1f} '
+              f'{result["file_size"] / 2**20:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from knee_marker_synthetic import generate_sessions
+
+
+def start_service(processes=1):
+    # Start knee_marker_service.py on a free port in its own process, so the clients do not compete
+    # with it for the GIL, and wait until it serves
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'knee_marker_service.py'), '--port', '0',
+                                '--processes', str(processes)],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Serving on '):
+        process.kill()
+        raise RuntimeError('knee_marker_service.py did not start')
+    return process, line.split()[-1]
+
+
+def client(url, bodies, requests):
+    # Send requests one after the other on one keep-alive connection, like a viewer does. Returns the
+    # latencies in seconds and the statuses of the failed requests.
+    latencies, errors = [], []
+    address = urlparse(url)
+    connection = http.client.HTTPConnection(address.hostname, address.port)
+    headers = {'Content-Type': 'application/json'}
+    for index in range(requests):
+        body = bodies[index % len(bodies)]
+        start = time.perf_counter()
+        connection.request('POST', '/analyse', body, headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(response.status)
+    connection.close()
+    return latencies, errors
+
+
+def load_test(url, clients, requests, bodies):
+    # Every client is a process of its own like the viewers are, client threads would queue for the GIL
+    # of this process and add that to the latencies of the service
+    latencies, errors = [], []
+    with ProcessPoolExecutor(clients) as executor:
+        # Start the processes before the clock does
+        list(executor.map(time.sleep, [0] * clients))
+        start = time.perf_counter()
+        for client_latencies, client_errors in executor.map(client, [url] * clients, [bodies] * clients,
+                                                            [requests] * clients):
+            latencies.extend(client_latencies)
+            errors.extend(client_errors)
+    return np.array(latencies) * 1000, errors, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test knee_marker_service.py with concurrent clients')
+    parser.add_argument('--url', help='service to test (default: start one on a free port)')
+    parser.add_argument('--clients', default='1,4,16',
+                        help='comma separated numbers of concurrent clients, every client sends its next request '
+                             'as soon as it has the answer to the previous one (default: 1,4,16)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes of the service that is started, at most one per core (default: 1)')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per client (default: 1000)')
+    parser.add_argument('--missing-rate', type=float, default=0.1,
+                        help='fraction of markers left out, like a marker set that is being placed (default: 0.1)')
+    parser.add_argument('--max-p99', type=float, default=5.0,
+                        help='p99 latency in ms above which the test fails (default: 5)')
+    args = parser.parse_args()
+
+    bodies = [json.dumps({'markers': x['markers']}) for x in generate_sessions(100, args.missing_rate)]
+
+    process = None
+    url = args.url
+    if url is None:
+        process, url = start_service(args.processes)
+
+    failed = False
+    try:
+        # Warm up the connections and the service
+        load_test(url, 1, 100, bodies)
+
+        print(f'{"clients":>7} {"requests":>9} {"req/s":>8} {"p50 ms":>7} {"p95 ms":>7} {"p99 ms":>7} '
+              f'{"max ms":>7} {"errors":>6}')
+        for clients in [int(x) for x in args.clients.split(',')]:
+            latencies, errors, seconds = load_test(url, clients, args.requests, bodies)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            print(f'{clients:>7} {len(latencies):>9} {len(latencies) / seconds:>8.0f} {p50:>7.2f} {p95:>7.2f} '
+                  f'{p99:>7.2f} {latencies.max():>7.2f} {len(errors):>6}')
+            failed |= p99 > args.max_p99 or bool(errors)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
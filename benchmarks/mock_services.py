@@ -0,0 +1,304 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import re
+import sys
+import tarfile
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from knee_marker_synthetic import RATERS, generate_sessions
+
+
+# Users whose tasks get_knee_parameters collects
+USERS = range(9, 19)
+
+FIRST_TIMESTAMP = datetime.datetime(2021, 1, 1)
+
+
+class MockDataset:
+    # Deterministic stand-in for the knee marker tasks on TASKMANAGER and their FIELDS files on XNAT.
+    # Task i belongs to user 9 + i % 10, every field resource has 1 to max_revisions timestamped
+    # revisions and nothing is generated before it is requested, so 100k tasks cost no memory.
+
+    def __init__(self, tasks=1000, max_revisions=1, aborted_rate=0.02, missing_rate=0.02, seed=0):
+        self.tasks = tasks
+        self.max_revisions = max_revisions
+        self.aborted_rate = aborted_rate
+        self.missing_rate = missing_rate
+        self.seed = seed
+
+    def _random(self, index):
+        return random.Random(self.seed * 1000003 + index)
+
+    @staticmethod
+    def experiment_id(index):
+        return f'MOCK_E{index:06d}'
+
+    def rater(self, index):
+        return RATERS[index % len(RATERS)]
+
+    def revisions(self, index):
+        count = self._random(index).randint(1, self.max_revisions)
+        return [(FIRST_TIMESTAMP + datetime.timedelta(days=index % 365, hours=x)).isoformat()
+                for x in range(count)]
+
+    def user_tasks(self, user_id):
+        return {'tasks': [
+            {'uri': f'/api/v1/tasks/{index}',
+             'status': 'aborted' if self._random(index).random() < self.aborted_rate else 'done'}
+            for index in range(user_id - USERS.start, self.tasks, len(USERS))
+        ]}
+
+    def task(self, index):
+        resource = f'/data/experiments/{self.experiment_id(index)}/resources/FIELDS_{self.rater(index)}'
+        content = {
+            '_vars': {'EXPERIMENT_ID': self.experiment_id(index), 'LABEL': f'MOCK_{index:06d}'},
+            'fields_file': resource + '/files/knee_marker_{timestamp}.json',
+        }
+        return {'uri': f'/api/v1/tasks/{index}', 'content': json.dumps(content)}
+
+    def spacing(self, index):
+        # Voxel spacing of the marker scan, mostly the 0.7 mm isotropic default of the protocol
+        in_plane = self._random(index).choice([0.7, 0.7, 0.7, 0.65, 0.75])
+        return [in_plane, in_plane, 0.7]
+
+    def experiment(self, index):
+        x, y, z = self.spacing(index)
+        scans = [
+            {'meta': {'xsi:type': 'xnat:mrScanData'}, 'data_fields': {'ID': '1', 'type': 'LOCALIZER'}},
+            {'meta': {'xsi:type': 'xnat:mrScanData'},
+             'data_fields': {'ID': '3', 'type': 'T1_WATER', 'series_description': '3DGRASS_WATER'},
+             'children': [{'field': 'parameters/voxelRes',
+                           'items': [{'data_fields': {'x': x, 'y': y, 'z': z}}]}]},
+        ]
+        return {'items': [{'meta': {'xsi:type': 'xnat:mrSessionData'},
+                           'data_fields': {'ID': self.experiment_id(index), 'label': f'MOCK_{index:06d}'},
+                           'children': [{'field': 'scans/scan', 'items': scans}]}]}
+
+    def listing(self, index):
+        return {'ResultSet': {'Result': [{'Name': f'knee_marker_{x}.json'} for x in self.revisions(index)]}}
+
+    def field_file(self, index, timestamp):
+        # Every revision moves one to three markers of the previous one, like a rater correcting their work
+        revision = self.revisions(index).index(timestamp)
+        data = generate_sessions(1, self.missing_rate, seed=self.seed * 1000003 + index)[0]
+        for number in range(1, revision + 1):
+            generator = random.Random(self.seed * 1000003 + index * 31 + number)
+            for marker in generator.sample(data['markers'], min(len(data['markers']), generator.randint(1, 3))):
+                marker['pos'] = [x + generator.uniform(-3, 3) for x in marker['pos'][:3]] + marker['pos'][3:]
+        data['__raters__'] = [{'username': self.rater(index), 'timestamp': timestamp}]
+        return data
+
+    def archive(self, indices, labels):
+        # tar.gz of every revision of the field resources, with members named like XNAT names them:
+        # {experiment label}/resources/{resource label}/files/{filename}
+        body = io.BytesIO()
+        with tarfile.open(fileobj=body, mode='w:gz') as archive:
+            for index in indices:
+                label = f'FIELDS_{self.rater(index)}'
+                if index >= self.tasks or label not in labels:
+                    continue
+                for timestamp in self.revisions(index):
+                    data = json.dumps(self.field_file(index, timestamp)).encode()
+                    member = tarfile.TarInfo(f'MOCK_{index:06d}/resources/{label}/files/knee_marker_{timestamp}.json')
+                    member.size = len(data)
+                    archive.addfile(member, io.BytesIO(data))
+        return body.getvalue()
+
+
+class MockServer:
+    # Serves the TASKMANAGER and XNAT endpoints used by get_knee_parameters from one local port:
+    #   /api/v1/users/{id}/tasks, /api/v1/tasks/{i}, /data/experiments/{id},
+    #   {resource}/files and {resource}/files/knee_marker_{timestamp}.json, and
+    #   /data/experiments/{id,...}/resources/{label,...}/files?format=tar.gz for the archives
+    # Every request waits latency seconds (plus up to jitter seconds) and fails with a 503 with
+    # probability error_rate.
+
+    ROUTES = [
+        ('archive', re.compile(r'^/data/experiments/((?:MOCK_E\d+,)*MOCK_E\d+)/resources/([^/]+)/files#tar\.gz$')),
+        ('user_tasks', re.compile(r'^/api/v1/users/(\d+)/tasks$')),
+        ('task', re.compile(r'^/api/v1/tasks/(\d+)$')),
+        ('experiment', re.compile(r'^/data/experiments/MOCK_E(\d+)$')),
+        ('listing', re.compile(r'^/data/experiments/MOCK_E(\d+)/resources/[^/]+/files$')),
+        ('field_file', re.compile(r'^/data/experiments/MOCK_E(\d+)/resources/[^/]+/files/knee_marker_(.+)\.json$')),
+    ]
+
+    def __init__(self, dataset, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self.errors = Counter()
+        # Requests being handled at the moment and the most there have been at once
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(dataset.seed)
+        self._user_tasks = lru_cache(maxsize=None)(lambda user_id: json.dumps(dataset.user_tasks(user_id)))
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are sent separately, without this every keep-alive request waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                format = parse_qs(query).get('format', [''])[0]
+                if '?' in query:
+                    # Like XNAT, a query string in the path is not understood
+                    status, body = 400, json.dumps({'error': f'malformed query {query}'})
+                else:
+                    # Archives are routed on the format, the same URL without it is a file listing
+                    status, body = server.handle(unquote(path) + ('#' + format if format.startswith('tar') else ''))
+                content_type = 'application/gzip' if isinstance(body, bytes) else 'application/json'
+                body = body.encode() if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def handle(self, path):
+        for endpoint, pattern in self.ROUTES:
+            match = pattern.match(path)
+            if match is not None:
+                break
+        else:
+            return 404, json.dumps({'error': f'unknown path {path}'})
+
+        with self._lock:
+            self.requests[endpoint] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            time.sleep(delay)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+        if failed:
+            with self._lock:
+                self.errors[endpoint] += 1
+            return 503, json.dumps({'error': 'service unavailable'})
+
+        arguments = match.groups()
+        if endpoint == 'archive':
+            indices = [int(x[len('MOCK_E'):]) for x in arguments[0].split(',')]
+            return 200, self.dataset.archive(indices, arguments[1].split(','))
+        index = int(arguments[0])
+        if endpoint == 'user_tasks':
+            return 200, self._user_tasks(index)
+        if index >= self.dataset.tasks:
+            return 404, json.dumps({'error': f'unknown task {index}'})
+        if endpoint == 'field_file':
+            if arguments[1] not in self.dataset.revisions(index):
+                return 404, json.dumps({'error': f'unknown file {path}'})
+            return 200, json.dumps(self.dataset.field_file(index, arguments[1]))
+        return 200, json.dumps(getattr(self.dataset, endpoint)(index))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class MockXNATConnection:
+    # The part of the xnatpy session interface that get_knee_parameters uses, backed by plain
+    # requests so it can talk to the mock server without the xnatpy login and data model handshake
+
+    def __init__(self, server):
+        self.server = server
+        self.interface = requests.Session()
+
+    def get(self, path):
+        response = self.interface.get(self.server + path)
+        response.raise_for_status()
+        return response
+
+    def get_json(self, path):
+        # xnatpy adds format=json to the path as it is, also when the path already has a query string
+        return self.get(path + '?format=json').json()
+
+    def create_object(self, uri):
+        return self.get_json(uri)
+
+    def download_generator(self, uri, format=None, chunk_size=524288):
+        response = self.interface.get(self.server + uri, params={'format': format} if format else None, stream=True)
+        response.raise_for_status()
+        yield from response.iter_content(chunk_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.interface.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the TASKMANAGER and XNAT endpoints')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--tasks', type=int, default=1000, help='number of tasks (default: 1000)')
+    parser.add_argument('--revisions', type=int, default=1,
+                        help='maximum number of timestamped revisions per field file (default: 1)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every request waits (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='additional random wait of up to this many seconds (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability that a request fails with a 503 (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the dataset (default: 0)')
+    args = parser.parse_args()
+
+    dataset = MockDataset(args.tasks, max_revisions=args.revisions, seed=args.seed)
+    server = MockServer(dataset, args.host, args.port, args.latency, args.jitter, args.error_rate)
+    print(f'Serving {args.tasks} mock tasks on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f'Requests: {dict(server.requests)}, errors: {dict(server.errors)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import functools
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import field_file_json
+import knee_marker_analysis
+from knee_marker_batch import PARAMETERS, knee_marker_batch_analysis
+from knee_marker_layout import MARKER_INDEX
+from knee_marker_screening import screen_markers
+from knee_marker_synthetic import generate_positions, generate_sessions
+from knee_output import FIELDNAMES, open_writer
+
+
+# Reference timings under version control, measured with the default arguments on a single core.
+# Timings depend on the machine, store a baseline of your own with --save-baseline --baseline FILE
+# before comparing against it on other hardware.
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Inputs of the geometry helpers, in the order knee_marker_analysis passes them
+METRIC_INPUTS = {
+    'insall_salvati': ['Sup_Pat', 'Inf_Pat', 'Tub_Tib'],
+    'lateral_translation': ['Ant_Pat', 'Pos_Pat', 'Sulc'],
+    'tt_tg': ['Med_Pos_Cond', 'Lat_Pos_Cond', 'Tub_Tib', 'Sulc'],
+    'pat_tilt': ['Med_Pat', 'Lat_Pat', 'Med_Pos_Cond', 'Lat_Pos_Cond'],
+    'lat_pat_tilt': ['Pos_Pat', 'Lat_Pat', 'Med_Ant_Cond', 'Lat_Ant_Cond'],
+    'bis_offset': ['Sulc', 'Med_Pos_Cond', 'Lat_Pos_Cond', 'Lat_Pat', 'Med_Pat'],
+    'sulc_angle': ['Lat_Ant_Cond', 'Med_Ant_Cond', 'Sulc'],
+    'inclination': ['Lat_Ant_Cond', 'Med_Ant_Cond', 'Sulc', 'Med_Pos_Cond', 'Lat_Pos_Cond'],
+    'depth_troch': ['Med_Ant_Cond', 'Lat_Ant_Cond', 'Sulc'],
+    'cd_bp_mis': ['Sup_Pat', 'Inf_Art_Pat', 'Sup_Ant_Tib', 'Tub_Tib', 'Sup_Tib'],
+    'troch_angle': ['Med_Ant_Cond', 'Lat_Ant_Cond', 'Med_Pos_Cond', 'Lat_Pos_Cond'],
+}
+
+
+def best_of(function, repeat):
+    # Shortest wall time of repeat runs, the least disturbed measurement
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def result_rows(positions, sessions):
+    columns = knee_marker_batch_analysis(positions)
+    for index, data in enumerate(sessions):
+        row = {name: float(columns[name][index]) for name in PARAMETERS}
+        row.update(label=f'SYN_{index}', id=f'SYN_E{index}', user=data['__raters__'][-1]['username'],
+                   timestamp=data['__raters__'][-1]['timestamp'])
+        yield row
+
+
+def benchmark_cases(size, args):
+    # Every case is (name, prepare), prepare creates the test data and returns the function to time,
+    # which handles size sessions in one call. Test data is only created for the cases that run.
+    @functools.lru_cache(maxsize=None)
+    def positions():
+        return generate_positions(size, args.missing_rate, args.sides, seed=size)[0]
+
+    @functools.lru_cache(maxsize=None)
+    def sessions():
+        return generate_sessions(size, args.missing_rate, args.sides, seed=size)
+
+    @functools.lru_cache(maxsize=None)
+    def documents():
+        return [json.dumps(x) for x in sessions()]
+
+    @functools.lru_cache(maxsize=None)
+    def rows():
+        return list(result_rows(positions(), sessions()))
+
+    side = args.sides[0]
+
+    def metric_case(name, inputs):
+        function = getattr(knee_marker_analysis, name)
+        arguments = [[session[MARKER_INDEX[f'{x}_{side}']] for x in inputs] for session in positions()]
+        arguments = [x for x in arguments if not any(np.isnan(y).any() for y in x)]
+        return lambda: [function(*x) for x in arguments]
+
+    def output_case(backend):
+        data = rows()
+
+        def write():
+            with tempfile.TemporaryDirectory() as directory:
+                with open_writer(os.path.join(directory, f'output.{backend}'), FIELDNAMES) as writer:
+                    writer.write_rows(data)
+        return write
+
+    for name, inputs in METRIC_INPUTS.items():
+        yield f'metric/{name}', functools.partial(metric_case, name, inputs)
+
+    def scalar_case():
+        data = sessions()
+        return lambda: [knee_marker_analysis.knee_marker_analysis(x) for x in data]
+
+    def json_case():
+        data = documents()
+        return lambda: [json.load(io.StringIO(x)) for x in data]
+
+    def extract_case(backend):
+        data = [x.encode() for x in documents()]
+        return lambda: [field_file_json.extract_field_data(x, backend) for x in data]
+
+    yield 'analysis/scalar', scalar_case
+    yield 'analysis/batch', lambda: functools.partial(knee_marker_batch_analysis, positions())
+    yield 'analysis/screening', lambda: functools.partial(screen_markers, positions())
+    yield 'json/load', json_case
+    for backend in field_file_json.available_backends():
+        yield f'json/extract_{backend}', functools.partial(extract_case, backend)
+
+    for backend in args.backends:
+        yield f'output/{backend}', functools.partial(output_case, backend)
+
+
+def compare(results, baseline, tolerance):
+    # Cases that got slower than the baseline by more than tolerance
+    regressions = []
+    for key, seconds in results.items():
+        reference = baseline.get(key)
+        if reference is not None and seconds > reference * (1 + tolerance):
+            regressions.append((key, reference, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the knee marker analysis on synthetic sessions')
+    parser.add_argument('--sizes', default='1,1000,100000',
+                        help='comma separated numbers of sessions (default: 1,1000,100000)')
+    parser.add_argument('--missing-rate', type=float, default=0.02,
+                        help='probability that a marker is missing (default: 0.02)')
+    parser.add_argument('--sides', default='RL', choices=['R', 'L', 'RL'],
+                        help='knees with landmarks (default: RL)')
+    parser.add_argument('--backends', default='csv,xlsx',
+                        help='comma separated output formats to benchmark (default: csv,xlsx)')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest counts (default: 3)')
+    parser.add_argument('--baseline', default=BASELINE, help=f'baseline file (default: {BASELINE})')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown against the baseline that counts as regression (default: 0.25)')
+    args = parser.parse_args()
+    args.backends = [x for x in args.backends.split(',') if x]
+
+    warnings.simplefilter('ignore')
+    results = {}
+    print(f'{"case":<28} {"sessions":>9} {"total s":>10} {"us/session":>11} {"sessions/s":>12}')
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for name, prepare in benchmark_cases(size, args):
+            if args.filter not in name:
+                continue
+            # Large sessions counts are slow enough to measure once
+            seconds = best_of(prepare(), args.repeat if size < 10000 else 1)
+            results[f'{name}@{size}'] = seconds
+            print(f'{name:<28} {size:>9} {seconds:>10.4f} {seconds / size * 1e6:>11.2f} {size / seconds:>12.0f}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f'Stored baseline in {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline in {args.baseline}, store one with --save-baseline')
+        return
+
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.tolerance)
+
+    for key, reference, seconds in regressions:
+        print(f'REGRESSION {key}: {seconds:.4f}s, baseline {reference:.4f}s (+{seconds / reference - 1:.0%})')
+    if regressions:
+        sys.exit(1)
+    print(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
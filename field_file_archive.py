@@ -0,0 +1,181 @@
+import io
+import logging
+import re
+import tarfile
+from urllib.parse import urlparse
+
+from field_file_json import extract_field_data
+from harvest_metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+# Experiments per archive request, their ids are part of the URL so it has to stay reasonably short
+ARCHIVE_BATCH = 250
+
+
+def timestamp_pattern(filename):
+    # Regular expression for the files matching a fields_file name with a {timestamp} placeholder
+    return filename.format(timestamp=r'(_?(?P<timestamp>\d\d\d\d\-\d\d\-\d\dT\d\d:\d\d:\d\d)_?)?') + '$'
+
+
+def select_revisions(filenames, pattern):
+    # The (timestamp, filename) of every file matching pattern, oldest first
+    files = {re.match(pattern, x): x for x in filenames}
+    files = {k.group('timestamp'): v for k, v in files.items() if k is not None}
+
+    # None is the first, timestamp come after that, so last one is highest timestamp
+    return sorted(files.items(), key=lambda x: x[0] or '')
+
+
+def _newer(timestamp, current):
+    return current is None or (timestamp or '') > (current[1] or '')
+
+
+class _ChunkReader(io.RawIOBase):
+    # Read-only file object over an iterator of byte chunks, such as a streamed HTTP response
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+class FieldArchive:
+    # The latest field file of many tasks from tar archives of their FIELDS resources: one request per
+    # ARCHIVE_BATCH experiments instead of a listing and a download per task. The archives are unpacked
+    # while they stream in, only the markers of the newest revision of every field file are kept and
+    # the newest revision is selected in the same way as find_latest_file does with the listing. With
+    # history every revision is kept, for the revision history of get_knee_parameters --history.
+    # Field files that did not change since an earlier run are listed by the harvest instead, they are
+    # left out of the archives.
+
+    def __init__(self, cache=None, history=False):
+        self.cache = cache
+        self.history = history
+        # Field files whose archive failed, the harvest downloads them per task instead
+        self.failed = set()
+        # Revisions of the unchanged field files, as find_revisions lists them
+        self.listed = {}
+        self.archives = 0
+        self.files = 0
+        self._latest = {}
+        self._data = {}
+        self._revisions = {}
+
+    def latest(self, fields_file):
+        # (resource, timestamp, filename) of the newest revision, like find_latest_file
+        return self._latest.get(fields_file)
+
+    def field_data(self, fields_file):
+        data = dict(self._data[fields_file])
+        data['__timestamp__'] = self._latest[fields_file][1]
+        return data
+
+    def revisions(self, fields_file):
+        # (timestamp, field data) of every revision, oldest first, like download_revisions
+        revisions = self._revisions.get(fields_file, {})
+        return [(timestamp, dict(revisions[timestamp], __timestamp__=timestamp))
+                for timestamp in sorted(revisions, key=lambda x: x or '')]
+
+    def download(self, task_contents, xnat_connection, batch_size=ARCHIVE_BATCH, listed=None):
+        # Fetch the field files of all tasks, tasks without a {timestamp} in their fields_file are skipped
+        # like in find_latest_file. The archive names the experiments by label, so both are matched.
+        # listed has the revisions of the field files that are not fetched, by fields_file.
+        self.listed.update(listed or {})
+        wanted = {}
+        for content in task_contents:
+            path = urlparse(content['fields_file']).path
+            if '{timestamp}' not in path or content['fields_file'] in self.listed:
+                continue
+            resource, filename = path.split('/files/')
+            match = re.search(r'/experiments/([^/]+)/resources/([^/]+)$', resource)
+            if match is None:
+                logger.warning('Cannot download %s in an archive', content['fields_file'])
+                continue
+            experiment_id, label = match.groups()
+            entry = (content['fields_file'], resource, timestamp_pattern(filename))
+            for experiment in {experiment_id, content['_vars'].get('LABEL', experiment_id)}:
+                wanted.setdefault((experiment, label), []).append(entry)
+
+        resources = sorted({re.search(r'/experiments/([^/]+)/resources/([^/]+)$', entry[1]).groups()
+                            for entries in wanted.values() for entry in entries})
+        experiments = sorted({x[0] for x in resources})
+        for start in range(0, len(experiments), batch_size):
+            batch = experiments[start:start + batch_size]
+            labels = sorted({label for experiment, label in resources if experiment in batch})
+            path = '/data/experiments/{}/resources/{}/files'.format(','.join(batch), ','.join(labels))
+            try:
+                self._download_archive(path, wanted, xnat_connection)
+            except (IOError, EOFError, tarfile.TarError) as exception:
+                # Forget what was read from the failed archive, its field files are fetched per task
+                failed = {entry[0] for (experiment, _), entries in wanted.items() if experiment in batch
+                          for entry in entries}
+                logger.warning('Archive of %d experiments failed, their %d field files are downloaded per task: %s',
+                               len(batch), len(failed), exception)
+                METRICS.increment('field_file_archives_failed')
+                self.failed.update(failed)
+                for fields_file in failed:
+                    for files in (self._latest, self._data, self._revisions):
+                        files.pop(fields_file, None)
+
+        # Only the revisions that are used are cached, like download_file would have cached them
+        if self.cache is not None:
+            for fields_file, (resource, timestamp, filename) in self._latest.items():
+                revisions = self._revisions.get(fields_file, {timestamp: self._data[fields_file]})
+                for timestamp, data in revisions.items():
+                    if timestamp is not None:
+                        self.cache.put(resource, timestamp, data)
+
+        logger.info('Field archives: %d requests, %d files, latest revision of %d field files, %d field files '
+                    'unchanged', self.archives, self.files, len(self._latest), len(self.listed))
+
+    def _download_archive(self, path, wanted, xnat_connection):
+        with METRICS.timer('http/xnat_archive'):
+            chunks = xnat_connection.download_generator(path, format='tar.gz')
+            with tarfile.open(fileobj=_ChunkReader(chunks), mode='r|gz') as archive:
+                for member in archive:
+                    if member.isfile():
+                        self._add_member(archive, member, wanted)
+        self.archives += 1
+        METRICS.increment('field_file_archives')
+
+    def _add_member(self, archive, member, wanted):
+        # Members are stored as {experiment label}/resources/{resource label}/files/{filename}
+        parts = member.name.split('/')
+        if 'resources' not in parts[1:-2]:
+            return
+        index = parts.index('resources', 1)
+        experiment, label = parts[index - 1], parts[index + 1]
+        filename = '/'.join(parts[index + 3:] if parts[index + 2] == 'files' else parts[index + 2:])
+        self.files += 1
+
+        data = None
+        for fields_file, resource, pattern in wanted.get((experiment, label), []):
+            match = re.match(pattern, filename)
+            if match is None:
+                continue
+            newer = _newer(match.group('timestamp'), self._latest.get(fields_file))
+            if not newer and not self.history:
+                continue
+            if data is None:
+                with METRICS.timer('stage/parse'):
+                    data = extract_field_data(archive.extractfile(member).read())
+            if self.history:
+                self._revisions.setdefault(fields_file, {})[match.group('timestamp')] = data
+            if newer:
+                self._latest[fields_file] = (resource, match.group('timestamp'), filename)
+                self._data[fields_file] = data
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class FieldFileCache:
+    # Persistent cache of downloaded FIELDS files, keyed by XNAT resource and file timestamp. Entries
+    # are evicted least recently used first once the total size exceeds max_bytes. The index is written
+    # by save, and by put every SAVE_PUTS puts or SAVE_SECONDS seconds, so a crash loses little of it.
+
+    INDEX = 'index.json'
+    SAVE_PUTS = 1000
+    SAVE_SECONDS = 30.0
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        self._entries = OrderedDict()
+        try:
+            with open(os.path.join(directory, self.INDEX)) as index_file:
+                self._entries.update(json.load(index_file))
+        except (IOError, ValueError):
+            pass
+        self._bytes = sum(x['size'] for x in self._entries.values())
+
+    @staticmethod
+    def key(resource, timestamp):
+        return '{}@{}'.format(resource, timestamp)
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def contains(self, resource, timestamp):
+        with self._lock:
+            return self.key(resource, timestamp) in self._entries
+
+    def get(self, resource, timestamp):
+        key = self.key(resource, timestamp)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+
+            try:
+                with open(self._path(key)) as cache_file:
+                    data = json.load(cache_file)
+            except (IOError, ValueError):
+                self._bytes -= self._entries.pop(key)['size']
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, resource, timestamp, data):
+        key = self.key(resource, timestamp)
+        body = json.dumps(data)
+        # Every key has its own file, so only the index needs the lock
+        path = self._path(key)
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'w') as cache_file:
+            cache_file.write(body)
+        os.replace(temporary, path)
+        with self._lock:
+            previous = self._entries.get(key)
+            self._bytes += len(body) - (previous['size'] if previous else 0)
+            self._entries[key] = {'size': len(body)}
+            self._entries.move_to_end(key)
+            self._evict()
+            self._unsaved += 1
+            if self._unsaved >= self.SAVE_PUTS or time.monotonic() - self._saved_at >= self.SAVE_SECONDS:
+                self._save()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry['size']
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _save(self):
+        index_path = os.path.join(self.directory, self.INDEX)
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(self._entries, index_file)
+        os.replace(index_path + '.tmp', index_path)
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+    def save(self):
+        # Store the index with the recency order of the entries, so the cache and its eviction survive
+        # between runs
+        with self._lock:
+            self._save()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self.size}
@@ -0,0 +1,75 @@
+import importlib
+import importlib.util
+import json
+import threading
+from functools import lru_cache
+
+
+# Parts of a field file that the analysis reads
+FIELD_KEYS = ('markers', '__raters__')
+
+# JSON backends from fast to slow, the fastest installed one is used by default. simdjson can decode
+# only the parts of a document that are read, orjson decodes the whole document but much faster than
+# json. They are imported on first use, so importing this module stays cheap.
+BACKENDS = ('simdjson', 'orjson', 'json')
+
+_modules = {'json': json}
+
+
+def available_backends():
+    return [x for x in BACKENDS if x in _modules or importlib.util.find_spec(x) is not None]
+
+
+@lru_cache(maxsize=None)
+def default_backend():
+    return available_backends()[0]
+
+
+def _module(backend):
+    if backend not in _modules:
+        _modules[backend] = importlib.import_module(backend)
+    return _modules[backend]
+
+
+# A simdjson parser reuses its buffers and may only be used by one thread at a time
+_local = threading.local()
+
+
+def _extract_simdjson(document):
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = _module('simdjson').Parser()
+
+    if isinstance(document, str):
+        document = document.encode()
+    parsed = parser.parse(document)
+
+    # Only the name and position of the markers are decoded, other marker attributes and the rest
+    # of the document are skipped
+    data = {}
+    for key in FIELD_KEYS:
+        try:
+            value = parsed[key]
+        except KeyError:
+            continue
+        if key == 'markers':
+            data[key] = [{'name': x['name'], 'pos': x['pos'].as_list()} for x in value]
+        else:
+            data[key] = value.as_list()
+    return data
+
+
+def extract_field_data(document, backend=None):
+    # The markers and raters of a field file given as str or bytes, in the same format as the file so
+    # the result can be passed to knee_marker_analysis and stored in the field file cache
+    backend = backend or default_backend()
+    if backend == 'simdjson':
+        return _extract_simdjson(document)
+
+    data = _module(backend).loads(document)
+    return {key: data[key] for key in FIELD_KEYS if key in data}
+
+
+def load_field_file(path, backend=None):
+    with open(path, 'rb') as json_file:
+        return extract_field_data(json_file.read(), backend)
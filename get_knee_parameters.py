@@ -1,188 +1,639 @@
-import csv
+import argparse
+import atexit
 import json
+import logging
+import math
 import netrc
 import os
 import re
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from string import Template
-from numpy.lib.polynomial import _binary_op_dispatcher
-import pandas
 
-import requests
-import xnat
-
-from knee_marker_analysis import knee_marker_analysis
+from field_file_archive import FieldArchive, select_revisions, timestamp_pattern
+from field_file_cache import FieldFileCache
+from field_file_json import extract_field_data
+from harvest_checkpoint import HarvestCheckpoint
+from harvest_metrics import METRICS
+import knee_marker_analysis
+from knee_marker_batch import PARAMETERS, knee_marker_batch_analysis
+from knee_marker_history import HISTORY_FIELDNAMES, HISTORY_NUMERIC, HistoryCollector, revision_history
+from knee_marker_layout import pack_markers
+from knee_marker_screening import describe, screen_markers
+from knee_marker_snapshot import SnapshotCollector, write_snapshot
+from knee_output import FIELDNAMES, open_writer
+from knee_results_store import ResultsStore
+from scan_spacing import ScanSpacingCache
 
 
 TASKMANAGER = 'https://bigr-tracr.erasmusmc.nl:5001'
 XNAT = 'https://bigr-genr-xnat.erasmusmc.nl'
 
+logger = logging.getLogger(__name__)
+
+# Geometry helpers of knee_marker_analysis that are timed with --metrics
+METRIC_FUNCTIONS = [
+    'insall_salvati', 'lateral_translation', 'tt_tg', 'pat_tilt', 'lat_pat_tilt', 'bis_offset',
+    'sulc_angle', 'inclination', 'depth_troch', 'cd_bp_mis', 'troch_angle',
+]
+
 
 COPY_FIELDS = [
 ]
 
+# (task uri, reason) of the tasks that were skipped because a request failed after its retries
+SKIPPED_TASKS = []
+
+# Expected orientation of the knees for the side checks of the screening, as screen_markers takes it, and
+# whether sessions the screening flags are analysed at all. Set from the command line.
+SCREENING_ORIENTATION = None
+SKIP_FLAGGED = False
+
+# Sessions whose markers the plausibility screening flagged, to be sent back to their raters
+FLAGGED_FIELDNAMES = ['label', 'id', 'user', 'timestamp', 'screening']
+FLAGGED_SESSIONS = []
+
 
-def download_latest_file(path, xnat_connection):
+def find_revisions(path, xnat_connection):
+    # (resource, timestamp, filename) of every revision of a field file, oldest first
     if path.startswith(XNAT):
         path = path.replace(XNAT, '')
 
-    if '{timestamp}' in path:
-        resource, filename = path.split('/files/')
-        pattern = filename.format(timestamp=r'(_?(?P<timestamp>\d\d\d\d\-\d\d\-\d\dT\d\d:\d\d:\d\d)_?)?') + '$'
-        pattern = pattern.replace(' ', '%20')
+    if '{timestamp}' not in path:
+        return []
 
-        # Query all files and sort by timestamp
-        print('{}/files'.format(resource))
+    resource, filename = path.split('/files/')
+    pattern = timestamp_pattern(filename).replace(' ', '%20')
+
+    # Query all files and sort by timestamp
+    logger.debug('Listing %s/files', resource)
+    with METRICS.timer('http/xnat_listing'):
         files = xnat_connection.get_json('{}/files'.format(resource))
-        files = [x['Name'] for x in files['ResultSet']['Result']]
-        print('Found file candidates {}, pattern is {}'.format(files, pattern))
-        files = {re.match(pattern, x): x for x in files}
-        files = {k.group('timestamp'): v for k, v in files.items() if k is not None}
-        print('Found files: {}'.format(files))
+    files = [x['Name'] for x in files['ResultSet']['Result']]
+    logger.debug('Found file candidates %s, pattern is %s', files, pattern)
+    return [(resource, timestamp, filename) for timestamp, filename in select_revisions(files, pattern)]
 
-        if len(files) == 0:
-            return None
 
-        # None is the first, timestamp come after that, so last one is highest timestamp
-        files = sorted(files.items())
-        latest_timestamp = files[-1][0]
-        latest_file = files[-1][1]
-        print('Select {} as being the latest file'.format(latest_file))
+def find_latest_file(path, xnat_connection):
+    revisions = find_revisions(path, xnat_connection)
+    if not revisions:
+        return None
 
-        # Construct the correct path again
-        path = '{}/files/{}'.format(resource, latest_file)
+    latest = revisions[-1]
+    logger.debug('Select %s as being the latest file', latest[2])
 
-        data = xnat_connection.get_json(path)
+    return latest
 
-        data['__timestamp__'] = latest_timestamp
 
-        return data
+def unchanged_revisions(task, task_content, xnat_connection, cache=None, checkpoint=None, reload=False):
+    # The listed revisions of the field file of a task if they do not have to be downloaded again: the
+    # checkpoint has the result of the newest revision and nothing is reloaded, or the cache has every
+    # revision that is read. None otherwise, also when the listing fails.
+    try:
+        revisions = find_revisions(task_content['fields_file'], xnat_connection)
+    except (IOError, ValueError) as exception:
+        logger.debug('Could not list %s: %s', task_content['fields_file'], exception)
+        return None
+    if not revisions:
+        return None
 
+    if not reload and checkpoint is not None and checkpoint.is_current(task['uri'], revisions[-1][1]):
+        return revisions
+    needed = revisions if reload else revisions[-1:]
+    if cache is not None and all(cache.contains(resource, timestamp) for resource, timestamp, _ in needed):
+        return revisions
+    return None
 
-def collect_info(connection, xnat_connection):
-    possible_tasks = []
-    for user_id in range(9, 19):
+
+def download_file(resource, timestamp, filename, xnat_connection, cache=None):
+    # A timestamped file never changes, so the listing is enough to know the cached copy is current
+    if cache is not None and timestamp is not None:
+        data = cache.get(resource, timestamp)
+        if data is not None:
+            METRICS.increment('field_file_cache_hits')
+            data['__timestamp__'] = timestamp
+            return data
+
+    # Construct the correct path again
+    path = '{}/files/{}'.format(resource, filename)
+
+    # Only the markers and raters are decoded, the rest of the file is not used
+    with METRICS.timer('http/xnat_download'):
+        response = xnat_connection.get(path)
+    with METRICS.timer('stage/parse'):
+        data = extract_field_data(response.content)
+    METRICS.increment('field_file_downloads')
+
+    if cache is not None and timestamp is not None:
+        cache.put(resource, timestamp, data)
+
+    data['__timestamp__'] = timestamp
+
+    return data
+
+
+def download_latest_file(path, xnat_connection, cache=None):
+    latest = find_latest_file(path, xnat_connection)
+
+    if latest is None:
+        return None
+
+    return download_file(*latest, xnat_connection, cache=cache)
+
+
+def download_revisions(revisions, xnat_connection, cache=None):
+    # (timestamp, field data) of every revision, revisions never change so only new ones are downloaded
+    return [(timestamp, download_file(resource, timestamp, filename, xnat_connection, cache=cache))
+            for resource, timestamp, filename in revisions]
+
+
+def pool_connections(session, workers):
+    # Keep enough keep-alive connections around for every worker thread
+    from requests.adapters import HTTPAdapter
+
+    from harvest_http import AdaptiveAdapter
+
+    if isinstance(session.get_adapter('http://'), AdaptiveAdapter):
+        # Already pooled by AdaptiveHTTP.mount
+        return session
+
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def map_ordered(function, items, workers):
+    # Map over items with a thread pool, the results keep the order of the items
+    if workers <= 1:
+        return list(map(function, items))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items))
+
+
+def imap_ordered(function, items, workers):
+    # Lazy map_ordered, items are only taken from the iterator while fewer than two per worker are in
+    # flight, so a slow consumer holds back the producers and memory does not grow with the input
+    if workers <= 1:
+        yield from map(function, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_user_tasks(connection, user_id):
+    with METRICS.timer('http/taskmanager_tasks'):
         response = connection.get(f'{TASKMANAGER}/api/v1/users/{user_id}/tasks')
-        print(f'response = [{response.status_code}] {response.text}')
-        user_tasks = response.json()['tasks']
-        possible_tasks.extend(x for x in user_tasks if x['status'] != 'aborted')
-        
-    result = []
+    logger.debug('response = [%s] %s', response.status_code, response.text)
+    response.raise_for_status()
+    user_tasks = response.json()['tasks']
+    return [x for x in user_tasks if x['status'] != 'aborted']
+
+
+def collect_info(connection, xnat_connection, workers=1, cache=None, checkpoint=None, store=None, spacing=None,
+                 bulk=False, snapshot=None, history=None):
+    if workers > 1:
+        pool_connections(connection, workers)
+        pool_connections(xnat_connection.interface, workers)
+
+    possible_tasks = []
+    with METRICS.timer('stage/discovery'):
+        for user_tasks in map_ordered(lambda user_id: get_user_tasks(connection, user_id), range(9, 19), workers):
+            possible_tasks.extend(user_tasks)
+
+    logger.info('Found %d tasks to check', len(possible_tasks))
+    METRICS.increment('tasks_found', len(possible_tasks))
+
+    if bulk:
+        # Fetch the task contents first, then all field files in a few archives instead of per task
+        contents = map_ordered(lambda task: guarded_task_content(task, connection, xnat_connection, checkpoint,
+                                                                 spacing),
+                               possible_tasks, workers)
+        tasks = [(task, content) for task, content in zip(possible_tasks, contents) if content is not None]
+        archive = FieldArchive(cache, history=history is not None)
+        listed = None
+        if (checkpoint is not None and checkpoint.tasks) or (cache is not None and cache.size):
+            # After an earlier run most field files are unchanged. Listing those is a small request each,
+            # the archives would fetch all their revisions again, so only changed field files are archived.
+            reload = snapshot is not None or history is not None
+            with METRICS.timer('stage/unchanged'):
+                listings = map_ordered(lambda item: unchanged_revisions(item[0], item[1], xnat_connection, cache,
+                                                                        checkpoint, reload),
+                                       tasks, workers)
+                listed = {content['fields_file']: revisions for (_, content), revisions in zip(tasks, listings)
+                          if revisions is not None}
+        with METRICS.timer('stage/archive'):
+            archive.download([content for _, content in tasks], xnat_connection, listed=listed)
+        result = map_ordered(lambda item: process_task(item[0], connection, xnat_connection, cache, checkpoint,
+                                                       spacing, item[1], archive, snapshot, history),
+                             tasks, workers)
+    else:
+        result = map_ordered(lambda task: process_task(task, connection, xnat_connection, cache, checkpoint,
+                                                       spacing, snapshot=snapshot, history=history),
+                             possible_tasks, workers)
+
+    info = [row for row in result if row is not None]
+
+    if store is not None:
+        with METRICS.timer('stage/store'):
+            appended = store.append(info)
+        logger.info('Results store: %d new or changed rows appended to %s', appended, store.directory)
+
+    return info
+
+
+def discover_tasks(connection, workers=1):
+    # Tasks of every user, yielded as the task list of each user arrives
+    for user_tasks in imap_ordered(lambda user_id: get_user_tasks(connection, user_id), range(9, 19), workers):
+        METRICS.increment('tasks_found', len(user_tasks))
+        yield from user_tasks
+
+
+def append_batches(rows, store, batch_size=10000):
+    # Pass rows through and append them to the results store in batches. Every batch writes a file per
+    # rater, so batches are large enough to keep the number of small files down.
+    batch = []
+    for row in rows:
+        batch.append(row)
+        yield row
+        if len(batch) >= batch_size:
+            with METRICS.timer('stage/store'):
+                store.append(batch)
+            batch = []
+    if batch:
+        with METRICS.timer('stage/store'):
+            store.append(batch)
+
+
+def stream_info(connection, xnat_connection, workers=1, cache=None, checkpoint=None, store=None, spacing=None):
+    # Streaming counterpart of collect_info: discovery, download and analysis run as a chain of
+    # generators with a bounded number of tasks in flight, rows are yielded as soon as they are ready.
+    # There is no snapshot or history, they would keep the markers of every task in memory.
+    if workers > 1:
+        pool_connections(connection, workers)
+        pool_connections(xnat_connection.interface, workers)
+
+    tasks = discover_tasks(connection, workers)
+    result = imap_ordered(lambda task: process_task(task, connection, xnat_connection, cache, checkpoint, spacing),
+                          tasks, workers)
+    rows = (row for row in result if row is not None)
+
+    if store is not None:
+        rows = append_batches(rows, store)
+    return rows
+
+
+def process_task(task, connection, xnat_connection, cache=None, checkpoint=None, spacing=None, task_content=None,
+                 archive=None, snapshot=None, history=None):
+    with METRICS.timer('stage/task'):
+        try:
+            return _process_task(task, connection, xnat_connection, cache, checkpoint, spacing, task_content,
+                                 archive, snapshot, history)
+        except (IOError, ValueError) as exception:
+            skip_task(task, exception)
+            return None
+
+
+def skip_task(task, exception):
+    # A request that still fails after its retries skips the task instead of ending the run, it is not
+    # checkpointed so the next run tries it again
+    logger.warning('Skipping task %s: %s', task['uri'], exception)
+    METRICS.increment('tasks_failed')
+    SKIPPED_TASKS.append((task['uri'], str(exception)))
 
-    print(f"Found {len(possible_tasks)} tasks to check")
 
-    for task in possible_tasks:
-        response = connection.get('{}{}'.format(TASKMANAGER, task['uri']))
+def guarded_task_content(task, connection, xnat_connection, checkpoint=None, spacing=None):
+    # get_task_content for the bulk harvest, None when the task is skipped
+    try:
+        return get_task_content(task, connection, xnat_connection, checkpoint, spacing)
+    except (IOError, ValueError) as exception:
+        skip_task(task, exception)
+        return None
+
+
+def get_task_content(task, connection, xnat_connection, checkpoint=None, spacing=None):
+    task_content = None
+    if checkpoint is not None:
+        task_content = checkpoint.task_content(task['uri'])
+
+    if task_content is None:
+        with METRICS.timer('http/taskmanager_task'):
+            response = connection.get('{}{}'.format(TASKMANAGER, task['uri']))
+        response.raise_for_status()
         task_data = response.json()
         task_content = json.loads(task_data['content'])
-        xnat_experiment = task_content['_vars']['EXPERIMENT_ID']
-        xnat_experiment = xnat_connection.create_object('/data/experiments/{}'.format(xnat_experiment))
-
-        # Get latest FIELDS dat from XNAT
-        field_data = download_latest_file(task_content['fields_file'], xnat_connection)
-
-        if field_data is None:
-            continue
-
-        rater = field_data['__raters__'][-1]
-        if rater == 'wvanderheijden' and 'wvanderheijden2' in task_content['fields_file']:
-            rater = 'wvanderheijden2'
-
-        print(f"Got field data: {json.dumps(field_data)}")
-        (i_s_R, lt_R, tttg_R, pt_R, lpt_R, bo_R, sa_R, lat_incl_R, med_incl_R, td_R, mis_R, cd_R, bp_R, ta_R,
-         i_s_L, lt_L, tttg_L, pt_L, lpt_L, bo_L, sa_L, lat_incl_L, med_incl_L, td_L, mis_L, cd_L, bp_L, ta_L
-         ) = knee_marker_analysis(field_data)
-
-        print(f"Calculated i_s R: {i_s_R}")
-        print(f"Calculated lt R: {lt_R}")
-        print(f"Calculated tttg R: {tttg_R}")
-        print(f"Calculated pt R: {pt_R}")
-        print(f"Calculated lpt_R: {lpt_R}")
-        print(f"Calculated bo_R: {bo_R}")
-        print(f"Calculated sa_R: {sa_R}")
-        print(f"Calculated lat_incl_R: {lat_incl_R}")
-        print(f"Calculated med_incl_R: {med_incl_R}")
-        print(f"Calculated td_R: {td_R}")
-        print(f"Calculated mis_R: {mis_R}")
-        print(f"Calculated cd_R: {cd_R}")
-        print(f"Calculated bp_R: {bp_R}")
-        print(f"Calculated ta_R: {ta_R}")
-        print(f"Calculated i_s L: {i_s_L}")
-        print(f"Calculated lt L: {lt_L}")
-        print(f"Calculated tttg L: {tttg_L}")
-        print(f"Calculated pt L: {pt_L}")
-        print(f"Calculated lpt_L: {lpt_L}")
-        print(f"Calculated bo_L: {bo_L}")
-        print(f"Calculated sa_L: {sa_L}")
-        print(f"Calculated lat_incl_L: {lat_incl_L}")
-        print(f"Calculated med_incl_L: {med_incl_L}")
-        print(f"Calculated td_L: {td_L}")
-        print(f"Calculated mis_L: {mis_L}")
-        print(f"Calculated cd_L: {cd_L}")
-        print(f"Calculated bp_L: {bp_L}")
-        print(f"Calculated ta_L: {ta_L}")
-
-        # Collect results
-        row = {
-            'label': task_content['_vars']['LABEL'],
-            'id': task_content['_vars']['EXPERIMENT_ID'],
-            'user': rater['username'],
-            'timestamp': rater['timestamp'],
-            'i_s_R': i_s_R,
-            'lt_R': lt_R,
-            'tttg_R': tttg_R,
-            'pt_R': pt_R,
-            'lpt_R': lpt_R,
-            'bo_R': bo_R,
-            'sa_R': sa_R,
-            'lat_incl_R': lat_incl_R,
-            'med_incl_R': med_incl_R,
-            'td_R': td_R,
-            'mis_R': mis_R,
-            'cd_R': cd_R,
-            'bp_R': bp_R,
-            'ta_R': ta_R,
-            'i_s_L': i_s_L,
-            'lt_L': lt_L,
-            'tttg_L': tttg_L,
-            'pt_L': pt_L,
-            'lpt_L': lpt_L,
-            'bo_L': bo_L,
-            'sa_L': sa_L,
-            'lat_incl_L': lat_incl_L,
-            'med_incl_L': med_incl_L,
-            'td_L': td_L,
-            'mis_L': mis_L,
-            'cd_L': cd_L,
-            'bp_L': bp_L,
-            'ta_L': ta_L
-        }
-
-        result.append(row)
-
-    return result
+        experiment_id = task_content['_vars']['EXPERIMENT_ID']
+        # The experiment has the scans, so the voxel spacing does not need a request of its own
+        with METRICS.timer('http/xnat_experiment'):
+            xnat_experiment = xnat_connection.get_json('/data/experiments/{}'.format(experiment_id))
+        if spacing is not None:
+            spacing.add(experiment_id, xnat_experiment)
+
+    return task_content
+
+
+def _process_task(task, connection, xnat_connection, cache, checkpoint, spacing, task_content, archive, snapshot,
+                  history):
+    if task_content is None:
+        task_content = get_task_content(task, connection, xnat_connection, checkpoint, spacing)
+
+    experiment_id = task_content['_vars']['EXPERIMENT_ID']
+    with METRICS.profile(experiment_id, 'profile_{}'.format(re.sub(r'[^\w.-]', '_', experiment_id))):
+        # Find latest FIELDS file on XNAT, skip the task if it was processed from that file before
+        revisions = None
+        if archive is not None and task_content['fields_file'] in archive.listed:
+            # Unchanged since an earlier run, listed before the archives were fetched and not in them
+            revisions = archive.listed[task_content['fields_file']]
+            archive = None
+        elif archive is not None and task_content['fields_file'] in archive.failed:
+            # Its archive could not be downloaded, list and download the field file on its own
+            archive = None
+        if archive is not None:
+            latest = archive.latest(task_content['fields_file'])
+        elif revisions is not None:
+            latest = revisions[-1]
+        elif history is not None:
+            # The listing has every revision, the history needs all of them
+            revisions = find_revisions(task_content['fields_file'], xnat_connection)
+            latest = revisions[-1] if revisions else None
+        else:
+            latest = find_latest_file(task_content['fields_file'], xnat_connection)
+        latest_timestamp = latest[1] if latest is not None else None
+
+        def load_field_data():
+            if archive is not None:
+                return archive.field_data(task_content['fields_file'])
+            return download_file(*latest, xnat_connection, cache=cache)
+
+        # Every revision for the history, the newest one is the field file that is analysed
+        def load_revisions():
+            if history is None:
+                return None, load_field_data()
+            if archive is not None:
+                field_revisions = archive.revisions(task_content['fields_file'])
+            else:
+                field_revisions = download_revisions(revisions, xnat_connection, cache=cache)
+            return field_revisions, field_revisions[-1][1]
+
+        # Voxel spacing of the marker scan, the analysis assumes 0.7 mm when it is not known
+        def scan_spacing():
+            return spacing.get(experiment_id, xnat_connection) if spacing is not None else None
+
+        if checkpoint is not None:
+            row = checkpoint.lookup(task['uri'], latest_timestamp)
+            if row is not None:
+                METRICS.increment('tasks_unchanged')
+                if snapshot is not None or history is not None:
+                    # They also need the markers of unchanged tasks, from the field file cache unless it is
+                    # disabled or the file was evicted
+                    METRICS.increment('tasks_unchanged_reloaded')
+                    field_revisions, field_data = load_revisions()
+                    if snapshot is not None:
+                        snapshot.add(row, field_data, scan_spacing())
+                    if history is not None:
+                        history.add(row, field_revisions, scan_spacing())
+                return row
+
+        row = None
+        if latest is not None:
+            (field_revisions, field_data), voxel_spacing = load_revisions(), scan_spacing()
+            row = analyse_task(task_content, field_data, voxel_spacing)
+            if snapshot is not None:
+                snapshot.add(row, field_data, voxel_spacing)
+            if history is not None:
+                history.add(row, field_revisions, voxel_spacing)
+        else:
+            METRICS.increment('tasks_without_field_file')
+
+    if checkpoint is not None:
+        checkpoint.record(task['uri'], task_content, latest_timestamp, row)
+
+    return row
+
+
+def analyse_task(task_content, field_data, spacing=None):
+    # The second read of wvanderheijden is stored as its own rater, so it can be compared with the first
+    rater = dict(field_data['__raters__'][-1])
+    if rater['username'] == 'wvanderheijden' and 'wvanderheijden2' in task_content['fields_file']:
+        rater['username'] = 'wvanderheijden2'
+
+    logger.debug('Got field data: %s', field_data)
+    # Screen the markers before they are analysed, a single session has no cohort to compare its sides
+    # with so those checks need SCREENING_ORIENTATION
+    positions, _ = pack_markers(field_data)
+    with METRICS.timer('stage/screening'):
+        reasons = describe(screen_markers(positions, orientation=SCREENING_ORIENTATION)[0])
+
+    values = None
+    if not reasons:
+        try:
+            with METRICS.timer('stage/analysis'):
+                values = knee_marker_analysis.knee_marker_analysis(field_data, spacing)
+        except ArithmeticError as exception:
+            logger.warning('Degenerate markers in %s: %s', task_content['_vars']['EXPERIMENT_ID'], exception)
+    if reasons and SKIP_FLAGGED:
+        values = [None] * len(PARAMETERS)
+    elif values is None:
+        # Degenerate geometry can make the analysis fail as a whole, the batch metrics give NaN for only
+        # the parameters it affects
+        with METRICS.timer('stage/analysis'):
+            columns = knee_marker_batch_analysis(positions[None], spacing=spacing)
+        values = [float(columns[name][0]) if math.isfinite(columns[name][0]) else None for name in PARAMETERS]
+    (i_s_R, lt_R, tttg_R, pt_R, lpt_R, bo_R, sa_R, lat_incl_R, med_incl_R, td_R, mis_R, cd_R, bp_R, ta_R,
+     i_s_L, lt_L, tttg_L, pt_L, lpt_L, bo_L, sa_L, lat_incl_L, med_incl_L, td_L, mis_L, cd_L, bp_L, ta_L) = values
+
+    # Collect results
+    row = {
+        'label': task_content['_vars']['LABEL'],
+        'id': task_content['_vars']['EXPERIMENT_ID'],
+        'user': rater['username'],
+        'timestamp': rater['timestamp'],
+        'i_s_R': i_s_R,
+        'lt_R': lt_R,
+        'tttg_R': tttg_R,
+        'pt_R': pt_R,
+        'lpt_R': lpt_R,
+        'bo_R': bo_R,
+        'sa_R': sa_R,
+        'lat_incl_R': lat_incl_R,
+        'med_incl_R': med_incl_R,
+        'td_R': td_R,
+        'mis_R': mis_R,
+        'cd_R': cd_R,
+        'bp_R': bp_R,
+        'ta_R': ta_R,
+        'i_s_L': i_s_L,
+        'lt_L': lt_L,
+        'tttg_L': tttg_L,
+        'pt_L': pt_L,
+        'lpt_L': lpt_L,
+        'bo_L': bo_L,
+        'sa_L': sa_L,
+        'lat_incl_L': lat_incl_L,
+        'med_incl_L': med_incl_L,
+        'td_L': td_L,
+        'mis_L': mis_L,
+        'cd_L': cd_L,
+        'bp_L': bp_L,
+        'ta_L': ta_L
+    }
+
+    # Plain floats, so rows compare equal to the rows read back from the checkpoint
+    for name in PARAMETERS:
+        if row[name] is not None:
+            row[name] = float(row[name])
+
+    METRICS.increment('tasks_analysed')
+    if reasons:
+        METRICS.increment('tasks_flagged')
+        logger.warning('Implausible markers in %s of %s: %s', row['id'], row['user'], ', '.join(reasons))
+        FLAGGED_SESSIONS.append(dict({x: row[x] for x in FLAGGED_FIELDNAMES[:-1]}, screening=';'.join(reasons)))
+
+    # One summary record per session instead of a line per parameter
+    calculated = sum(row[x] is not None for x in PARAMETERS)
+    logger.info('Analysed %s of %s: %d of %d parameters calculated', row['id'], row['user'],
+                calculated, len(PARAMETERS))
+
+    return row
 
 
 def write_info(info, filename):
-    fieldnames = (
-            [
-                'label', 'id', 'user', 'timestamp',
-                'i_s_R', 'lt_R', 'tttg_R', 'pt_R', 'lpt_R',
-                'bo_R', 'sa_R', 'lat_incl_R', 'med_incl_R',
-                'td_R', 'mis_R', 'cd_R', 'bp_R', 'ta_R',
-                'i_s_L', 'lt_L', 'tttg_L', 'pt_L', 'lpt_L',
-                'bo_L', 'sa_L', 'lat_incl_L', 'med_incl_L',
-                'td_L', 'mis_L', 'cd_L', 'bp_L', 'ta_L'
-            ]
-    )
-
-    data = pandas.DataFrame(info)
-    data.to_excel(filename, columns=fieldnames, index=False)
+    # The output format follows the extension of filename: .xlsx, .csv, .parquet or .arrow. info may
+    # be a generator, rows are written as they are produced. Returns the number of rows.
+    count = 0
+    with open_writer(filename, FIELDNAMES) as writer:
+        for row in info:
+            writer.write_row(row)
+            count += 1
+    return count
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Collect the knee parameters of all knee marker tasks')
+    parser.add_argument('--output', default='./knee_newIS.xlsx',
+                        help='output file, the format follows the extension: .xlsx, .csv, .parquet or .arrow '
+                             '(default: ./knee_newIS.xlsx)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of tasks to harvest concurrently (default: 1)')
+    parser.add_argument('--cache-dir', default='.knee_field_cache',
+                        help='directory to cache downloaded field files in (default: .knee_field_cache)')
+    parser.add_argument('--cache-size', type=int, default=512,
+                        help='maximum size of the field file cache in MB (default: 512)')
+    parser.add_argument('--no-cache', action='store_true', help='always download the field files')
+    parser.add_argument('--spacing-cache', default='.knee_scan_spacing.json',
+                        help='file to keep the voxel spacing of the scans in (default: .knee_scan_spacing.json)')
+    parser.add_argument('--no-spacing', action='store_true',
+                        help='do not look up the voxel spacing of the scans, assume 0.7 mm voxels')
+    parser.add_argument('--checkpoint',
+                        help='incremental mode: keep processed tasks in this file, skip tasks whose field '
+                             'file did not change and resume there after a crash')
+    parser.add_argument('--store', metavar='DIRECTORY',
+                        help='also append the results to the partitioned Parquet history in DIRECTORY, rows '
+                             'are updated when a (session, rater, timestamp) changes')
+    parser.add_argument('--bulk', action='store_true',
+                        help='download all field files in a few tar archives instead of listing and downloading '
+                             'them per task. With a checkpoint or field file cache from an earlier run the field '
+                             'files are listed first and only the changed ones are archived')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='also save the markers of every session in FILE (.npy), to analyse them again with '
+                             'knee_marker_snapshot.py without XNAT')
+    parser.add_argument('--history', metavar='FILE',
+                        help='also analyse every revision of the field files and write the parameters and how they '
+                             'and the markers changed since the previous revision to FILE, in any output format')
+    parser.add_argument('--flagged', metavar='FILE',
+                        help='write the sessions whose markers the plausibility screening flags to FILE, with '
+                             'the reasons, to send them back to the raters. Tasks reused from the checkpoint '
+                             'are not screened again')
+    parser.add_argument('--skip-flagged', action='store_true',
+                        help='do not compute the parameters of sessions the plausibility screening flags')
+    parser.add_argument('--orientation', type=json.loads,
+                        help='expected orientation of the knees for the side checks of the screening, as JSON, '
+                             'e.g. {"sides": 1, "R": 1, "L": -1}; without it those checks are skipped')
+    parser.add_argument('--stream', action='store_true',
+                        help='write every row as soon as its task is analysed instead of after the harvest, '
+                             'memory stays constant and the output grows while the run is going')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a response before the request is retried (default: 60)')
+    parser.add_argument('--retries', type=int, default=4,
+                        help='times a request is retried after a timeout, 429 or 5xx (default: 4)')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='show a summary per task, repeat to also show requests and analysis details')
+    parser.add_argument('--metrics', metavar='PREFIX',
+                        help='time every stage, HTTP endpoint and metric function and write the report to '
+                             'PREFIX.json and PREFIX.prom, and the throughput per host to PREFIX.hosts.json')
+    parser.add_argument('--profile', metavar='EXPERIMENT_ID',
+                        help='profile the harvest and analysis of a single session to profile_<EXPERIMENT_ID>')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile',
+                        help='profiler to use with --profile (default: cprofile)')
+    args = parser.parse_args()
+    if args.bulk and args.stream:
+        parser.error('--bulk needs all tasks before the first download and cannot be combined with --stream')
+    if args.snapshot and args.stream:
+        parser.error('--snapshot keeps the markers of every task until the end and cannot be combined with --stream')
+    if args.history and args.stream:
+        parser.error('--history keeps every revision until the end and cannot be combined with --stream')
+
+    # The HTTP clients are only needed for the harvest, importing them here keeps importing this module cheap
+    import requests
+    import xnat
+
+    from harvest_http import AdaptiveHTTP
+
+    # Only warnings by default, -v shows the harvest progress and -vv everything including the analysis
+    logging.basicConfig(format='[%(levelname)s] %(name)s: %(message)s',
+                        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+
+    if args.metrics:
+        METRICS.enabled = True
+        METRICS.instrument(knee_marker_analysis, METRIC_FUNCTIONS)
+    METRICS.profile_session = args.profile
+    METRICS.profiler = args.profiler
+
+    global SCREENING_ORIENTATION, SKIP_FLAGGED
+    SCREENING_ORIENTATION = args.orientation
+    SKIP_FLAGGED = args.skip_flagged
+
+    cache = None
+    if not args.no_cache:
+        cache = FieldFileCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+        # The index is only written now and then, also keep it when the run ends early
+        atexit.register(cache.save)
+
+    spacing = None
+    if not args.no_spacing:
+        spacing = ScanSpacingCache(args.spacing_cache)
+
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = HarvestCheckpoint(args.checkpoint)
+
+    store = None
+    if args.store:
+        store = ResultsStore(args.store)
+
+    snapshot = SnapshotCollector() if args.snapshot else None
+    if args.snapshot and checkpoint is not None and cache is None:
+        logger.warning('--snapshot without the field file cache downloads the field files of unchanged tasks again')
+    history = HistoryCollector() if args.history else None
+    if args.history and checkpoint is not None and cache is None:
+        logger.warning('--history without the field file cache downloads every revision of unchanged tasks again')
+
+    # Adaptive concurrency per host, timeouts, retries and circuit breakers for all requests
+    http = AdaptiveHTTP(args.workers, timeout=(10, args.timeout), retries=args.retries)
+
     with xnat.connect(XNAT) as xnat_connection:
         taskman_connection = requests.Session()
+        http.mount(taskman_connection)
+        http.mount(xnat_connection.interface)
 
         parsed_taskman = urlparse(TASKMANAGER)
 
@@ -192,10 +643,60 @@ def main():
             username, _, password = netrc.netrc(netrc_file).authenticators(parsed_taskman.netloc)
             taskman_connection.auth = (username, password)
         except (TypeError, IOError):
-            print('[INFO] Could not find login for {}, continuing without login'.format(parsed_taskman.netloc))
-
-        info = collect_info(taskman_connection, xnat_connection)
-    write_info(info, './knee_newIS.xlsx')
+            logger.info('Could not find login for %s, continuing without login', parsed_taskman.netloc)
+
+        info = None
+        if args.stream:
+            with METRICS.timer('stage/stream'):
+                rows = write_info(stream_info(taskman_connection, xnat_connection, workers=args.workers,
+                                              cache=cache, checkpoint=checkpoint, store=store, spacing=spacing),
+                              args.output)
+            logger.info('Wrote %d rows to %s', rows, args.output)
+        else:
+            info = collect_info(taskman_connection, xnat_connection, workers=args.workers, cache=cache,
+                                checkpoint=checkpoint, store=store, spacing=spacing, bulk=args.bulk,
+                                snapshot=snapshot, history=history)
+
+    if cache is not None:
+        cache.save()
+        logger.info('Field file cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, '
+                    '%(entries)d entries (%(bytes)d bytes)', cache.stats())
+    if snapshot is not None:
+        with METRICS.timer('stage/snapshot'):
+            write_snapshot(args.snapshot, snapshot.sessions)
+    if history is not None:
+        with METRICS.timer('stage/history'):
+            with open_writer(args.history, HISTORY_FIELDNAMES, numeric=HISTORY_NUMERIC) as writer:
+                writer.write_rows(revision_history(history.files))
+    if spacing is not None:
+        spacing.save()
+        logger.info('Scan spacing: %(lookups)d lookups, %(hits)d hits, %(experiments)d experiments', spacing.stats())
+    if checkpoint is not None:
+        # Only a completed run shrinks the log back to one record per task
+        checkpoint.compact()
+        checkpoint.close()
+        logger.info('Checkpoint: %d tasks unchanged, %d tasks processed', checkpoint.reused, checkpoint.recorded)
+    if info is not None:
+        with METRICS.timer('stage/write'):
+            write_info(info, args.output)
+
+    if FLAGGED_SESSIONS:
+        logger.warning('The markers of %d sessions are implausible%s', len(FLAGGED_SESSIONS),
+                       ', see ' + args.flagged if args.flagged else '')
+    if args.flagged:
+        with open_writer(args.flagged, FLAGGED_FIELDNAMES, numeric=()) as writer:
+            writer.write_rows(FLAGGED_SESSIONS)
+
+    http.log_stats()
+    if args.metrics:
+        METRICS.write(args.metrics)
+        with open(args.metrics + '.hosts.json', 'w') as hosts_file:
+            json.dump(http.stats(), hosts_file, indent=2)
+
+    if SKIPPED_TASKS:
+        logger.error('Skipped %d tasks after failed requests, run again to retry them:\n%s', len(SKIPPED_TASKS),
+                     '\n'.join(f'  {uri}: {reason}' for uri, reason in SKIPPED_TASKS))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+
+
+class HarvestCheckpoint:
+    # Append-only log of harvested tasks. Every processed task is written as one JSON line with its
+    # task content, the timestamp of the field file it was computed from, the
+    # (EXPERIMENT_ID, rater, timestamp) key of the result and the result row itself. Later lines
+    # for the same task replace earlier ones, so a crashed run can simply be started again.
+
+    def __init__(self, path):
+        self.path = path
+        self.tasks = {}
+        self.reused = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+        torn = False
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                for line in checkpoint_file:
+                    torn = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line can be truncated if the previous run was killed while writing
+                        continue
+                    self.tasks[record['uri']] = record
+
+        self._file = open(path, 'a')
+        if torn:
+            # End the truncated line, otherwise the next record is appended to it and lost as well
+            self._file.write('\n')
+            self._file.flush()
+
+    def task_content(self, uri):
+        # The content of a task does not change, so it only has to be fetched once
+        record = self.tasks.get(uri)
+        return record['content'] if record is not None else None
+
+    def is_current(self, uri, timestamp):
+        # Whether the stored result of a task was computed from the field file with this timestamp
+        record = self.tasks.get(uri)
+        return record is not None and timestamp is not None and record['timestamp'] == timestamp
+
+    def lookup(self, uri, timestamp):
+        # The stored result of a task if it was computed from the field file with this timestamp
+        if not self.is_current(uri, timestamp):
+            return None
+
+        with self._lock:
+            self.reused += 1
+        return self.tasks[uri]['row']
+
+    def record(self, uri, content, timestamp, row):
+        key = None
+        if row is not None:
+            key = [row['id'], row['user'], row['timestamp']]
+
+        record = {'uri': uri, 'content': content, 'timestamp': timestamp, 'key': key, 'row': row}
+        with self._lock:
+            self.tasks[uri] = record
+            self.recorded += 1
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def compact(self):
+        # Rewrite the log with only the latest record per task
+        with self._lock:
+            self._file.close()
+            with open(self.path + '.tmp', 'w') as checkpoint_file:
+                for record in self.tasks.values():
+                    checkpoint_file.write(json.dumps(record) + '\n')
+            os.replace(self.path + '.tmp', self.path)
+            self._file = open(self.path, 'a')
+
+    def close(self):
+        self._file.close()
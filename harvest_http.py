@@ -0,0 +1,262 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from harvest_metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+# Responses of an overloaded or failing server, the request is tried again after a while
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Only requests without side effects are retried
+RETRY_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class HostState:
+    # Adaptive concurrency limit, circuit breaker and statistics of the requests to one host.
+    #
+    # The limit follows AIMD: it grows by one after a limit's worth of successful requests and halves
+    # on a 429, 5xx, timeout or connection error, or when a response takes latency_factor times longer
+    # than the fastest one seen. It is halved at most once per smoothed latency, so a burst of slow
+    # responses to requests that were in flight together counts once. After failure_threshold failed
+    # requests in a row the circuit opens: requests wait for cooldown seconds, then a single request is
+    # let through to probe the host and the others wait for its outcome, at most cooldown seconds after
+    # which another request probes. Only when the host has been failing for max_outage seconds do
+    # requests fail at once with CircuitOpenError.
+
+    def __init__(self, host, max_limit, latency_factor=3.0, min_latency=0.05, failure_threshold=5, cooldown=30.0,
+                 max_outage=600.0):
+        self.host = host
+        self.max_limit = max_limit
+        self.limit = float(min(max_limit, 4))
+        self.latency_factor = latency_factor
+        self.min_latency = min_latency
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_outage = max_outage
+
+        self.in_flight = 0
+        self.fastest = None
+        self.smoothed = None
+        self.last_decrease = 0.0
+        self.failures_in_row = 0
+        self.open_until = None
+        self.opened_at = None
+        self.probing = False
+        self.probe_started = None
+
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.first_start = None
+        self.last_end = None
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        # Wait for a free slot, returns whether this request probes a host whose circuit is open
+        probe = False
+        with self._condition:
+            while True:
+                if self.open_until is not None:
+                    now = time.monotonic()
+                    if now - self.opened_at > self.max_outage:
+                        self.rejected += 1
+                        raise CircuitOpenError(f'circuit open for {self.host} since {now - self.opened_at:.0f} s '
+                                               f'after {self.failures_in_row} failed requests')
+                    if self.probing and now - self.probe_started < self.cooldown:
+                        # Wait for the probe to close the circuit or open it again
+                        self._condition.wait(self.cooldown - (now - self.probe_started))
+                        continue
+                    if now < self.open_until:
+                        self._condition.wait(self.open_until - now)
+                        continue
+                    # Half open, this request probes whether the host is back
+                    self.probing = probe = True
+                    self.probe_started = now
+                    break
+                if self.in_flight < int(self.limit):
+                    break
+                self._condition.wait()
+
+            self.in_flight += 1
+            self.requests += 1
+            if self.first_start is None:
+                self.first_start = time.monotonic()
+        return probe
+
+    def release(self, latency, failed=False, throttled=False, size=0, probe=False):
+        now = time.monotonic()
+        with self._condition:
+            self.in_flight -= 1
+            self.last_end = now
+            self.bytes += size
+            self.smoothed = latency if self.smoothed is None else 0.8 * self.smoothed + 0.2 * latency
+
+            if failed:
+                self.failures += 1
+                self.throttled += throttled
+                self.failures_in_row += 1
+                self._decrease(now)
+                if self.failures_in_row >= self.failure_threshold or probe:
+                    if self.open_until is None or probe:
+                        logger.warning('Circuit for %s opened for %.0f s after %d failed requests', self.host,
+                                       self.cooldown, self.failures_in_row)
+                        METRICS.increment('http_circuit_opened')
+                    if self.open_until is None:
+                        self.opened_at = now
+                    self.open_until = now + self.cooldown
+            else:
+                self.successes += 1
+                self.failures_in_row = 0
+                if self.open_until is not None:
+                    logger.warning('Circuit for %s closed', self.host)
+                    self.open_until = self.opened_at = None
+                self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+                if latency > self.min_latency and latency > self.latency_factor * self.fastest:
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            if probe:
+                self.probing = False
+            self._condition.notify_all()
+
+    def retried(self):
+        with self._condition:
+            self.retries += 1
+
+    def _decrease(self, now):
+        if now - self.last_decrease > (self.smoothed or 0.0):
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+
+    def stats(self):
+        with self._condition:
+            seconds = (self.last_end or 0.0) - (self.first_start or 0.0)
+            return {
+                'requests': self.requests,
+                'successes': self.successes,
+                'failures': self.failures,
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+                'limit': int(self.limit),
+                'latency': self.smoothed,
+                'requests_per_second': self.successes / seconds if seconds > 0 else None,
+                'bytes_per_second': self.bytes / seconds if seconds > 0 else None,
+                'circuit': 'closed' if self.open_until is None else 'open',
+            }
+
+
+class AdaptiveAdapter(HTTPAdapter):
+    # Transport adapter that sends every request through the HostState of its host and retries
+    # failed requests with jittered exponential backoff. It is mounted on the requests sessions of
+    # TASKMANAGER and of xnatpy, so all their requests are covered without changing the call sites.
+
+    def __init__(self, client, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        client = self.client
+        state = client.host(urlparse(request.url).netloc)
+        retries = client.retries if request.method in RETRY_METHODS else 0
+        if timeout is None:
+            timeout = client.timeout
+
+        for attempt in range(retries + 1):
+            probe = state.acquire()
+            start = time.monotonic()
+            response = None
+            try:
+                response = super().send(request, stream=stream, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exception:
+                if attempt == retries:
+                    raise
+                logger.info('Retrying %s after %s', request.url, exception)
+                delay = client.backoff_delay(attempt)
+            finally:
+                # Also after any other exception, a slot or probe that is not released blocks the host
+                failed = response is None or response.status_code in RETRY_STATUS
+                state.release(time.monotonic() - start, failed=failed,
+                              throttled=response is not None and response.status_code == 429,
+                              size=int(response.headers.get('Content-Length') or 0) if response is not None else 0,
+                              probe=probe)
+            if response is not None:
+                if not failed or attempt == retries:
+                    return response
+                logger.info('Retrying %s after status %d', request.url, response.status_code)
+                delay = client.backoff_delay(attempt, response.headers.get('Retry-After'))
+                response.close()
+
+            state.retried()
+            METRICS.increment('http_retries')
+            time.sleep(delay)
+
+
+class AdaptiveHTTP:
+    # Per-host adaptive concurrency, timeouts, retries and circuit breakers for the requests sessions
+    # it is mounted on. max_concurrency bounds the limit of every host, it is the number of workers.
+
+    def __init__(self, max_concurrency=1, timeout=(10, 60), retries=4, backoff=0.5, max_backoff=30.0,
+                 latency_factor=3.0, failure_threshold=5, cooldown=30.0, max_outage=600.0):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_factor = latency_factor
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_outage = max_outage
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, host):
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostState(host, self.max_concurrency, self.latency_factor,
+                                             failure_threshold=self.failure_threshold, cooldown=self.cooldown,
+                                             max_outage=self.max_outage)
+            return self.hosts[host]
+
+    def backoff_delay(self, attempt, retry_after=None):
+        # Seconds to wait before the next attempt: what the server asked for, otherwise full jitter
+        # exponential backoff so clients that failed together do not retry together
+        try:
+            return min(float(retry_after), self.max_backoff)
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def mount(self, session):
+        adapter = AdaptiveAdapter(self, pool_connections=self.max_concurrency, pool_maxsize=self.max_concurrency)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def stats(self):
+        with self._lock:
+            hosts = list(self.hosts.values())
+        return {x.host: x.stats() for x in hosts}
+
+    def log_stats(self):
+        for host, stats in self.stats().items():
+            logger.info('%s: %d requests, %d failed, %d retried, %d throttled, %d rejected by the circuit breaker, '
+                        '%.1f requests/s, %.0f kB/s, concurrency limit %d', host, stats['requests'],
+                        stats['failures'], stats['retries'], stats['throttled'], stats['rejected'],
+                        stats['requests_per_second'] or 0.0, (stats['bytes_per_second'] or 0.0) / 1024,
+                        stats['limit'])
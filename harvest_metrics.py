@@ -0,0 +1,187 @@
+import bisect
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket that contains the q-th quantile
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    # Timers and counters of the harvest pipeline. Timers are grouped as '<group>/<name>', e.g.
+    # 'stage/analysis', 'http/xnat_listing' or 'metric/tt_tg'. Nothing is recorded while disabled,
+    # which is the default.
+
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+        self.profile_session = None
+        self.profiler = 'cprofile'
+        self._lock = threading.Lock()
+        self._instrumented = []
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].observe(seconds)
+
+    def increment(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def instrument(self, module, names, group='metric'):
+        # Replace the functions in module with timed versions, the functions are looked up as module
+        # globals by their callers so the timers are picked up without changing the call sites
+        for name in names:
+            function = getattr(module, name)
+            setattr(module, name, self._timed(function, '{}/{}'.format(group, name)))
+            self._instrumented.append((module, name, function))
+
+    def _timed(self, function, name):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start)
+
+        return timed
+
+    def uninstrument(self):
+        for module, name, function in reversed(self._instrumented):
+            setattr(module, name, function)
+        self._instrumented = []
+
+    def report(self):
+        with self._lock:
+            return {
+                'timers': {
+                    name: {
+                        'count': x.count,
+                        'sum': x.sum,
+                        'mean': x.sum / x.count if x.count else None,
+                        'p50': x.quantile(0.5),
+                        'p90': x.quantile(0.9),
+                        'p99': x.quantile(0.99),
+                        'max': x.max,
+                        'buckets': {str(bound): count for bound, count in zip(BUCKETS, x.counts)},
+                    } for name, x in sorted(self.timers.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self, prefix='knee_harvest'):
+        # Report in the Prometheus text exposition format
+        lines = [
+            f'# HELP {prefix}_duration_seconds Duration of harvest stages, HTTP requests and metric functions',
+            f'# TYPE {prefix}_duration_seconds histogram',
+        ]
+        with self._lock:
+            for name, histogram in sorted(self.timers.items()):
+                group, _, label = name.partition('/')
+                labels = f'group="{group}",name="{label}"'
+                total = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    total += count
+                    bound = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{prefix}_duration_seconds_bucket{{{labels},le="{bound}"}} {total}')
+                lines.append(f'{prefix}_duration_seconds_sum{{{labels}}} {histogram.sum!r}')
+                lines.append(f'{prefix}_duration_seconds_count{{{labels}}} {histogram.count}')
+
+            lines.append(f'# HELP {prefix}_events_total Number of harvest events')
+            lines.append(f'# TYPE {prefix}_events_total counter')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prefix):
+        # Write the JSON report to <prefix>.json and the Prometheus metrics to <prefix>.prom
+        with open(prefix + '.json', 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        with open(prefix + '.prom', 'w') as report_file:
+            report_file.write(self.prometheus())
+
+    @contextmanager
+    def profile(self, session_id, output):
+        # Profile the block if it handles the session selected with profile_session
+        if self.profile_session is None or session_id != self.profile_session:
+            yield
+            return
+
+        if self.profiler == 'pyinstrument':
+            import pyinstrument
+
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(output + '.html', 'w') as profile_file:
+                    profile_file.write(profiler.output_html())
+        else:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(output + '.prof')
+
+
+METRICS = Metrics()
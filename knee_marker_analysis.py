@@ -1,181 +1,157 @@
-import json
-from zlib import Z_PARTIAL_FLUSH
-import xlsxwriter
+import logging
 import numpy as np
 import math
+import os
+
+from field_file_json import load_field_file
+from knee_marker_batch import PARAMETERS, VOXEL_SIZE
+from knee_marker_layout import MARKER_INDEX, has_markers, marker_mask, missing_markers, pack_markers
+from knee_output import open_writer
+
+
+logger = logging.getLogger(__name__)
 
 
 def knee_marker_analyse_file(data_path):
-    # Load data from JSON
-    with open(data_path) as json_file:
-        data = json.load(json_file)
+    # Load the markers and raters from JSON
+    return knee_marker_analysis(load_field_file(data_path))
 
-    return knee_marker_analysis(data)
 
+def knee_marker_analysis(data, spacing=None):
+    # Pack data in the fixed marker layout, missing markers are found with the presence mask
+    positions, mask = pack_markers(data)
 
-def knee_marker_analysis(data):
-    # Clean up data
-    marker = {x['name']: np.asarray(x['pos'][:3]) for x in data['markers']}
+    # With the (x, y, z) voxel spacing of the scan the positions are converted to millimetres,
+    # otherwise distances are converted with the default voxel size
+    voxel_size = VOXEL_SIZE
+    if spacing is not None:
+        positions *= np.asarray(spacing, dtype=np.float64)
+        voxel_size = 1.0
+    skipped = []
+
+    def markers(description, *names):
+        required = marker_mask(*names)
+        if not has_markers(mask, required):
+            skipped.append(description)
+            return None
+        return [positions[MARKER_INDEX[name]] for name in names]
 
     # --- Insall Salvati Ratio (IS) ---
     i_s_R, i_s_L = None, None
-    try:
-        i_s_R = insall_salvati(marker['Sup_Pat_R'], marker['Inf_Pat_R'],
-                               marker['Tub_Tib_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Insall Salvati R calculation: {exception}')
-
-    try:
-        i_s_L = insall_salvati(marker['Sup_Pat_L'], marker['Inf_Pat_L'],
-                               marker['Tub_Tib_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Insall Salvati L calculation: {exception}')
+    inputs = markers('Insall Salvati R', 'Sup_Pat_R', 'Inf_Pat_R', 'Tub_Tib_R')
+    if inputs is not None:
+        i_s_R = insall_salvati(*inputs)
+
+    inputs = markers('Insall Salvati L', 'Sup_Pat_L', 'Inf_Pat_L', 'Tub_Tib_L')
+    if inputs is not None:
+        i_s_L = insall_salvati(*inputs)
 
     # --- Lateral Translation (LT) ---
     lt_R, lt_L = None, None
-    try:
-        lt_R = lateral_translation(marker['Ant_Pat_R'], marker['Pos_Pat_R'], 
-                                   marker['Sulc_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Lateral Translation R calculation: {exception}')
-
-    try:
-        lt_L = lateral_translation(marker['Ant_Pat_L'], marker['Pos_Pat_L'],
-                                   marker['Sulc_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Lateral Translation L calculation: {exception}')
+    inputs = markers('Lateral Translation R', 'Ant_Pat_R', 'Pos_Pat_R', 'Sulc_R')
+    if inputs is not None:
+        lt_R = lateral_translation(*inputs, voxel_size=voxel_size)
+
+    inputs = markers('Lateral Translation L', 'Ant_Pat_L', 'Pos_Pat_L', 'Sulc_L')
+    if inputs is not None:
+        lt_L = lateral_translation(*inputs, voxel_size=voxel_size)
 
     # --- TT-TG Distance (tttg) ---
     tttg_R, tttg_L = None, None
-    try:
-        tttg_R = tt_tg(marker['Med_Pos_Cond_R'], marker['Lat_Pos_Cond_R'],
-                       marker['Tub_Tib_R'], marker['Sulc_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without TT-TG R calculation: {exception}')
-
-    try:
-        tttg_L = tt_tg(marker['Med_Pos_Cond_L'], marker['Lat_Pos_Cond_L'],
-                       marker['Tub_Tib_L'], marker['Sulc_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without TT-TG L calculation: {exception}')
+    inputs = markers('TT-TG R', 'Med_Pos_Cond_R', 'Lat_Pos_Cond_R', 'Tub_Tib_R', 'Sulc_R')
+    if inputs is not None:
+        tttg_R = tt_tg(*inputs, voxel_size=voxel_size)
+
+    inputs = markers('TT-TG L', 'Med_Pos_Cond_L', 'Lat_Pos_Cond_L', 'Tub_Tib_L', 'Sulc_L')
+    if inputs is not None:
+        tttg_L = tt_tg(*inputs, voxel_size=voxel_size)
 
     # --- Patellar Tilt (pt) ---
     pt_R, pt_L = None, None
-    try:
-        pt_R = pat_tilt(marker['Med_Pat_R'], marker['Lat_Pat_R'], marker['Med_Pos_Cond_R'],
-                        marker['Lat_Pos_Cond_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Patellar Tilt R calculation: {exception}')
-
-    try:
-        pt_L = pat_tilt(marker['Med_Pat_L'], marker['Lat_Pat_L'], marker['Med_Pos_Cond_L'],
-                        marker['Lat_Pos_Cond_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Patellar Tilt L calculation: {exception}')
+    inputs = markers('Patellar Tilt R', 'Med_Pat_R', 'Lat_Pat_R', 'Med_Pos_Cond_R', 'Lat_Pos_Cond_R')
+    if inputs is not None:
+        pt_R = pat_tilt(*inputs)
+
+    inputs = markers('Patellar Tilt L', 'Med_Pat_L', 'Lat_Pat_L', 'Med_Pos_Cond_L', 'Lat_Pos_Cond_L')
+    if inputs is not None:
+        pt_L = pat_tilt(*inputs)
 
     # --- Lateral Patellar Tilt (lpt) ---
     lpt_R, lpt_L = None, None
-    try:
-        lpt_R = lat_pat_tilt(marker['Pos_Pat_R'], marker['Lat_Pat_R'],
-                             marker['Med_Ant_Cond_R'], marker['Lat_Ant_Cond_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Lateral Patellar Tilt R calculation: {exception}')
-
-    try:
-        lpt_L = lat_pat_tilt(marker['Pos_Pat_L'], marker['Lat_Pat_L'],
-                             marker['Med_Ant_Cond_L'], marker['Lat_Ant_Cond_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Lateral Patellar Tilt L calculation: {exception}')
+    inputs = markers('Lateral Patellar Tilt R', 'Pos_Pat_R', 'Lat_Pat_R', 'Med_Ant_Cond_R', 'Lat_Ant_Cond_R')
+    if inputs is not None:
+        lpt_R = lat_pat_tilt(*inputs)
+
+    inputs = markers('Lateral Patellar Tilt L', 'Pos_Pat_L', 'Lat_Pat_L', 'Med_Ant_Cond_L', 'Lat_Ant_Cond_L')
+    if inputs is not None:
+        lpt_L = lat_pat_tilt(*inputs)
 
     # --- Bisect Offset (bo) ---
     bo_R, bo_L = None, None
-    try:
-        bo_R = bis_offset(marker['Sulc_R'], marker['Med_Pos_Cond_R'],
-                          marker['Lat_Pos_Cond_R'], marker['Lat_Pat_R'],
-                          marker['Med_Pat_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Bisect Offset R calculation: {exception}')
-
-    try:
-        bo_L = bis_offset(marker['Sulc_L'], marker['Med_Pos_Cond_L'],
-                          marker['Lat_Pos_Cond_L'], marker['Lat_Pat_L'],
-                          marker['Med_Pat_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Bisect Offset L calculation: {exception}')
+    inputs = markers('Bisect Offset R', 'Sulc_R', 'Med_Pos_Cond_R', 'Lat_Pos_Cond_R', 'Lat_Pat_R', 'Med_Pat_R')
+    if inputs is not None:
+        bo_R = bis_offset(*inputs)
+
+    inputs = markers('Bisect Offset L', 'Sulc_L', 'Med_Pos_Cond_L', 'Lat_Pos_Cond_L', 'Lat_Pat_L', 'Med_Pat_L')
+    if inputs is not None:
+        bo_L = bis_offset(*inputs)
 
     # --- Sulcus Angle (sa) ---
     sa_R, sa_L = None, None
-    try:
-        sa_R = sulc_angle(marker['Lat_Ant_Cond_R'], marker['Med_Ant_Cond_R'],
-                          marker['Sulc_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Sulcus Angle R calculation: {exception}')
-
-    try:
-        sa_L = sulc_angle(marker['Lat_Ant_Cond_L'], marker['Med_Ant_Cond_L'],
-                          marker['Sulc_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Sulcus Angle L calculation: {exception}')
+    inputs = markers('Sulcus Angle R', 'Lat_Ant_Cond_R', 'Med_Ant_Cond_R', 'Sulc_R')
+    if inputs is not None:
+        sa_R = sulc_angle(*inputs)
+
+    inputs = markers('Sulcus Angle L', 'Lat_Ant_Cond_L', 'Med_Ant_Cond_L', 'Sulc_L')
+    if inputs is not None:
+        sa_L = sulc_angle(*inputs)
 
     # --- Inclination (incl) ---
     lat_incl_R, med_incl_R, lat_incl_L, med_incl_L = None, None, None, None
-    try:
-        lat_incl_R, med_incl_R = inclination(marker['Lat_Ant_Cond_R'], marker['Med_Ant_Cond_R'],
-                                             marker['Sulc_R'], marker['Med_Pos_Cond_R'],
-                                             marker['Lat_Pos_Cond_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Inclination R calculation: {exception}')
-
-    try:
-        lat_incl_L, med_incl_L = inclination(marker['Lat_Ant_Cond_L'], marker['Med_Ant_Cond_L'],
-                                             marker['Sulc_L'], marker['Med_Pos_Cond_L'],
-                                             marker['Lat_Pos_Cond_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Inclination L calculation: {exception}')
+    inputs = markers('Inclination R', 'Lat_Ant_Cond_R', 'Med_Ant_Cond_R', 'Sulc_R',
+                     'Med_Pos_Cond_R', 'Lat_Pos_Cond_R')
+    if inputs is not None:
+        lat_incl_R, med_incl_R = inclination(*inputs)
+
+    inputs = markers('Inclination L', 'Lat_Ant_Cond_L', 'Med_Ant_Cond_L', 'Sulc_L',
+                     'Med_Pos_Cond_L', 'Lat_Pos_Cond_L')
+    if inputs is not None:
+        lat_incl_L, med_incl_L = inclination(*inputs)
 
     # --- Trochlear Depth (td) ---
     td_R, td_L = None, None
-    try:
-        td_R = depth_troch(marker['Med_Ant_Cond_R'], marker['Lat_Ant_Cond_R'],
-                           marker['Sulc_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Trochlear Depth R calculation: {exception}')
-
-    try:
-        td_L = depth_troch(marker['Med_Ant_Cond_L'], marker['Lat_Ant_Cond_L'],
-                           marker['Sulc_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Trochlear Depth L calculation: {exception}')
+    inputs = markers('Trochlear Depth R', 'Med_Ant_Cond_R', 'Lat_Ant_Cond_R', 'Sulc_R')
+    if inputs is not None:
+        td_R = depth_troch(*inputs, voxel_size=voxel_size)
+
+    inputs = markers('Trochlear Depth L', 'Med_Ant_Cond_L', 'Lat_Ant_Cond_L', 'Sulc_L')
+    if inputs is not None:
+        td_L = depth_troch(*inputs, voxel_size=voxel_size)
 
     # --- Modified Insall-Salvati (mis), Caton-Deschamps (cd), Blackburne-Peele (bp)  ---
     mis_R, cd_R, bp_R, mis_L, cd_L, bp_L = None, None, None, None, None, None
-    try:
-        mis_R, cd_R, bp_R = cd_bp_mis(marker['Sup_Pat_R'], marker['Inf_Art_Pat_R'],
-                                      marker['Sup_Ant_Tib_R'], marker['Tub_Tib_R'],
-                                      marker['Sup_Tib_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Ratio R calculation: {exception}')
-
-    try:
-        mis_L, cd_L, bp_L = cd_bp_mis(marker['Sup_Pat_L'], marker['Inf_Art_Pat_L'],
-                                      marker['Sup_Ant_Tib_L'], marker['Tub_Tib_L'],
-                                      marker['Sup_Tib_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Ratio L calculation: {exception}')
+    inputs = markers('Ratio R', 'Sup_Pat_R', 'Inf_Art_Pat_R', 'Sup_Ant_Tib_R', 'Tub_Tib_R', 'Sup_Tib_R')
+    if inputs is not None:
+        mis_R, cd_R, bp_R = cd_bp_mis(*inputs)
+
+    inputs = markers('Ratio L', 'Sup_Pat_L', 'Inf_Art_Pat_L', 'Sup_Ant_Tib_L', 'Tub_Tib_L', 'Sup_Tib_L')
+    if inputs is not None:
+        mis_L, cd_L, bp_L = cd_bp_mis(*inputs)
 
     # --- Trochlear Angle (TA) ---
     ta_R, ta_L = None, None
-    try:
-        ta_R = troch_angle(marker['Med_Ant_Cond_R'], marker['Lat_Ant_Cond_R'],
-                           marker['Med_Pos_Cond_R'], marker['Lat_Pos_Cond_R'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Trochlear Angle R calculation: {exception}')
-
-    try:
-        ta_L = troch_angle(marker['Med_Ant_Cond_L'], marker['Lat_Ant_Cond_L'],
-                           marker['Med_Pos_Cond_L'], marker['Lat_Pos_Cond_L'])
-    except KeyError as exception:
-        print(f'Error: Markers missing; Will continue without Trochlear Angle L calculation: {exception}')
+    inputs = markers('Trochlear Angle R', 'Med_Ant_Cond_R', 'Lat_Ant_Cond_R', 'Med_Pos_Cond_R', 'Lat_Pos_Cond_R')
+    if inputs is not None:
+        ta_R = troch_angle(*inputs)
+
+    inputs = markers('Trochlear Angle L', 'Med_Ant_Cond_L', 'Lat_Ant_Cond_L', 'Med_Pos_Cond_L', 'Lat_Pos_Cond_L')
+    if inputs is not None:
+        ta_L = troch_angle(*inputs)
+
+    # One summary record per session, the analysis is quiet unless debug logging is enabled
+    if skipped and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Markers missing: %s; continued without %s calculation', missing_markers(mask),
+                     ', '.join(skipped))
 
     # Output data
     return(i_s_R, lt_R, tttg_R, pt_R, lpt_R, bo_R, sa_R, lat_incl_R, med_incl_R, td_R, mis_R, cd_R, bp_R, ta_R,
@@ -193,11 +169,10 @@ def insall_salvati(sup_ar_pat, inf_pat, tub_tib):
     pat = math.dist(sup_ar_pat, inf_pat)
     tendon = math.dist(inf_pat, tub_tib)
     ins_sal = tendon/pat
-    print("Insall-Salvati Ratio")
     return ins_sal
 
 
-def lateral_translation(pat_ant, pat_post, troch_sulc):
+def lateral_translation(pat_ant, pat_post, troch_sulc, voxel_size=VOXEL_SIZE):
     x, y, z = pat_ant
     pat_ant = [x, y]
     pat_ant = np.asarray(pat_ant)
@@ -208,12 +183,11 @@ def lateral_translation(pat_ant, pat_post, troch_sulc):
     troch_sulc = [x, y]
     troch_sulc = np.asarray(troch_sulc)
     pat_lat_trans = np.linalg.norm(np.cross(pat_ant-pat_post, pat_post-troch_sulc))/np.linalg.norm(pat_ant-pat_post)
-    pat_lat_trans = pat_lat_trans * 0.7
-    print("Lateral Translation Patella")
+    pat_lat_trans = pat_lat_trans * voxel_size
     return pat_lat_trans
 
 
-def tt_tg(pcl_m, pcl_l, tub_tib, troch_sulc):
+def tt_tg(pcl_m, pcl_l, tub_tib, troch_sulc, voxel_size=VOXEL_SIZE):
     xm, ym, zm = pcl_m
     xl, yl, zl = pcl_l
     x3, y3, z3 = tub_tib
@@ -229,8 +203,7 @@ def tt_tg(pcl_m, pcl_l, tub_tib, troch_sulc):
     tg = xtg, ytg
 
     tttg = math.dist(tt, tg)
-    tttg = tttg * 0.7
-    print("TT-TG distance")
+    tttg = tttg * voxel_size
     return tttg
 
 
@@ -242,7 +215,6 @@ def pat_tilt(pat_m, pat_l, pcl_m, pcl_l):
     dot_product = np.dot(unit_pcl, unit_pat)
     angle = np.arccos(dot_product)
     pat_tilt = 180 * angle / np.pi
-    print('Patellar Tilt')
     return pat_tilt
 
 
@@ -254,7 +226,6 @@ def lat_pat_tilt(pat_post, pat_l, cond_ant_l, cond_ant_m):
     dot_product = np.dot(unit_lat, unit_cond)
     angle = np.arccos(dot_product)
     lat_pat_tilt = 180 * angle / np.pi
-    print("Lateral Patellar Tilt")
     return lat_pat_tilt
 
 
@@ -278,7 +249,7 @@ def bis_offset(troch_sulc, pcl_m, pcl_l, pat_l, pat_m):
 
         div = det(xdiff, ydiff)
         if div == 0:
-            raise Exception('lines do not intersect')
+            raise ZeroDivisionError('lines do not intersect')
 
         d = (det(*line1), det(*line2))
         x = det(d, xdiff) / div
@@ -289,7 +260,6 @@ def bis_offset(troch_sulc, pcl_m, pcl_l, pat_l, pat_m):
     d = pat_l[0]-pat_m[0]
     g = pat_l[0] - punt[0]
     bis_off = g/d
-    print("Bisect Offset")
     return bis_off
 
 
@@ -302,7 +272,6 @@ def sulc_angle(cond_ant_l, cond_ant_m, troch_sulc):
     dot_product = np.dot(unit_l, unit_m)
     angle = np.arccos(dot_product)
     sulcus_angle = 180 * angle / np.pi
-    print("Sulcus Angle")
     return sulcus_angle
 
 
@@ -323,11 +292,10 @@ def inclination(cond_ant_l, cond_ant_m, troch_sulc, pcl_m, pcl_l):
     dot_product_med = np.dot(unit_med, unit_pcl)
     angle_med = np.arccos(dot_product_med)
     med_incl = 180*angle_med/np.pi
-    print("lateral and medial inclination")
     return lat_incl, med_incl
 
 
-def depth_troch(cond_ant_m, cond_ant_l, troch_sulc):
+def depth_troch(cond_ant_m, cond_ant_l, troch_sulc, voxel_size=VOXEL_SIZE):
     xm, ym, zm = cond_ant_m
     xl, yl, zl = cond_ant_l
     x3, y3, z3 = troch_sulc
@@ -339,8 +307,7 @@ def depth_troch(cond_ant_m, cond_ant_l, troch_sulc):
     td = xtd, ytd
 
     troch_depth = math.dist(td, troch_sulc)
-    troch_depth = troch_depth * 0.7
-    print("Trochlear Depth")
+    troch_depth = troch_depth * voxel_size
     return troch_depth
 
 
@@ -365,7 +332,6 @@ def cd_bp_mis(sup_pat, inf_ar_pat, tib_ant_sup, tub_tib, tib_sup):
     a, b, tib_plat = np.asarray(tib_sup)
     pat_plat = inf_ar_pat[1]-tib_plat
     black_peel = pat_plat/pat_ar
-    print("Modified Insall Salvati, Caton-Deschamps, Blackburne-Peele")
     return mod_is, cat_dchmps, black_peel
 
 
@@ -377,14 +343,11 @@ def troch_angle(cond_ant_m, cond_ant_l, pcl_m, pcl_l):
     dot_product = np.dot(unit_ant, unit_pcl)
     angle = np.arccos(dot_product)
     tr_angl = 180 * angle / np.pi
-    print("Trochlear Angle")
     return tr_angl
 
 
-def calculate_parameters(output_file, ids):
-    workbook = xlsxwriter.Workbook(output_file)
-    worksheet = workbook.add_worksheet()
-    bold = workbook.add_format({'bold': True})
+def calculate_parameters(output_file, paths):
+    # Analyse exported field files, the ID of every row is the file name without extension
     first_line = ['ID',
                   'Insall Salvati Ratio R',
                   'Lateral Translation Patella R',
@@ -415,49 +378,17 @@ def calculate_parameters(output_file, ids):
                   'Blackburne-Peele Ratio L',
                   'Trochlear Angle L'
                   ]
-    for column, value in enumerate(first_line):
-        worksheet.write(0, column, value, bold)
-
-    file = "D:/TM Stage Resources/Stage 3 Resources/Sample data/data1.json"
-
-    for row, patient_id in enumerate(ids):
-        (i_s_R, lt_R, tttg_R, pt_R, lpt_R, bo_R, sa_R, lat_incl_R, med_incl_R, td_R, mis_R, cd_R, bp_R, ta_R,
-         i_s_L, lt_L, tttg_L, pt_L, lpt_L, bo_L, sa_L, lat_incl_L, med_incl_L, td_L, mis_L, cd_L, bp_L, ta_L
-         ) = knee_marker_analysis(file)
-        worksheet.write(row + 1, 0, patient_id)
-        worksheet.write(row + 1, 1, i_s_R)
-        worksheet.write(row + 1, 2, lt_R)
-        worksheet.write(row + 1, 3, tttg_R)
-        worksheet.write(row + 1, 4, pt_R)
-        worksheet.write(row + 1, 5, lpt_R)
-        worksheet.write(row + 1, 6, bo_R)
-        worksheet.write(row + 1, 7, sa_R)
-        worksheet.write(row + 1, 8, lat_incl_R)
-        worksheet.write(row + 1, 9, med_incl_R)
-        worksheet.write(row + 1, 10, td_R)
-        worksheet.write(row + 1, 11, mis_R)
-        worksheet.write(row + 1, 12, cd_R)
-        worksheet.write(row + 1, 13, bp_R)
-        worksheet.write(row + 1, 14, ta_R)
-        worksheet.write(row + 1, 15, i_s_L)
-        worksheet.write(row + 1, 16, lt_L)
-        worksheet.write(row + 1, 17, tttg_L)
-        worksheet.write(row + 1, 18, pt_L)
-        worksheet.write(row + 1, 19, lpt_L)
-        worksheet.write(row + 1, 20, bo_L)
-        worksheet.write(row + 1, 21, sa_L)
-        worksheet.write(row + 1, 22, lat_incl_L)
-        worksheet.write(row + 1, 23, med_incl_L)
-        worksheet.write(row + 1, 24, td_L)
-        worksheet.write(row + 1, 25, mis_L)
-        worksheet.write(row + 1, 26, cd_L)
-        worksheet.write(row + 1, 27, bp_L)
-        worksheet.write(row + 1, 28, ta_L)
-    workbook.close()
+
+    # Rows are written whole, the backend follows the extension of output_file
+    with open_writer(output_file, ['id'] + list(PARAMETERS), header=first_line) as writer:
+        for path in paths:
+            row = dict(zip(PARAMETERS, knee_marker_analyse_file(path)))
+            row['id'] = os.path.splitext(os.path.basename(path))[0]
+            writer.write_row(row)
 
 
 if __name__ == '__main__':
     # Run a test:
     test = "D:/TM Stage Resources/Stage 3 Resources/Sample data/data4.json"
-    calculate_parameters('D:/test1.xlsx', [1])
+    calculate_parameters('D:/test1.xlsx', [test])
     # knee_marker_analysis(test)
@@ -0,0 +1,229 @@
+from collections import namedtuple
+
+import numpy as np
+
+from knee_marker_layout import MARKER_INDEX
+
+
+# Output columns, in the same order as the tuple returned by knee_marker_analysis
+PARAMETERS = (
+    'i_s_R', 'lt_R', 'tttg_R', 'pt_R', 'lpt_R', 'bo_R', 'sa_R',
+    'lat_incl_R', 'med_incl_R', 'td_R', 'mis_R', 'cd_R', 'bp_R', 'ta_R',
+    'i_s_L', 'lt_L', 'tttg_L', 'pt_L', 'lpt_L', 'bo_L', 'sa_L',
+    'lat_incl_L', 'med_incl_L', 'td_L', 'mis_L', 'cd_L', 'bp_L', 'ta_L',
+)
+
+# Voxel size in millimetres of the scans the markers were placed on, when their spacing is not known
+VOXEL_SIZE = 0.7
+
+# Every metric and every intermediate shared between metrics is a node computed from its inputs, which
+# are markers or other nodes. markers are all markers the node depends on: a metric is NaN for sessions
+# in which any of them is missing, like knee_marker_analysis skips a metric when one of its markers is
+# missing. side is 'R' or 'L'.
+Node = namedtuple('Node', ['name', 'side', 'inputs', 'function', 'markers'])
+
+NODES = {}
+
+
+def register(name, side, inputs, function, markers=()):
+    # Add a node, markers lists markers the node needs beyond the ones its inputs depend on
+    inputs = tuple(inputs)
+    dependencies = set(markers)
+    for item in inputs:
+        dependencies.update([item] if item in MARKER_INDEX else NODES[item].markers)
+    NODES[name] = Node(name, side, inputs, function, frozenset(dependencies))
+
+
+def dependent_nodes(*markers):
+    # Names of the nodes that change when any of the given markers moves
+    return [name for name, node in NODES.items() if not node.markers.isdisjoint(markers)]
+
+
+def knee_marker_batch_analysis(positions, parameters=PARAMETERS, spacing=None):
+    # Vectorized counterpart of knee_marker_analysis: takes a (sessions x markers x 3) array as made
+    # by pack_sessions and returns a dict with a column per parameter, NaN where markers are missing.
+    # Only the requested parameters and the nodes they need are computed. spacing is the (x, y, z)
+    # voxel spacing in millimetres of all sessions or a (sessions x 3) array with one per session.
+    return MetricEvaluation(positions, spacing).compute(parameters)
+
+
+class MetricEvaluation:
+    # Node values of one batch of sessions. Values are computed when first asked for and kept, so
+    # intermediates are shared between metrics. update replaces the positions of a marker and only
+    # forgets the nodes that depend on it, the next compute recomputes those and nothing else.
+    # Positions are in voxels and converted to millimetres with spacing, VOXEL_SIZE in every
+    # direction by default, so distances come out in millimetres.
+
+    def __init__(self, positions, spacing=None):
+        positions = np.asarray(positions, dtype=np.float64)
+        if positions.ndim == 2:
+            positions = positions[np.newaxis]
+        self.positions = positions
+        self.spacing = np.broadcast_to(np.asarray(VOXEL_SIZE if spacing is None else spacing, dtype=np.float64),
+                                       (len(positions), 3))
+        self.evaluations = 0
+        self._markers = {}
+        self._missing = {}
+        self._values = {}
+
+    def marker(self, name):
+        if name not in self._markers:
+            self._markers[name] = self.positions[:, MARKER_INDEX[name]] * self.spacing
+        return self._markers[name]
+
+    def missing(self, name):
+        # Sessions without the marker
+        if name not in self._missing:
+            self._missing[name] = np.isnan(self.marker(name)).any(axis=1)
+        return self._missing[name]
+
+    def value(self, name):
+        if name in MARKER_INDEX:
+            return self.marker(name)
+        if name not in self._values:
+            node = NODES[name]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = node.function(*[self.value(x) for x in node.inputs])
+            missing = np.logical_or.reduce([self.missing(x) for x in node.markers])
+            if missing.any():
+                result = np.where(missing[(slice(None),) + (np.newaxis,) * (result.ndim - 1)], np.nan, result)
+            self._values[name] = result
+            self.evaluations += 1
+        return self._values[name]
+
+    def compute(self, names=PARAMETERS):
+        return {name: self.value(name) for name in names}
+
+    def update(self, marker, positions, sessions=slice(None)):
+        # Move a marker in the given sessions to positions in voxels, the positions array passed in is
+        # left untouched
+        column = self.marker(marker).copy()
+        column[sessions] = np.asarray(positions, dtype=np.float64) * self.spacing[sessions]
+        self._markers[marker] = column
+        self._missing.pop(marker, None)
+        for name in dependent_nodes(marker):
+            self._values.pop(name, None)
+
+
+def _unit(vector):
+    return vector / np.linalg.norm(vector, axis=-1, keepdims=True)
+
+
+def _angle(unit_a, unit_b):
+    # Angle in degrees between two sets of unit vectors
+    dot_product = np.einsum('ij,ij->i', unit_a, unit_b)
+    return 180 * np.arccos(dot_product) / np.pi
+
+
+def _project(line_m, line_l, point):
+    # Project point on the line through line_l along (line_l - line_m), in the axial (x, y) plane
+    dx = line_l[:, 0] - line_m[:, 0]
+    dy = line_l[:, 1] - line_m[:, 1]
+    det = dx * dx + dy * dy
+    a = (dy * (point[:, 1] - line_l[:, 1]) + dx * (point[:, 0] - line_l[:, 0])) / det
+    return np.column_stack((line_l[:, 0] + a * dx, line_l[:, 1] + a * dy))
+
+
+def batch_insall_salvati(sup_ar_pat, inf_pat, tub_tib):
+    pat = np.hypot(*(sup_ar_pat[:, 1:] - inf_pat[:, 1:]).T)
+    tendon = np.hypot(*(inf_pat[:, 1:] - tub_tib[:, 1:]).T)
+    return tendon / pat
+
+
+def batch_lateral_translation(pat_ant, pat_post, troch_sulc):
+    axis = pat_ant[:, :2] - pat_post[:, :2]
+    offset = pat_post[:, :2] - troch_sulc[:, :2]
+    cross = axis[:, 0] * offset[:, 1] - axis[:, 1] * offset[:, 0]
+    return np.abs(cross) / np.hypot(axis[:, 0], axis[:, 1])
+
+
+def batch_tt_tg(tub_on_pcl, sulc_on_pcl):
+    return np.hypot(*(tub_on_pcl - sulc_on_pcl).T)
+
+
+def batch_pat_tilt(pat_m, pat_l, pcl_unit):
+    return _angle(pcl_unit, _unit(pat_m - pat_l))
+
+
+def batch_lat_pat_tilt(pat_post, pat_l, cond_ant_l, cond_ant_m):
+    return _angle(_unit(pat_post - pat_l), _unit(cond_ant_l - cond_ant_m))
+
+
+def batch_bis_offset(troch_sulc, sulc_on_pcl, pat_l, pat_m):
+    xpcl, ypcl = sulc_on_pcl.T
+
+    # Intersect the line from the projected sulcus to the sulcus with the patellar width line
+    xdiff = (xpcl - troch_sulc[:, 0], pat_l[:, 0] - pat_m[:, 0])
+    ydiff = (ypcl - troch_sulc[:, 1], pat_l[:, 1] - pat_m[:, 1])
+    div = xdiff[0] * ydiff[1] - xdiff[1] * ydiff[0]
+    d = (xpcl * troch_sulc[:, 1] - ypcl * troch_sulc[:, 0],
+         pat_l[:, 0] * pat_m[:, 1] - pat_l[:, 1] * pat_m[:, 0])
+    x = (d[0] * xdiff[1] - d[1] * xdiff[0]) / np.where(div == 0, np.nan, div)
+
+    d = pat_l[:, 0] - pat_m[:, 0]
+    g = pat_l[:, 0] - x
+    return g / d
+
+
+def batch_sulc_angle(lat_facet_unit, med_facet_unit):
+    return _angle(lat_facet_unit, med_facet_unit)
+
+
+def batch_inclination(facet_unit, pcl_unit):
+    # Against the PCL pointing laterally, pcl_unit points medially
+    return _angle(facet_unit, -pcl_unit)
+
+
+def batch_depth_troch(troch_sulc, sulc_on_acl):
+    return np.hypot(*(sulc_on_acl - troch_sulc[:, :2]).T)
+
+
+def batch_patellar_height(pat_ar, inf_ar_pat, tibia):
+    # Distance from the inferior patellar cartilage to a tibial landmark relative to the patellar cartilage length
+    return np.hypot(*(inf_ar_pat[:, 1:] - tibia[:, 1:]).T) / pat_ar
+
+
+def batch_black_peel(pat_ar, inf_ar_pat, tib_sup):
+    return (inf_ar_pat[:, 2] - tib_sup[:, 2]) / pat_ar
+
+
+def batch_troch_angle(cond_ant_m, cond_ant_l, pcl_unit):
+    return _angle(_unit(cond_ant_m - cond_ant_l), pcl_unit)
+
+
+def _register_side(side):
+    def m(name):
+        return f'{name}_{side}'
+
+    # Intermediates shared between metrics
+    register(m('pcl_unit'), side, [m('Med_Pos_Cond'), m('Lat_Pos_Cond')], lambda pcl_m, pcl_l: _unit(pcl_m - pcl_l))
+    register(m('tub_on_pcl'), side, [m('Med_Pos_Cond'), m('Lat_Pos_Cond'), m('Tub_Tib')], _project)
+    register(m('sulc_on_pcl'), side, [m('Med_Pos_Cond'), m('Lat_Pos_Cond'), m('Sulc')], _project)
+    register(m('sulc_on_acl'), side, [m('Med_Ant_Cond'), m('Lat_Ant_Cond'), m('Sulc')], _project)
+    register(m('lat_facet_unit'), side, [m('Lat_Ant_Cond'), m('Sulc')], lambda cond, sulc: _unit(cond - sulc))
+    register(m('med_facet_unit'), side, [m('Med_Ant_Cond'), m('Sulc')], lambda cond, sulc: _unit(cond - sulc))
+    register(m('pat_ar'), side, [m('Sup_Pat'), m('Inf_Art_Pat')],
+             lambda sup_pat, inf_ar_pat: np.hypot(*(sup_pat[:, 1:] - inf_ar_pat[:, 1:]).T))
+
+    # Metrics, the inclinations and cd_bp_mis ratios are only reported together like in knee_marker_analysis
+    register(m('i_s'), side, [m('Sup_Pat'), m('Inf_Pat'), m('Tub_Tib')], batch_insall_salvati)
+    register(m('lt'), side, [m('Ant_Pat'), m('Pos_Pat'), m('Sulc')], batch_lateral_translation)
+    register(m('tttg'), side, [m('tub_on_pcl'), m('sulc_on_pcl')], batch_tt_tg)
+    register(m('pt'), side, [m('Med_Pat'), m('Lat_Pat'), m('pcl_unit')], batch_pat_tilt)
+    register(m('lpt'), side, [m('Pos_Pat'), m('Lat_Pat'), m('Med_Ant_Cond'), m('Lat_Ant_Cond')], batch_lat_pat_tilt)
+    register(m('bo'), side, [m('Sulc'), m('sulc_on_pcl'), m('Lat_Pat'), m('Med_Pat')], batch_bis_offset)
+    register(m('sa'), side, [m('lat_facet_unit'), m('med_facet_unit')], batch_sulc_angle)
+    register(m('lat_incl'), side, [m('lat_facet_unit'), m('pcl_unit')], batch_inclination,
+             markers=[m('Med_Ant_Cond')])
+    register(m('med_incl'), side, [m('med_facet_unit'), m('pcl_unit')], batch_inclination,
+             markers=[m('Lat_Ant_Cond')])
+    register(m('td'), side, [m('Sulc'), m('sulc_on_acl')], batch_depth_troch)
+    tibia = [m('Sup_Ant_Tib'), m('Tub_Tib'), m('Sup_Tib')]
+    register(m('mis'), side, [m('pat_ar'), m('Inf_Art_Pat'), m('Tub_Tib')], batch_patellar_height, markers=tibia)
+    register(m('cd'), side, [m('pat_ar'), m('Inf_Art_Pat'), m('Sup_Ant_Tib')], batch_patellar_height, markers=tibia)
+    register(m('bp'), side, [m('pat_ar'), m('Inf_Art_Pat'), m('Sup_Tib')], batch_black_peel, markers=tibia)
+    register(m('ta'), side, [m('Med_Ant_Cond'), m('Lat_Ant_Cond'), m('pcl_unit')], batch_troch_angle)
+
+
+_register_side('R')
+_register_side('L')
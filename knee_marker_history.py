@@ -0,0 +1,177 @@
+import argparse
+import logging
+import math
+import os
+import re
+import threading
+
+import numpy as np
+
+from knee_marker_batch import NODES, PARAMETERS, VOXEL_SIZE, MetricEvaluation
+from knee_marker_layout import MARKER_INDEX, MARKERS, pack_markers
+from knee_output import open_writer
+
+
+logger = logging.getLogger(__name__)
+
+# One row per revision of a field file: its parameters with the change since the previous revision
+# under name_delta, and how far every marker moved in millimetres under marker_shift. changed lists
+# the markers that were moved, placed or removed in the revision.
+HISTORY_FIELDNAMES = (['label', 'id', 'user', 'timestamp', 'revision', 'previous_revision', 'changed']
+                      + [f'{name}{suffix}' for name in PARAMETERS for suffix in ('', '_delta')]
+                      + [f'{name}_shift' for name in MARKERS])
+HISTORY_NUMERIC = frozenset(HISTORY_FIELDNAMES[7:])
+
+# Timestamp in the name of an exported revision, like the {timestamp} of a fields_file
+REVISION_PATTERN = re.compile(r'_?(\d\d\d\d-\d\d-\d\dT\d\d[:_]\d\d[:_]\d\d)_?')
+
+
+class HistoryCollector:
+    # Collects the revisions of the field files of a harvest for revision_history, add is called from
+    # the worker threads. revisions is a list of (revision timestamp, field data), oldest first.
+
+    def __init__(self):
+        self.files = []
+        self._lock = threading.Lock()
+
+    def add(self, row, revisions, spacing=None):
+        with self._lock:
+            self.files.append((row, revisions, spacing))
+
+
+def _changed_markers(positions, first):
+    # (revisions x markers) array, True where a marker moved, was placed or was removed since the
+    # previous revision of the same field file, and for every marker of the first revision
+    previous = np.roll(positions, 1, axis=0)
+    same = (positions == previous) | (np.isnan(positions) & np.isnan(previous))
+    changed = ~same.all(axis=2)
+    changed[first] = True
+    return changed
+
+
+def revision_values(positions, spacing, first, parameters=PARAMETERS):
+    # Parameters of consecutive revisions of field files, a (revisions x markers x 3) array in which the
+    # revisions of a field file follow each other oldest first and first marks the first revision of each.
+    # A parameter is only computed again in a revision that changed one of the markers it depends on,
+    # otherwise it keeps the value of the previous revision. Revisions that need the same parameters are
+    # computed together by the batch metrics. Returns the columns, the changed markers and the number
+    # of parameter evaluations.
+    changed = _changed_markers(positions, first)
+    dependencies = np.array([[marker in NODES[name].markers for marker in MARKERS] for name in parameters])
+    dirty = (changed.astype(np.uint8) @ dependencies.T.astype(np.uint8)) > 0
+
+    values = np.full((len(positions), len(parameters)), np.nan)
+    patterns, groups = np.unique(dirty, axis=0, return_inverse=True)
+    for index, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        rows = np.flatnonzero(groups.ravel() == index)
+        names = [name for name, needed in zip(parameters, pattern) if needed]
+        columns = MetricEvaluation(positions[rows], spacing[rows]).compute(names)
+        for name in names:
+            values[rows, parameters.index(name)] = columns[name]
+
+    # Carry the values forward from the last revision they were computed for, every first revision is
+    # computed so this never crosses into the previous field file
+    source = np.maximum.accumulate(np.where(dirty, np.arange(len(positions))[:, np.newaxis], 0), axis=0)
+    values = np.take_along_axis(values, source, axis=0)
+    return {name: values[:, index] for index, name in enumerate(parameters)}, changed, int(dirty.sum())
+
+
+def revision_history(files, parameters=PARAMETERS):
+    # History rows of (row, revisions, spacing) field files as HistoryCollector keeps them, row has the
+    # label, id and user of the task the field file belongs to, without user the rater of every revision
+    # is used. Every revision is compared with the previous revision of its file.
+    files = sorted((x for x in files if x[1]), key=lambda x: (x[0]['id'], x[0].get('user') or ''))
+    count = sum(len(revisions) for _, revisions, _ in files)
+    positions = np.full((count, len(MARKERS), 3), np.nan)
+    spacing = np.full((count, 3), VOXEL_SIZE)
+    first = np.zeros(count, dtype=bool)
+    index = 0
+    for _, revisions, file_spacing in files:
+        first[index] = True
+        if file_spacing is not None:
+            spacing[index:index + len(revisions)] = file_spacing
+        for _, field_data in revisions:
+            pack_markers(field_data, out=positions[index])
+            index += 1
+
+    columns, changed, evaluations = revision_values(positions, spacing, first, parameters)
+    logger.info('Revision history: %d field files, %d revisions, %d of %d parameters computed', len(files),
+                count, evaluations, count * len(parameters))
+
+    previous = np.roll(np.arange(count), 1)
+    shift = np.linalg.norm((positions - positions[previous]) * spacing[:, np.newaxis], axis=2)
+    shift[first] = np.nan
+    deltas = {name: np.where(first, np.nan, values - values[previous]) for name, values in columns.items()}
+
+    def value(x):
+        x = float(x)
+        return None if math.isnan(x) else x
+
+    index = 0
+    for row, revisions, _ in files:
+        previous_revision = None
+        for revision, field_data in revisions:
+            rater = (field_data.get('__raters__') or [{}])[-1]
+            result = {'label': row.get('label'), 'id': row['id'], 'user': row.get('user') or rater.get('username'),
+                      'timestamp': rater.get('timestamp'), 'revision': revision,
+                      'previous_revision': previous_revision,
+                      'changed': None if first[index] else
+                      ';'.join(x for x, moved in zip(MARKERS, changed[index]) if moved)}
+            for name in parameters:
+                result[name] = value(columns[name][index])
+                result[f'{name}_delta'] = value(deltas[name][index])
+            for marker in MARKERS:
+                result[f'{marker}_shift'] = value(shift[index, MARKER_INDEX[marker]])
+            yield result
+            previous_revision = revision
+            index += 1
+
+
+def history_files(paths):
+    # (row, revisions, None) field files from exported revisions, files whose names only differ in their
+    # timestamp are revisions of the same field file, the id is that name without the timestamp
+    from field_file_json import load_field_file
+    from knee_marker_offline import find_field_files
+
+    files = {}
+    for path in find_field_files(paths):
+        name = os.path.splitext(os.path.basename(path))[0]
+        match = REVISION_PATTERN.search(name)
+        revision = match.group(1).replace('_', ':') if match else None
+        key = os.path.join(os.path.dirname(path), REVISION_PATTERN.sub('', name, count=1))
+        try:
+            data = load_field_file(path)
+        except (OSError, ValueError) as exception:
+            logger.warning('Could not read %s: %s', path, exception)
+            continue
+        files.setdefault(key, []).append((revision, data))
+
+    for key, revisions in sorted(files.items()):
+        # Like select_revisions, a file without timestamp comes before the timestamped revisions
+        revisions.sort(key=lambda x: x[0] or '')
+        yield {'id': os.path.basename(key)}, revisions, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parameters of every revision of exported field files and how '
+                                                 'they changed between revisions, get_knee_parameters --history '
+                                                 'does the same for the field files on XNAT')
+    parser.add_argument('paths', nargs='+', help='directories, globs or JSON files with revisions of field files, '
+                                                 'e.g. knee_marker_2021-01-01T10:00:00.json')
+    parser.add_argument('--output', default='./knee_history.csv',
+                        help='output file, the format follows the extension: .xlsx, .csv, .parquet or .arrow '
+                             '(default: ./knee_history.csv)')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='show progress')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=max(logging.WARNING - 10 * args.verbose, logging.DEBUG),
+                        format='[%(levelname)s] %(name)s: %(message)s')
+
+    with open_writer(args.output, HISTORY_FIELDNAMES, numeric=HISTORY_NUMERIC) as writer:
+        writer.write_rows(revision_history(list(history_files(args.paths))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'knee_marker4.yaml')
+
+
+@lru_cache(maxsize=None)
+def load_marker_names(template=TEMPLATE):
+    # Marker names in the order of qa_fields.markers.markers in the template, this fixes the row of
+    # every marker in the packed arrays and its bit in the presence mask
+    import yaml
+
+    with open(template) as template_file:
+        config = yaml.safe_load(template_file)
+
+    return tuple(x['name'] for x in config['qa_fields']['markers']['markers'])
+
+
+# The markers of TEMPLATE as load_marker_names returns them, spelled out so the analysis does not need
+# yaml or the template file. tests/test_knee_marker_layout.py checks that they match knee_marker4.yaml.
+MARKERS = tuple(f'{name}_{side}' for side in ('R', 'L') for name in (
+    'Sup_Pat', 'Inf_Pat', 'Inf_Art_Pat', 'Sup_Tib', 'Sup_Ant_Tib', 'Lat_Pat', 'Med_Pat', 'Ant_Pat', 'Pos_Pat',
+    'Sulc', 'Med_Ant_Cond', 'Lat_Ant_Cond', 'Lat_Pos_Cond', 'Med_Pos_Cond', 'Tub_Tib',
+))
+MARKER_INDEX = {name: index for index, name in enumerate(MARKERS)}
+MARKER_BITS = {name: 1 << index for index, name in enumerate(MARKERS)}
+ALL_MARKERS = (1 << len(MARKERS)) - 1
+
+
+def marker_mask(*names):
+    # Presence mask with the bits of the given markers set
+    mask = 0
+    for name in names:
+        mask |= MARKER_BITS[name]
+    return mask
+
+
+def has_markers(mask, required):
+    # True if all markers of the required mask are present in mask
+    return mask & required == required
+
+
+def missing_markers(mask, required=ALL_MARKERS):
+    return [name for name in MARKERS if required & MARKER_BITS[name] and not mask & MARKER_BITS[name]]
+
+
+def pack_markers(data, out=None):
+    # Pack the markers of a single session in a contiguous (markers x 3) float64 array, NaN for
+    # markers that were not placed, together with a presence mask
+    positions = np.full((len(MARKERS), 3), np.nan) if out is None else out
+    mask = 0
+    for marker in data['markers']:
+        index = MARKER_INDEX.get(marker['name'])
+        if index is None:
+            continue
+        positions[index] = marker['pos'][:3]
+        mask |= 1 << index
+    return positions, mask
+
+
+def pack_sessions(sessions):
+    # Pack many sessions in one (sessions x markers x 3) array and a presence mask per session
+    positions = np.full((len(sessions), len(MARKERS), 3), np.nan)
+    masks = np.zeros(len(sessions), dtype=np.uint64)
+    for row, data in enumerate(sessions):
+        _, masks[row] = pack_markers(data, out=positions[row])
+    return positions, masks
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from field_file_json import load_field_file
+from knee_marker_batch import PARAMETERS, VOXEL_SIZE, knee_marker_batch_analysis
+from knee_marker_layout import MARKERS, pack_markers
+from knee_marker_screening import describe, screen_markers
+from knee_output import open_writer
+
+
+logger = logging.getLogger(__name__)
+
+# Columns of the rows written for local field files, error is empty unless the file could not be analysed
+# and screening lists why knee_marker_screening considers the markers implausible
+OFFLINE_FIELDNAMES = ['file', 'id', 'user', 'timestamp', 'error', 'screening'] + list(PARAMETERS)
+
+
+def find_field_files(patterns):
+    # Exported field files, patterns are directories (searched recursively for JSON files), globs or files
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, directories, files in os.walk(pattern):
+                directories.sort()
+                for filename in sorted(files):
+                    if filename.lower().endswith('.json'):
+                        yield os.path.join(root, filename)
+        else:
+            yield from sorted(glob.glob(pattern, recursive=True))
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def file_row(path):
+    # Row of a field file without results yet, the id is the file name without extension
+    return {'file': path, 'id': os.path.splitext(os.path.basename(path))[0]}
+
+
+def analyse_files(paths, skip_flagged=False, spacing=None):
+    # Analyse a chunk of field files in one batch. Runs in the worker processes, a file that cannot be
+    # read or packed gets an error row and does not affect the rest of the chunk. Sessions are screened
+    # first, with skip_flagged the parameters of implausible sessions are left empty. spacing maps the
+    # id of a session to the voxel spacing of its scan, as kept by scan_spacing.ScanSpacingCache.
+    rows = []
+    positions = np.full((len(paths), len(MARKERS), 3), np.nan)
+    voxel_spacing = np.full((len(paths), 3), VOXEL_SIZE)
+    for index, path in enumerate(paths):
+        row = file_row(path)
+        try:
+            data = load_field_file(path)
+            pack_markers(data, out=positions[index])
+            rater = (data.get('__raters__') or [{}])[-1]
+            row['user'] = rater.get('username')
+            row['timestamp'] = rater.get('timestamp')
+        except (OSError, ValueError, KeyError, TypeError, IndexError, AttributeError) as exception:
+            positions[index] = np.nan
+            row['error'] = f'{type(exception).__name__}: {exception}'
+        if spacing and spacing.get(row['id']):
+            voxel_spacing[index] = spacing[row['id']]
+        rows.append(row)
+
+    flags = screen_markers(positions)
+    columns = knee_marker_batch_analysis(positions, spacing=voxel_spacing)
+    for index, row in enumerate(rows):
+        if 'error' in row:
+            continue
+        row['screening'] = ';'.join(describe(flags[index]))
+        if skip_flagged and flags[index]:
+            continue
+        # Missing metrics are empty, like the None values of knee_marker_analysis
+        for name in PARAMETERS:
+            value = float(columns[name][index])
+            row[name] = None if math.isnan(value) else value
+    return rows
+
+
+def analyse_archive(paths, workers=None, chunk_size=256, skip_flagged=False, spacing=None):
+    # Rows for all paths in order. Chunks are analysed by a process pool, at most two chunks per
+    # worker are in flight so results can be written while the rest is analysed.
+    chunks = chunked(paths, chunk_size)
+    if workers == 1:
+        for chunk in chunks:
+            yield from analyse_files(chunk, skip_flagged, spacing)
+        return
+
+    window = 2 * (workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(analyse_files, chunk, skip_flagged, spacing))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyse exported knee marker field files on disk')
+    parser.add_argument('paths', nargs='+', help='directories, globs or JSON files with field data')
+    parser.add_argument('--output', default='./knee_offline.csv', help='Output file (default: ./knee_offline.csv)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='number of files every worker analyses at once (default: 256)')
+    parser.add_argument('--skip-flagged', action='store_true',
+                        help='do not compute the parameters of sessions the plausibility screening flags')
+    parser.add_argument('--spacing', metavar='FILE',
+                        help='voxel spacing of the scans as kept by get_knee_parameters --spacing-cache, '
+                             'sessions not in FILE are assumed to have 0.7 mm voxels')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='show progress, twice for debug output')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=max(logging.WARNING - 10 * args.verbose, logging.DEBUG),
+                        format='[%(levelname)s] %(name)s: %(message)s')
+
+    spacing = None
+    if args.spacing:
+        with open(args.spacing) as spacing_file:
+            spacing = json.load(spacing_file)
+
+    analysed, errors, flagged = 0, 0, 0
+    with open_writer(args.output, OFFLINE_FIELDNAMES) as writer:
+        for row in analyse_archive(find_field_files(args.paths), args.workers, args.chunk_size, args.skip_flagged,
+                                   spacing):
+            writer.write_row(row)
+            analysed += 1
+            if 'error' in row:
+                errors += 1
+                logger.warning('Could not analyse %s: %s', row['file'], row['error'])
+            if row.get('screening'):
+                flagged += 1
+                logger.info('Implausible markers in %s: %s', row['file'], row['screening'])
+            if analysed % 10000 == 0:
+                logger.info('Analysed %d files', analysed)
+
+    logger.info('Analysed %d files, %d errors, %d flagged, written to %s', analysed, errors, flagged, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+from functools import lru_cache
+
+import numpy as np
+
+from knee_marker_layout import MARKER_INDEX
+
+
+# Reasons a session is flagged, every reason is a bit of the flags returned by screen_markers
+REASONS = {
+    'coincident': 1 << 0,  # two landmarks that span a line or vector are at the same position
+    'degenerate_projection': 1 << 1,  # a line used for a projection or ratio has no length in its plane
+    'collinear': 1 << 2,  # the sulcus lies on a condylar line, or the bisect offset lines do not intersect
+    'arccos_domain': 1 << 3,  # the cosine of an angle is outside [-1, 1], arccos would return NaN
+    'out_of_range': 1 << 4,  # a coordinate is infinite, negative or outside the scan
+    'sides_swapped': 1 << 5,  # the right and left knee are on the other side than in the rest of the cohort
+    'medial_lateral_swapped': 1 << 6,  # medial and lateral landmarks of a knee are swapped
+}
+
+# Landmarks that span a line or vector in knee_marker_analysis
+PAIRS = [
+    ('Med_Pos_Cond', 'Lat_Pos_Cond'), ('Med_Ant_Cond', 'Lat_Ant_Cond'), ('Med_Pat', 'Lat_Pat'),
+    ('Ant_Pat', 'Pos_Pat'), ('Pos_Pat', 'Lat_Pat'), ('Sup_Pat', 'Inf_Pat'), ('Sup_Pat', 'Inf_Art_Pat'),
+    ('Inf_Pat', 'Tub_Tib'), ('Lat_Ant_Cond', 'Sulc'), ('Med_Ant_Cond', 'Sulc'),
+]
+
+# Lines that are projected on or divided by, with the coordinates of the plane they are used in
+PROJECTIONS = [
+    ('Med_Pos_Cond', 'Lat_Pos_Cond', slice(0, 2)), ('Med_Ant_Cond', 'Lat_Ant_Cond', slice(0, 2)),
+    ('Ant_Pat', 'Pos_Pat', slice(0, 2)), ('Sup_Pat', 'Inf_Pat', slice(1, 3)),
+    ('Sup_Pat', 'Inf_Art_Pat', slice(1, 3)),
+]
+
+# Vector pairs whose angle is reported, as (start, end) landmarks of both vectors
+ANGLES = [
+    (('Lat_Pos_Cond', 'Med_Pos_Cond'), ('Lat_Pat', 'Med_Pat')),
+    (('Lat_Pat', 'Pos_Pat'), ('Lat_Ant_Cond', 'Med_Ant_Cond')),
+    (('Sulc', 'Lat_Ant_Cond'), ('Sulc', 'Med_Ant_Cond')),
+    (('Sulc', 'Lat_Ant_Cond'), ('Med_Pos_Cond', 'Lat_Pos_Cond')),
+    (('Sulc', 'Med_Ant_Cond'), ('Med_Pos_Cond', 'Lat_Pos_Cond')),
+    (('Lat_Ant_Cond', 'Med_Ant_Cond'), ('Lat_Pos_Cond', 'Med_Pos_Cond')),
+]
+
+# Medial and lateral landmarks whose order along x tells the orientation of a knee
+MEDIAL_LATERAL = [('Med_Pos_Cond', 'Lat_Pos_Cond'), ('Med_Ant_Cond', 'Lat_Ant_Cond'), ('Med_Pat', 'Lat_Pat')]
+
+
+def describe(flags):
+    # Names of the reasons set in the flags of one session
+    return [name for name, bit in REASONS.items() if flags & bit]
+
+
+def _indices(names):
+    # Rows of the given landmarks of both knees, as a (landmarks x sides) index array
+    return _index_array(tuple(names))
+
+
+@lru_cache(maxsize=None)
+def _index_array(names):
+    # Cached, screening a single marker set in the analysis service would otherwise spend a tenth
+    # of its time building these. The arrays are shared and must not be modified.
+    return np.array([[MARKER_INDEX[f'{name}_{side}'] for side in ('R', 'L')] for name in names])
+
+
+def _length(vectors):
+    return np.sqrt(vectors[..., 0] ** 2 + vectors[..., 1] ** 2 + vectors[..., 2] ** 2) if vectors.shape[-1] == 3 \
+        else np.sqrt(vectors[..., 0] ** 2 + vectors[..., 1] ** 2)
+
+
+def _opposite(values, reference):
+    # Sessions where values have the opposite sign of the reference, or of the majority of the cohort
+    sign = np.sign(np.nan_to_num(values))
+    if reference is None:
+        reference = np.sign(sign.sum())
+    return sign * reference < 0
+
+
+def _nanmean(values, axis):
+    present = ~np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        return np.where(present, values, 0).sum(axis=axis) / present.sum(axis=axis)
+
+
+def screen_markers(positions, extent=None, min_distance=1.0, max_angle=1.0, orientation=None):
+    # Flags of every session of a (sessions x markers x 3) array as made by pack_sessions, 0 for a
+    # plausible marker set. Missing markers are not flagged, the analysis already skips the metrics
+    # that need them. Distances are in voxels, extent is the (x, y, z) size of the scans and max_angle
+    # is in degrees. The side and medial/lateral checks compare every session with the majority of the
+    # cohort, or with orientation: a dict with the expected sign of x(L) - x(R) under 'sides' and of
+    # x(Lat) - x(Med) per side under 'R' and 'L'.
+    positions = np.asarray(positions, dtype=np.float64)
+    if positions.ndim == 2:
+        positions = positions[np.newaxis]
+    orientation = orientation or {}
+    sessions = len(positions)
+    flags = np.zeros(sessions, dtype=np.uint32)
+    min_sin = np.sin(np.radians(max_angle))
+
+    # Landmark-major copy, gathering landmarks then only copies contiguous blocks
+    markers = np.ascontiguousarray(positions.transpose(1, 0, 2))
+
+    def flag(reason, condition):
+        # Comparisons with NaN are False, so sessions with missing landmarks are not flagged
+        flags[condition.reshape(-1, sessions).any(axis=0)] |= REASONS[reason]
+
+    def m(name):
+        # (sides x sessions x 3) positions of a landmark
+        return markers[_indices([name])[0]]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out_of_range = np.isinf(markers) | (markers < 0)
+        if extent is not None:
+            out_of_range |= markers >= np.asarray(extent, dtype=np.float64)
+        flag('out_of_range', out_of_range.any(axis=-1))
+
+        a, b = (_indices(x) for x in zip(*PAIRS))
+        flag('coincident', _length(markers[a] - markers[b]) < min_distance)
+
+        for plane in (slice(0, 2), slice(1, 3)):
+            a, b = (_indices(x) for x in zip(*[(a, b) for a, b, p in PROJECTIONS if p == plane]))
+            flag('degenerate_projection', _length((markers[a] - markers[b])[..., plane]) < min_distance)
+
+        # Sulcus on the anterior condylar line: the sulcus angle is 180 degrees and there is no trochlear depth
+        facet_l, facet_m = m('Lat_Ant_Cond') - m('Sulc'), m('Med_Ant_Cond') - m('Sulc')
+        flag('collinear', _length(np.cross(facet_l, facet_m)) < min_sin * _length(facet_l) * _length(facet_m))
+
+        # Bisect offset intersects the line from the sulcus to its projection on the posterior condylar
+        # line with the patellar width line, in the axial plane
+        pcl = (m('Lat_Pos_Cond') - m('Med_Pos_Cond'))[..., :2]
+        sulc = (m('Sulc') - m('Lat_Pos_Cond'))[..., :2]
+        scale = (sulc * pcl).sum(axis=-1) / (pcl * pcl).sum(axis=-1)
+        normal = sulc - pcl * scale[..., None]
+        width = (m('Lat_Pat') - m('Med_Pat'))[..., :2]
+        flag('collinear', _length(normal) < min_distance)
+        flag('collinear', np.abs(normal[..., 0] * width[..., 1] - normal[..., 1] * width[..., 0])
+             < min_sin * _length(normal) * _length(width))
+
+        (a0, a1), (b0, b1) = ((_indices(x) for x in zip(*vectors)) for vectors in zip(*ANGLES))
+        u, v = markers[a1] - markers[a0], markers[b1] - markers[b0]
+        u /= _length(u)[..., None]
+        v /= _length(v)[..., None]
+        flag('arccos_domain', np.abs((u * v).sum(axis=-1)) > 1)
+
+        med, lat = (_indices(x) for x in zip(*MEDIAL_LATERAL))
+        lateral = _nanmean(markers[lat, :, 0] - markers[med, :, 0], axis=0)
+        for index, side in enumerate(('R', 'L')):
+            flag('medial_lateral_swapped', _opposite(lateral[index], orientation.get(side)))
+
+        centres = _nanmean(markers[_indices([x.rsplit('_', 1)[0] for x in MARKER_INDEX if x.endswith('_R')]), :, 0],
+                           axis=0)
+        flag('sides_swapped', _opposite(centres[1] - centres[0], orientation.get('sides')))
+
+    return flags
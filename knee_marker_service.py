@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import math
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from knee_marker_analysis import knee_marker_analysis
+from knee_marker_batch import PARAMETERS, knee_marker_batch_analysis
+from knee_marker_layout import ALL_MARKERS, MARKERS, missing_markers, pack_markers
+from knee_marker_screening import describe, screen_markers
+
+
+logger = logging.getLogger(__name__)
+
+# Largest request body that is read, a full marker set is a few kB
+MAX_BODY = 1024 * 1024
+
+
+class RequestError(ValueError):
+    pass
+
+
+def analyse_markers(payload, orientation=None):
+    # Parameters and plausibility flags of one marker set. payload is a dict with the markers of a
+    # field file under 'markers' and optionally the (x, y, z) voxel spacing of the scan under 'spacing'
+    # and its size in voxels under 'extent'.
+    if not isinstance(payload, dict) or not isinstance(payload.get('markers'), list):
+        raise RequestError('expected a JSON object with a list of markers')
+    try:
+        positions, mask = pack_markers(payload)
+    except (KeyError, TypeError, ValueError, IndexError) as exception:
+        raise RequestError(f'invalid marker: {exception}')
+
+    spacing = payload.get('spacing')
+    if spacing is not None and (not isinstance(spacing, list) or len(spacing) != 3
+                                or not all(isinstance(x, (int, float)) and 0 < x < math.inf for x in spacing)):
+        raise RequestError('spacing should be a list of three positive numbers')
+
+    # Degenerate geometry, like two markers on the same spot while they are being placed, can make the
+    # analysis fail as a whole. The batch metrics give NaN or inf for only the parameters it affects, so
+    # flagged marker sets and the ones the screening misses but the analysis cannot handle go there.
+    flags = int(screen_markers(positions, extent=payload.get('extent'), orientation=orientation)[0])
+    values = None
+    if not flags:
+        try:
+            values = knee_marker_analysis(payload, spacing)
+        except ArithmeticError:
+            pass
+    if values is None:
+        columns = knee_marker_batch_analysis(positions, spacing=spacing)
+        values = [columns[name][0] for name in PARAMETERS]
+    return {
+        # NaN is not valid JSON, a parameter that cannot be computed is null like a missing one
+        'parameters': {name: None if value is None or not math.isfinite(value) else float(value)
+                       for name, value in zip(PARAMETERS, values)},
+        'flags': flags,
+        'screening': describe(flags),
+        'missing': missing_markers(mask, ALL_MARKERS),
+    }
+
+
+class AnalysisServer:
+    # Long-running HTTP/JSON service around knee_marker_analysis, so the viewer gets the parameters
+    # of a marker set without starting Python and importing the analysis for every request:
+    #   POST /analyse with a marker set as analyse_markers takes it, returns its result
+    #   GET /health
+    # Requests are handled by a thread each on keep-alive connections. A process analyses one marker set
+    # at a time, about 1000 a second on one core, so its p99 stays below 5 ms for up to two clients that
+    # send their requests back to back. A viewer sends one per placed marker; for more concurrent clients
+    # serve with a process per core.
+
+    def __init__(self, host='127.0.0.1', port=8765, orientation=None):
+        self.orientation = orientation
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are sent separately, without this every keep-alive request waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                logger.info(format, *args)
+
+            def send_json(self, status, body):
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                # The viewer runs in a browser on another origin
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_OPTIONS(self):
+                self.send_response(204)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+                self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path != '/health':
+                    self.send_json(404, {'error': f'unknown path {self.path}'})
+                    return
+                self.send_json(200, {'status': 'ok', 'requests': server.requests, 'markers': len(MARKERS),
+                                     'parameters': len(PARAMETERS)})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > MAX_BODY:
+                    self.close_connection = True
+                    self.send_json(413, {'error': f'request body larger than {MAX_BODY} bytes'})
+                    return
+                body = self.rfile.read(length)
+                if self.path != '/analyse':
+                    self.send_json(404, {'error': f'unknown path {self.path}'})
+                    return
+
+                try:
+                    result = server.analyse(json.loads(body))
+                except (ValueError, TypeError) as exception:
+                    self.send_json(400, {'error': str(exception)})
+                    return
+                except Exception:
+                    # The viewer gets an answer instead of a dropped connection
+                    logger.exception('Analysis of %s failed', body[:200])
+                    self.send_json(500, {'error': 'the analysis of the markers failed'})
+                    return
+                self.send_json(200, result)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def analyse(self, payload):
+        with self._lock:
+            self.requests += 1
+        return analyse_markers(payload, self.orientation)
+
+    def warm_up(self):
+        # Run the whole analysis once, so the first request from the viewer is as fast as the rest
+        from knee_marker_synthetic import generate_sessions
+
+        analyse_markers(generate_sessions(1)[0])
+
+    def serve_forever(self, processes=1):
+        # Serve until interrupted. With more than one process, forked copies of the service accept
+        # requests on the same socket, so concurrent requests are analysed in parallel despite the GIL.
+        children = []
+        for _ in range(processes - 1):
+            pid = os.fork()
+            if pid == 0:
+                children = None
+                break
+            children.append(pid)
+
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpd.server_close()
+            for pid in children or []:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the knee parameters of marker sets over HTTP for live '
+                                                 'feedback in the viewer')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on, 0 for any (default: 8765)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes serving requests, more than one needs fork (default: 1)')
+    parser.add_argument('--orientation', type=json.loads,
+                        help='expected orientation of the knees for the side checks of the screening, as JSON, '
+                             'e.g. {"sides": 1, "R": 1, "L": -1}; a single marker set has no cohort to compare with')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='show requests')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=max(logging.WARNING - 10 * args.verbose, logging.DEBUG),
+                        format='[%(levelname)s] %(name)s: %(message)s')
+
+    server = AnalysisServer(args.host, args.port, args.orientation)
+    server.warm_up()
+    # Printed so scripts that start the service on port 0 can find it
+    print(f'Serving on {server.url}', flush=True)
+    # SIGTERM stops the service like Ctrl-C, so the forked processes are stopped with it
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server.serve_forever(args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import logging
+import math
+import threading
+
+import numpy as np
+
+from knee_marker_batch import PARAMETERS, VOXEL_SIZE, knee_marker_batch_analysis
+from knee_marker_layout import MARKERS, pack_markers
+from knee_marker_screening import describe, screen_markers
+from knee_output import FIELDNAMES, open_writer
+
+
+logger = logging.getLogger(__name__)
+
+# One record per session: the metadata of the result row, the packed markers and presence mask as made
+# by pack_markers and the voxel spacing of the scan, NaN when it was not known. Records are sorted by
+# id, user and timestamp, so the sessions of an experiment are one contiguous slice.
+SNAPSHOT_DTYPE = np.dtype([
+    ('id', 'U64'),
+    ('label', 'U64'),
+    ('user', 'U32'),
+    ('timestamp', 'U32'),
+    ('positions', np.float64, (len(MARKERS), 3)),
+    ('mask', np.uint64),
+    ('spacing', np.float64, (3,)),
+])
+
+SNAPSHOT_FIELDNAMES = FIELDNAMES + ['screening']
+
+
+class SnapshotCollector:
+    # Collects the sessions of a harvest for write_snapshot, add is called from the worker threads
+
+    def __init__(self):
+        self.sessions = []
+        self._lock = threading.Lock()
+
+    def add(self, row, field_data, spacing=None):
+        with self._lock:
+            self.sessions.append((row, field_data, spacing))
+
+
+def write_snapshot(path, sessions):
+    # Write (row, field data, spacing) sessions to a .npy file that load_snapshot can memory-map. A
+    # later session with the same id, user and timestamp replaces an earlier one.
+    latest = {}
+    for row, field_data, spacing in sessions:
+        latest[(row['id'], row['user'], row['timestamp'] or '')] = (row, field_data, spacing)
+
+    snapshot = np.lib.format.open_memmap(path, mode='w+', dtype=SNAPSHOT_DTYPE, shape=(len(latest),))
+    for index, key in enumerate(sorted(latest)):
+        row, field_data, spacing = latest[key]
+        record = snapshot[index]
+        record['id'], record['user'], record['timestamp'] = key
+        record['label'] = row.get('label') or ''
+        record['positions'] = np.nan
+        _, record['mask'] = pack_markers(field_data, out=record['positions'])
+        record['spacing'] = np.nan if spacing is None else spacing
+    snapshot.flush()
+    logger.info('Wrote %d sessions to %s', len(snapshot), path)
+    return len(snapshot)
+
+
+def load_snapshot(path):
+    # The records of a snapshot, memory-mapped read-only: slicing and selecting columns do not copy
+    return np.load(path, mmap_mode='r')
+
+
+def experiment(snapshot, experiment_id):
+    # All sessions of an experiment, a view on the snapshot found by bisection on the sorted ids
+    start = np.searchsorted(snapshot['id'], experiment_id, side='left')
+    stop = np.searchsorted(snapshot['id'], experiment_id, side='right')
+    return snapshot[start:stop]
+
+
+def analyse_snapshot(snapshot, parameters=PARAMETERS, chunk_size=65536):
+    # Result rows of every session in a snapshot, like get_knee_parameters writes them plus the
+    # screening of knee_marker_screening. The snapshot is analysed in chunks with the batch metrics.
+    for start in range(0, len(snapshot), chunk_size):
+        chunk = snapshot[start:start + chunk_size]
+        positions = chunk['positions']
+        spacing = chunk['spacing']
+        spacing = np.where(np.isnan(spacing), VOXEL_SIZE, spacing)
+        flags = screen_markers(positions)
+        columns = knee_marker_batch_analysis(positions, parameters, spacing=spacing)
+        for index, record in enumerate(chunk):
+            row = {'label': str(record['label']), 'id': str(record['id']), 'user': str(record['user']),
+                   'timestamp': str(record['timestamp']) or None,
+                   'screening': ';'.join(describe(flags[index]))}
+            # Missing metrics are empty, like the None values of knee_marker_analysis
+            for name in parameters:
+                value = float(columns[name][index])
+                row[name] = None if math.isnan(value) else value
+            yield row
+
+
+def snapshot_files(paths):
+    # (row, field data, spacing) sessions of exported field files, the id is the file name
+    from field_file_json import load_field_file
+    from knee_marker_offline import file_row, find_field_files
+
+    for path in find_field_files(paths):
+        try:
+            data = load_field_file(path)
+        except (OSError, ValueError) as exception:
+            logger.warning('Could not read %s: %s', path, exception)
+            continue
+        rater = (data.get('__raters__') or [{}])[-1]
+        row = file_row(path)
+        row.update(user=rater.get('username') or '', timestamp=rater.get('timestamp'))
+        yield row, data, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot the marker coordinates of all sessions in one file, '
+                                                 'and analyse them again from that file without XNAT')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create = subparsers.add_parser('create', help='snapshot exported field files, get_knee_parameters --snapshot '
+                                                  'makes a snapshot of a harvest')
+    create.add_argument('paths', nargs='+', help='directories, globs or JSON files with field data')
+    create.add_argument('--output', default='./knee_markers.npy', help='snapshot file (default: ./knee_markers.npy)')
+
+    analyse = subparsers.add_parser('analyse', help='compute the parameters of every session in a snapshot')
+    analyse.add_argument('snapshot', help='snapshot file')
+    analyse.add_argument('--output', default='./knee_snapshot.csv',
+                         help='output file, the format follows the extension: .xlsx, .csv, .parquet or .arrow '
+                              '(default: ./knee_snapshot.csv)')
+    analyse.add_argument('--id', action='append', dest='ids', metavar='EXPERIMENT_ID',
+                         help='only analyse these experiments, can be repeated')
+
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='show progress')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=max(logging.WARNING - 10 * args.verbose, logging.DEBUG),
+                        format='[%(levelname)s] %(name)s: %(message)s')
+
+    if args.command == 'create':
+        write_snapshot(args.output, snapshot_files(args.paths))
+        return
+
+    snapshot = load_snapshot(args.snapshot)
+    if args.ids:
+        snapshot = np.concatenate([experiment(snapshot, x) for x in args.ids])
+    with open_writer(args.output, SNAPSHOT_FIELDNAMES) as writer:
+        writer.write_rows(analyse_snapshot(snapshot))
+
+
+if __name__ == '__main__':
+    main()
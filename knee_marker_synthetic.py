@@ -0,0 +1,82 @@
+import datetime
+
+import numpy as np
+
+from knee_marker_layout import MARKER_INDEX, MARKERS
+
+
+# Typical position in voxels of every landmark of the right knee, x runs from medial to lateral,
+# y from anterior to posterior and z from inferior to superior. The left knee is mirrored in x.
+TEMPLATE_R = {
+    'Sup_Pat': (152, 60, 260),
+    'Inf_Pat': (152, 70, 195),
+    'Inf_Art_Pat': (155, 78, 205),
+    'Sup_Tib': (150, 120, 160),
+    'Sup_Ant_Tib': (155, 100, 155),
+    'Lat_Pat': (180, 70, 235),
+    'Med_Pat': (125, 72, 235),
+    'Ant_Pat': (152, 55, 235),
+    'Pos_Pat': (155, 85, 235),
+    'Sulc': (150, 100, 220),
+    'Med_Ant_Cond': (120, 92, 220),
+    'Lat_Ant_Cond': (185, 88, 220),
+    'Lat_Pos_Cond': (190, 170, 215),
+    'Med_Pos_Cond': (115, 175, 215),
+    'Tub_Tib': (164, 95, 130),
+}
+
+# Width of the scan in voxels, used to mirror the right knee to the left knee
+SCAN_WIDTH = 512
+
+RATERS = ['rater1', 'rater2', 'rater3', 'rater4', 'rater5']
+
+
+def template_positions():
+    # Typical (markers x 3) positions in the order of the marker layout
+    positions = np.empty((len(MARKERS), 3))
+    for name, index in MARKER_INDEX.items():
+        base, side = name.rsplit('_', 1)
+        x, y, z = TEMPLATE_R[base]
+        positions[index] = (x if side == 'R' else SCAN_WIDTH - x, y, z)
+    return positions
+
+
+def generate_positions(count, missing_rate=0.0, sides='RL', jitter=2.0, seed=0):
+    # Synthetic (sessions x markers x 3) positions and presence masks. Every session gets its own
+    # position and size of the knee plus independent placement noise of jitter voxels per marker.
+    # Markers of sides that are not requested are missing, other markers are missing with
+    # probability missing_rate.
+    rng = np.random.default_rng(seed)
+    template = template_positions()
+    center = template.mean(axis=0)
+
+    scale = rng.normal(1.0, 0.05, size=(count, 1, 1))
+    offset = rng.normal(0.0, 10.0, size=(count, 1, 3))
+    noise = rng.normal(0.0, jitter, size=(count, len(MARKERS), 3))
+    positions = (template - center) * scale + center + offset + noise
+
+    present = rng.random((count, len(MARKERS))) >= missing_rate
+    for name, index in MARKER_INDEX.items():
+        if name.rsplit('_', 1)[1] not in sides:
+            present[:, index] = False
+    positions[~present] = np.nan
+
+    masks = (present.astype(np.uint64) << np.arange(len(MARKERS), dtype=np.uint64)).sum(axis=1, dtype=np.uint64)
+    return positions, masks
+
+
+def generate_sessions(count, missing_rate=0.0, sides='RL', jitter=2.0, seed=0):
+    # Synthetic field data in the format of the FIELDS files on XNAT
+    positions, _ = generate_positions(count, missing_rate, sides, jitter, seed)
+    start = datetime.datetime(2021, 1, 1)
+    sessions = []
+    for index, session in enumerate(positions):
+        timestamp = (start + datetime.timedelta(minutes=index)).isoformat()
+        sessions.append({
+            'markers': [
+                {'name': name, 'pos': [float(x) for x in session[marker_index]] + [0.0]}
+                for marker_index, name in enumerate(MARKERS) if not np.isnan(session[marker_index, 0])
+            ],
+            '__raters__': [{'username': RATERS[index % len(RATERS)], 'timestamp': timestamp}],
+        })
+    return sessions
@@ -0,0 +1,140 @@
+import csv
+import math
+import os
+
+from knee_marker_batch import PARAMETERS
+
+
+# Columns of the result rows written by get_knee_parameters
+FIELDNAMES = ['label', 'id', 'user', 'timestamp'] + list(PARAMETERS)
+
+# Columns holding numbers, the other columns hold text. Callers with other numeric columns than the
+# parameters pass their own to open_writer.
+NUMERIC_FIELDNAMES = frozenset(PARAMETERS)
+
+
+class OutputWriter:
+    # Base class of the output backends, rows are dicts keyed by fieldname and written one at a time
+    # so a backend never has to hold the whole result in memory
+
+    def __init__(self, filename, fieldnames=FIELDNAMES, header=None, numeric=NUMERIC_FIELDNAMES):
+        self.filename = filename
+        self.fieldnames = list(fieldnames)
+        self.header = list(header) if header is not None else self.fieldnames
+        self.numeric = frozenset(numeric)
+
+    def write_row(self, row):
+        raise NotImplementedError
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CsvWriter(OutputWriter):
+    def __init__(self, filename, fieldnames=FIELDNAMES, header=None, numeric=NUMERIC_FIELDNAMES):
+        super().__init__(filename, fieldnames, header, numeric)
+        self._file = open(filename, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.header)
+
+    def write_row(self, row):
+        self._writer.writerow([row.get(x) for x in self.fieldnames])
+
+    def close(self):
+        self._file.close()
+
+
+class XlsxWriter(OutputWriter):
+    # Uses the constant memory mode of xlsxwriter, every row is flushed to disk once the next one starts
+    def __init__(self, filename, fieldnames=FIELDNAMES, header=None, numeric=NUMERIC_FIELDNAMES):
+        super().__init__(filename, fieldnames, header, numeric)
+        import xlsxwriter
+
+        self._workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+        self._worksheet = self._workbook.add_worksheet()
+        self._worksheet.write_row(0, 0, self.header, self._workbook.add_format({'bold': True}))
+        self._row = 1
+
+    def write_row(self, row):
+        # Excel has no NaN, leave those cells empty like pandas does
+        values = [row.get(x) for x in self.fieldnames]
+        values = [None if isinstance(x, float) and math.isnan(x) else x for x in values]
+        self._worksheet.write_row(self._row, 0, values)
+        self._row += 1
+
+    def close(self):
+        self._workbook.close()
+
+
+class ArrowWriter(OutputWriter):
+    # Parquet or Arrow IPC output, rows are collected in record batches of batch_size rows
+    def __init__(self, filename, fieldnames=FIELDNAMES, header=None, numeric=NUMERIC_FIELDNAMES, batch_size=10000):
+        super().__init__(filename, fieldnames, header, numeric)
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema(
+            [(name, pyarrow.float64() if field in self.numeric else pyarrow.string())
+             for name, field in zip(self.header, self.fieldnames)]
+        )
+        if os.path.splitext(filename)[1].lower() == '.parquet':
+            self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema)
+        else:
+            self._writer = pyarrow.ipc.new_file(filename, self._schema)
+        self._batch_size = batch_size
+        self._columns = [[] for _ in self.fieldnames]
+
+    def write_row(self, row):
+        for column, field in zip(self._columns, self.fieldnames):
+            value = row.get(field)
+            column.append(str(value) if value is not None and field not in self.numeric else value)
+
+        if len(self._columns[0]) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._columns[0]) == 0:
+            return
+
+        batch = self._pyarrow.record_batch(
+            [self._pyarrow.array(x, type=field.type) for x, field in zip(self._columns, self._schema)],
+            schema=self._schema
+        )
+        self._writer.write_batch(batch)
+        self._columns = [[] for _ in self.fieldnames]
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+BACKENDS = {
+    '.csv': CsvWriter,
+    '.xlsx': XlsxWriter,
+    '.parquet': ArrowWriter,
+    '.arrow': ArrowWriter,
+    '.feather': ArrowWriter,
+}
+
+
+def open_writer(filename, fieldnames=FIELDNAMES, header=None, numeric=NUMERIC_FIELDNAMES):
+    # Select the output backend from the extension of filename, the numeric columns are typed float64
+    # in Parquet and Arrow output
+    extension = os.path.splitext(filename)[1].lower()
+    try:
+        backend = BACKENDS[extension]
+    except KeyError:
+        raise ValueError('Unsupported output format {}, use one of {}'.format(extension, ', '.join(BACKENDS)))
+
+    return backend(filename, fieldnames, header, numeric)
@@ -0,0 +1,195 @@
+import argparse
+import csv
+import itertools
+import logging
+import os
+
+import numpy as np
+
+from knee_marker_batch import PARAMETERS
+from knee_output import open_writer
+
+
+logger = logging.getLogger(__name__)
+
+# Statistics computed for every rater pair and parameter, each with a bootstrap confidence interval
+STATISTICS = ('icc', 'bias', 'loa_low', 'loa_high', 'mad')
+
+RELIABILITY_FIELDNAMES = (['rater_a', 'rater_b', 'parameter', 'sessions']
+                          + [f'{x}{suffix}' for x in STATISTICS for suffix in ('', '_ci_low', '_ci_high')])
+RELIABILITY_NUMERIC = frozenset(RELIABILITY_FIELDNAMES[3:])
+
+# Number of bootstrap resamples handled at once, bounds the memory of the sums to chunk x parameters x 6
+BOOTSTRAP_CHUNK = 1000
+
+
+def rating_matrix(rows, parameters=PARAMETERS):
+    # Ratings as a (parameters x sessions x raters) array, NaN where a rater did not rate a session or
+    # a parameter is missing. A later row for the same session and rater replaces an earlier one.
+    latest = {}
+    for row in rows:
+        latest[(row['id'], row['user'])] = row
+
+    sessions = sorted({x[0] for x in latest})
+    raters = sorted({x[1] for x in latest})
+    session_index = {x: i for i, x in enumerate(sessions)}
+    rater_index = {x: i for i, x in enumerate(raters)}
+
+    ratings = np.full((len(parameters), len(sessions), len(raters)), np.nan)
+    for (session, rater), row in latest.items():
+        values = [row.get(x) for x in parameters]
+        ratings[:, session_index[session], rater_index[rater]] = [
+            np.nan if x is None or x == '' else float(x) for x in values]
+    return sessions, raters, ratings
+
+
+def _pair_sums(counts, features):
+    # Weighted sums of the features of every parameter for every resample, a single matrix product
+    # of (resamples x sessions) counts with the (sessions x features * parameters) feature matrix
+    sums = counts @ features.reshape(-1, features.shape[-1]).T
+    return sums.reshape(counts.shape[0], *features.shape[:2])
+
+
+def _pair_statistics(sums):
+    # ICC(2,1), Bland-Altman bias and 95% limits of agreement and mean absolute difference of two raters
+    # from the weighted sums of 1, mean, mean^2, difference, difference^2 and |difference|
+    n, total, total_sq, diff, diff_sq, abs_diff = np.moveaxis(sums, -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / n
+        bias = diff / n
+        # Between sessions, between raters and residual mean squares of the two-way ANOVA with k = 2
+        ms_rows = 2 * (total_sq - n * mean ** 2) / (n - 1)
+        ms_raters = n * bias ** 2 / 2
+        ms_error = (diff_sq - n * bias ** 2) / 2 / (n - 1)
+        icc = (ms_rows - ms_error) / (ms_rows + ms_error + 2 * (ms_raters - ms_error) / n)
+
+        sd = np.sqrt((diff_sq - n * bias ** 2) / (n - 1))
+        return {'icc': icc, 'bias': bias, 'loa_low': bias - 1.96 * sd, 'loa_high': bias + 1.96 * sd,
+                'mad': abs_diff / n}
+
+
+def pair_reliability(ratings_a, ratings_b, bootstrap=2000, confidence=0.95, seed=0):
+    # Reliability of two raters for all parameters at once, ratings are (parameters x sessions) arrays.
+    # Returns the number of sessions per parameter, the statistics and their percentile bootstrap
+    # confidence intervals. A bootstrap resample of the sessions is represented by how often every
+    # session is drawn, so all resamples and parameters reduce to matrix products.
+    complete = ~(np.isnan(ratings_a) | np.isnan(ratings_b))
+    sessions = np.flatnonzero(complete.any(axis=0))
+    complete = complete[:, sessions]
+    a = np.where(complete, ratings_a[:, sessions], 0.0)
+    b = np.where(complete, ratings_b[:, sessions], 0.0)
+
+    mean = (a + b) / 2
+    difference = a - b
+    features = np.stack([complete.astype(np.float64), mean, mean ** 2, difference, difference ** 2,
+                         np.abs(difference)], axis=1)
+
+    estimates = _pair_statistics(_pair_sums(np.ones((1, len(sessions))), features)[0])
+
+    intervals = {name: (np.full(len(a), np.nan), np.full(len(a), np.nan)) for name in STATISTICS}
+    if bootstrap and len(sessions) > 1:
+        rng = np.random.default_rng(seed)
+        resampled = {name: [] for name in STATISTICS}
+        for start in range(0, bootstrap, BOOTSTRAP_CHUNK):
+            size = min(BOOTSTRAP_CHUNK, bootstrap - start)
+            counts = rng.multinomial(len(sessions), np.full(len(sessions), 1 / len(sessions)), size=size)
+            for name, values in _pair_statistics(_pair_sums(counts.astype(np.float64), features)).items():
+                resampled[name].append(values)
+
+        tail = (1 - confidence) / 2 * 100
+        for name, values in resampled.items():
+            low, high = np.nanpercentile(np.concatenate(values), [tail, 100 - tail], axis=0)
+            intervals[name] = (low, high)
+
+    return complete.sum(axis=1), estimates, intervals
+
+
+def reliability(rows, parameters=PARAMETERS, bootstrap=2000, confidence=0.95, min_sessions=2, seed=0):
+    # Reliability rows for every pair of raters with at least min_sessions sessions in common, this
+    # includes the second reads of a rater, which have their own username like wvanderheijden2
+    sessions, raters, ratings = rating_matrix(rows, parameters)
+    rated = ~np.isnan(ratings).all(axis=0)
+
+    for i, j in itertools.combinations(range(len(raters)), 2):
+        common = np.count_nonzero(rated[:, i] & rated[:, j])
+        if common < min_sessions:
+            continue
+        logger.info('Rater pair %s, %s: %d sessions', raters[i], raters[j], common)
+
+        counts, estimates, intervals = pair_reliability(ratings[:, :, i], ratings[:, :, j], bootstrap,
+                                                        confidence, seed)
+        for index, parameter in enumerate(parameters):
+            row = {'rater_a': raters[i], 'rater_b': raters[j], 'parameter': parameter,
+                   'sessions': int(counts[index])}
+            for name in STATISTICS:
+                row[name] = float(estimates[name][index])
+                row[f'{name}_ci_low'] = float(intervals[name][0][index])
+                row[f'{name}_ci_high'] = float(intervals[name][1][index])
+            yield row
+
+
+def load_results(path):
+    # Result rows from the output of get_knee_parameters (.xlsx, .csv, .parquet, .arrow), a results store
+    # directory or a marker snapshot (.npy), which is analysed again
+    if os.path.isdir(path):
+        from knee_results_store import ResultsStore
+
+        return ResultsStore(path).query(['id', 'user'] + list(PARAMETERS)).to_pylist()
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        from knee_marker_snapshot import analyse_snapshot, load_snapshot
+
+        return list(analyse_snapshot(load_snapshot(path)))
+
+    if extension == '.csv':
+        with open(path, newline='') as csv_file:
+            return list(csv.DictReader(csv_file))
+
+    if extension == '.xlsx':
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        try:
+            values = workbook.active.iter_rows(values_only=True)
+            header = next(values, ())
+            return [dict(zip(header, x)) for x in values]
+        finally:
+            workbook.close()
+
+    if extension not in ('.parquet', '.arrow', '.feather'):
+        raise ValueError('Unsupported results format {}, use .xlsx, .csv, .parquet, .arrow, .npy '
+                         'or a results store directory'.format(extension))
+
+    import pyarrow.dataset
+
+    return pyarrow.dataset.dataset(path, format='ipc' if extension in ('.arrow', '.feather') else 'parquet'
+                                   ).to_table().to_pylist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inter-rater reliability of the knee parameters')
+    parser.add_argument('results', help='results of get_knee_parameters: a .xlsx, .csv, .parquet or .arrow file, '
+                                        'a results store directory or a marker snapshot (.npy)')
+    parser.add_argument('--output', default='./knee_reliability.csv',
+                        help='Output file (default: ./knee_reliability.csv)')
+    parser.add_argument('--bootstrap', type=int, default=2000,
+                        help='number of bootstrap resamples, 0 to skip the confidence intervals (default: 2000)')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level (default: 0.95)')
+    parser.add_argument('--min-sessions', type=int, default=2,
+                        help='minimum number of sessions two raters have in common (default: 2)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the bootstrap (default: 0)')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='show the rater pairs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=max(logging.WARNING - 10 * args.verbose, logging.DEBUG),
+                        format='[%(levelname)s] %(name)s: %(message)s')
+
+    rows = load_results(args.results)
+    with open_writer(args.output, RELIABILITY_FIELDNAMES, numeric=RELIABILITY_NUMERIC) as writer:
+        writer.write_rows(reliability(rows, bootstrap=args.bootstrap, confidence=args.confidence,
+                                      min_sessions=args.min_sessions, seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import datetime
+import hashlib
+import os
+import time
+import uuid
+
+from knee_marker_batch import PARAMETERS
+from knee_output import FIELDNAMES
+
+
+# A result is identified by the session, the rater and the timestamp of the field file it was computed from
+KEY = ('id', 'user', 'timestamp')
+
+# Partitions of the store, every harvest run appends files to user=<rater>/run_date=<date>
+PARTITIONS = ('user', 'run_date')
+
+
+class ResultsStore:
+    # Append-only history of result rows in a directory of Parquet files, partitioned by rater and run
+    # date. Rows are never rewritten, an upsert appends a newer version of a row and queries return
+    # the most recently written version of every key. Rows whose values did not change since they
+    # were last stored are not appended again, so repeated harvests do not grow the store.
+
+    def __init__(self, directory):
+        # pyarrow is only needed when a store is used
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+
+        self.directory = directory
+        # Digests of the stored rows, read once and kept up to date by append
+        self._stored = None
+        self._pyarrow = pyarrow
+        self._compute = pyarrow.compute
+        self._dataset = pyarrow.dataset
+        os.makedirs(directory, exist_ok=True)
+
+        self.schema = pyarrow.schema(
+            [(name, pyarrow.float64() if name in PARAMETERS else pyarrow.string()) for name in FIELDNAMES]
+            + [('digest', pyarrow.string()), ('written_at', pyarrow.int64()), ('run_date', pyarrow.string())]
+        )
+        self.partitioning = pyarrow.dataset.partitioning(
+            pyarrow.schema([self.schema.field(x) for x in PARTITIONS]), flavor='hive')
+
+    @staticmethod
+    def digest(row):
+        # Fingerprint of the values of a row, to find rows that changed since they were stored. Parameters
+        # are hashed as plain floats, np.float64 has another repr than the float read back from a checkpoint
+        values = [row.get(x) for x in FIELDNAMES]
+        values = [float(value) if name in PARAMETERS and value is not None else value
+                  for name, value in zip(FIELDNAMES, values)]
+        values = repr(values).encode()
+        return hashlib.sha1(values).hexdigest()
+
+    def dataset(self):
+        return self._dataset.dataset(self.directory, schema=self.schema, format='parquet',
+                                     partitioning=self.partitioning)
+
+    def latest(self, table, versions=None):
+        # Keep the most recently written version of every key, versions is a table with the key and
+        # written_at of all versions when table only holds some of them
+        if table.num_rows == 0:
+            return table
+        versions = table if versions is None else versions
+        newest = {}
+        for key, written_at in zip(zip(*[versions.column(x).to_pylist() for x in KEY]),
+                                   versions.column('written_at').to_pylist()):
+            if written_at > newest.get(key, -1):
+                newest[key] = written_at
+
+        keys = zip(*[table.column(x).to_pylist() for x in KEY])
+        latest = {}
+        for index, (key, written_at) in enumerate(zip(keys, table.column('written_at').to_pylist())):
+            if written_at == newest[key]:
+                latest[key] = index
+        return table.take(sorted(latest.values()))
+
+    def stored_digests(self):
+        table = self.latest(self.dataset().to_table(columns=list(KEY) + ['digest', 'written_at']))
+        keys = zip(*[table.column(x).to_pylist() for x in KEY])
+        return dict(zip(keys, table.column('digest').to_pylist()))
+
+    def append(self, rows, run_date=None):
+        # Upsert rows, returns the number of rows that were new or changed and therefore written. The
+        # stored digests are only read by the first append, so appending in batches stays linear.
+        if self._stored is None:
+            self._stored = self.stored_digests()
+        stored = {}
+        written_at = time.time_ns()
+        run_date = run_date or datetime.date.today().isoformat()
+
+        columns = {name: [] for name in self.schema.names}
+        for row in rows:
+            digest = self.digest(row)
+            key = tuple(row.get(x) for x in KEY)
+            if stored.get(key, self._stored.get(key)) == digest:
+                continue
+            stored[key] = digest
+            for name in FIELDNAMES:
+                value = row.get(name)
+                columns[name].append(str(value) if value is not None and name not in PARAMETERS else value)
+            columns['digest'].append(digest)
+            columns['written_at'].append(written_at)
+            columns['run_date'].append(run_date)
+
+        count = len(columns['digest'])
+        if count == 0:
+            return 0
+
+        table = self._pyarrow.table(columns, schema=self.schema)
+        self._dataset.write_dataset(table, self.directory, format='parquet', partitioning=self.partitioning,
+                                    basename_template=f'part-{written_at}-{uuid.uuid4().hex[:8]}-{{i}}.parquet',
+                                    existing_data_behavior='overwrite_or_ignore')
+        self._stored.update(stored)
+        return count
+
+    def query(self, columns=None, user=None, since=None, filter=None, history=False):
+        # Load the stored results as a pyarrow Table. Only the requested columns are read, and the
+        # user and since (first run date) conditions skip whole partitions. filter is an additional
+        # pyarrow.compute expression, for example pyarrow.compute.field('tttg_R') > 15. Unless history
+        # is set only the latest version of every row is returned.
+        field = self._compute.field
+        partitions = None
+        for condition in (field('user') == user if user is not None else None,
+                          field('run_date') >= since if since is not None else None):
+            if condition is not None:
+                partitions = condition if partitions is None else partitions & condition
+        expression = partitions if filter is None else filter if partitions is None else partitions & filter
+
+        names = list(columns) if columns is not None else FIELDNAMES
+        if history:
+            return self.dataset().to_table(columns=names, filter=expression)
+
+        # A row only counts when no newer version of it exists, also when that version does not match filter
+        dataset = self.dataset()
+        table = dataset.to_table(columns=list(dict.fromkeys(list(KEY) + ['written_at'] + names)), filter=expression)
+        versions = dataset.to_table(columns=list(KEY) + ['written_at'], filter=partitions) if filter is not None else None
+        return self.latest(table, versions).select(names)
+
+    def compact(self):
+        # Replace the files of every partition by one file with only the latest version of every row
+        dataset = self.dataset()
+        files = list(dataset.files)
+        table = self.latest(dataset.to_table())
+        if table.num_rows:
+            self._dataset.write_dataset(table, self.directory, format='parquet', partitioning=self.partitioning,
+                                        basename_template=f'compact-{time.time_ns()}-{{i}}.parquet',
+                                        existing_data_behavior='overwrite_or_ignore')
+        for path in files:
+            os.remove(path)
@@ -0,0 +1,156 @@
+import argparse
+import json
+import logging
+import math
+
+import numpy as np
+
+from knee_marker_batch import PARAMETERS, VOXEL_SIZE, knee_marker_batch_analysis
+from knee_marker_layout import MARKERS
+from knee_output import open_writer
+
+
+logger = logging.getLogger(__name__)
+
+# Statistics reported for every parameter next to its value
+STATISTICS = ('sd', 'ci_low', 'ci_high')
+
+UNCERTAINTY_FIELDNAMES = (['label', 'id', 'user', 'timestamp', 'screening', 'samples']
+                          + [f'{name}{suffix}' for name in PARAMETERS for suffix in ('', '_sd', '_ci_low', '_ci_high')])
+UNCERTAINTY_NUMERIC = frozenset(UNCERTAINTY_FIELDNAMES[5:])
+
+# Number of perturbed marker sets evaluated at once, bounds the memory to about 150 MB of positions
+CHUNK = 200000
+
+
+def noise_model(sigma=(1.0, 1.0, 1.0), landmarks=None):
+    # Standard deviation in voxels of the placement of every marker along x, y and z, as a (markers x 3)
+    # array. sigma applies to all markers, landmarks overrides it by landmark name without side, e.g.
+    # {'Sulc': [1.5, 1.5, 2.0]}, or by marker name, e.g. {'Sulc_R': ...}.
+    model = np.tile(np.asarray(sigma, dtype=np.float64), (len(MARKERS), 1))
+    for name, value in (landmarks or {}).items():
+        rows = [i for i, x in enumerate(MARKERS) if x == name or x.rsplit('_', 1)[0] == name]
+        if not rows:
+            raise ValueError(f'unknown landmark {name}')
+        model[rows] = value
+    return model
+
+
+def _nan_quantiles(values, quantiles):
+    # Quantiles along the last axis ignoring NaN, with linear interpolation like np.nanquantile, but
+    # for all rows at once: NaN sorts last, so every row only interpolates between its first n values
+    values = np.sort(values, axis=-1)
+    counts = np.count_nonzero(~np.isnan(values), axis=-1)
+    result = []
+    for quantile in quantiles:
+        position = quantile * np.maximum(counts - 1, 0)
+        low = np.floor(position).astype(np.intp)
+        high = np.minimum(low + 1, np.maximum(counts - 1, 0))
+        value_low = np.take_along_axis(values, low[..., None], axis=-1)[..., 0]
+        value_high = np.take_along_axis(values, high[..., None], axis=-1)[..., 0]
+        value = value_low + (position - low) * (value_high - value_low)
+        result.append(np.where(counts > 0, value, np.nan))
+    return result
+
+
+def parameter_uncertainty(positions, spacing=None, samples=1000, noise=None, confidence=0.95, parameters=PARAMETERS,
+                          seed=0, chunk=CHUNK):
+    # Monte Carlo uncertainty of the parameters of a (sessions x markers x 3) array of marker positions.
+    # Every session is perturbed samples times with independent Gaussian noise per marker and axis
+    # from noise (see noise_model) and all perturbed marker sets are evaluated by the batch metrics.
+    # Returns a dict with per parameter and statistic a column per session, under 'name_sd',
+    # 'name_ci_low' and 'name_ci_high', plus the number of samples the parameter could be computed for
+    # under 'name_samples'.
+    positions = np.asarray(positions, dtype=np.float64)
+    sessions = len(positions)
+    noise = noise_model() if noise is None else np.asarray(noise, dtype=np.float64)
+    spacing = np.broadcast_to(np.asarray(VOXEL_SIZE if spacing is None else spacing, dtype=np.float64),
+                              (sessions, 3))
+    spacing = np.where(np.isnan(spacing), VOXEL_SIZE, spacing)
+    rng = np.random.default_rng(seed)
+    tail = (1 - confidence) / 2
+
+    result = {f'{name}_{x}': np.full(sessions, np.nan) for name in parameters for x in STATISTICS + ('samples',)}
+    step = max(1, chunk // samples)
+    for start in range(0, sessions, step):
+        stop = min(start + step, sessions)
+        count = stop - start
+        perturbed = rng.standard_normal((count, samples, len(MARKERS), 3))
+        perturbed *= noise
+        perturbed += positions[start:stop, np.newaxis]
+        columns = knee_marker_batch_analysis(perturbed.reshape(-1, len(MARKERS), 3), parameters,
+                                             spacing=np.repeat(spacing[start:stop], samples, axis=0))
+
+        for name in parameters:
+            values = columns[name].reshape(count, samples)
+            valid = np.count_nonzero(~np.isnan(values), axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.nansum(values, axis=1) / valid
+                result[f'{name}_sd'][start:stop] = np.sqrt(
+                    np.nansum((values - mean[:, np.newaxis]) ** 2, axis=1) / (valid - 1))
+            result[f'{name}_ci_low'][start:stop], result[f'{name}_ci_high'][start:stop] = _nan_quantiles(
+                values, (tail, 1 - tail))
+            result[f'{name}_samples'][start:stop] = valid
+    return result
+
+
+def uncertainty_rows(snapshot, samples=1000, noise=None, confidence=0.95, seed=0):
+    # Rows with the value and uncertainty of every parameter of every session of a marker snapshot
+    from knee_marker_snapshot import analyse_snapshot
+
+    uncertainty = parameter_uncertainty(snapshot['positions'], snapshot['spacing'], samples, noise, confidence,
+                                        seed=seed)
+    for index, row in enumerate(analyse_snapshot(snapshot)):
+        row['samples'] = samples
+        for name in PARAMETERS:
+            for statistic in STATISTICS:
+                value = float(uncertainty[f'{name}_{statistic}'][index])
+                row[f'{name}_{statistic}'] = None if math.isnan(value) else value
+        yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo uncertainty of the knee parameters from the rater '
+                                                 'jitter of the landmark placement')
+    parser.add_argument('snapshot', help='marker snapshot made by get_knee_parameters --snapshot or '
+                                         'knee_marker_snapshot.py create')
+    parser.add_argument('--output', default='./knee_uncertainty.csv',
+                        help='output file, the format follows the extension: .xlsx, .csv, .parquet or .arrow '
+                             '(default: ./knee_uncertainty.csv)')
+    parser.add_argument('--samples', type=int, default=1000,
+                        help='perturbed marker sets per session (default: 1000)')
+    parser.add_argument('--noise', default='1,1,1',
+                        help='standard deviation in voxels of the placement along x,y,z (default: 1,1,1)')
+    parser.add_argument('--landmark-noise', metavar='JSON',
+                        help='JSON file with the x,y,z standard deviation of specific landmarks, '
+                             'e.g. {"Sulc": [1.5, 1.5, 2]}')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level (default: 0.95)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the perturbations (default: 0)')
+    parser.add_argument('--id', action='append', dest='ids', metavar='EXPERIMENT_ID',
+                        help='only these experiments, can be repeated')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='show progress')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=max(logging.WARNING - 10 * args.verbose, logging.DEBUG),
+                        format='[%(levelname)s] %(name)s: %(message)s')
+
+    from knee_marker_snapshot import experiment, load_snapshot
+
+    landmarks = None
+    if args.landmark_noise:
+        with open(args.landmark_noise) as noise_file:
+            landmarks = json.load(noise_file)
+    noise = noise_model([float(x) for x in args.noise.split(',')], landmarks)
+
+    snapshot = load_snapshot(args.snapshot)
+    if args.ids:
+        snapshot = np.concatenate([experiment(snapshot, x) for x in args.ids])
+    logger.info('Perturbing %d sessions %d times: %d metric evaluations', len(snapshot), args.samples,
+                len(snapshot) * args.samples * len(PARAMETERS))
+
+    with open_writer(args.output, UNCERTAINTY_FIELDNAMES, numeric=UNCERTAINTY_NUMERIC) as writer:
+        writer.write_rows(uncertainty_rows(snapshot, args.samples, noise, args.confidence, args.seed))
+
+
+if __name__ == '__main__':
+    main()
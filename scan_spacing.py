@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import threading
+
+from harvest_metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+# The scan the markers are placed on, see scans in knee_marker4.yaml
+SCAN_TYPE = 'T1_WATER'
+SCAN_PROTOCOL = '3DGRASS'
+
+
+def _children(item, field):
+    for child in item.get('children', []):
+        if child.get('field') == field or child.get('field', '').endswith('/' + field):
+            yield from child.get('items', [])
+
+
+def find_scan(experiment):
+    # The marker scan in the JSON of an XNAT experiment: the scan of type T1_WATER, or else the first
+    # scan made with the 3DGRASS protocol
+    scans = [x for item in experiment.get('items', []) for x in _children(item, 'scans/scan')]
+    for scan in scans:
+        if scan.get('data_fields', {}).get('type') == SCAN_TYPE:
+            return scan
+    for scan in scans:
+        fields = scan.get('data_fields', {})
+        if any(SCAN_PROTOCOL in str(fields.get(x, '')) for x in ('protocol', 'series_description', 'type')):
+            return scan
+    return None
+
+
+def scan_spacing(experiment):
+    # Voxel spacing (x, y, z) in millimetres of the marker scan of an experiment, None if unknown
+    scan = find_scan(experiment)
+    if scan is None:
+        return None
+    for voxel_res in _children(scan, 'voxelRes'):
+        fields = voxel_res.get('data_fields', {})
+        try:
+            return [float(fields[x]) for x in ('x', 'y', 'z')]
+        except (KeyError, TypeError, ValueError):
+            return None
+    return None
+
+
+class ScanSpacingCache:
+    # Voxel spacing of the marker scan of every experiment, looked up on XNAT once and kept in a JSON
+    # file between runs. Concurrent lookups of the same experiment wait for the first one, so every
+    # experiment is requested at most once. Experiments without usable spacing are remembered as None.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lookups = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._spacing = {}
+        if path is not None:
+            try:
+                with open(path) as spacing_file:
+                    self._spacing.update(json.load(spacing_file))
+            except (IOError, ValueError):
+                pass
+
+    def _lookup(self, experiment_id, xnat_connection):
+        # get_json asks for the JSON format itself
+        with METRICS.timer('http/xnat_scan_metadata'):
+            experiment = xnat_connection.get_json('/data/experiments/{}'.format(experiment_id))
+        return self._spacing_of(experiment_id, experiment)
+
+    @staticmethod
+    def _spacing_of(experiment_id, experiment):
+        spacing = scan_spacing(experiment)
+        if spacing is None:
+            logger.warning('No voxel spacing of a %s scan for %s', SCAN_TYPE, experiment_id)
+        return spacing
+
+    def add(self, experiment_id, experiment):
+        # Keep the spacing from the JSON of an experiment that was fetched anyway, so get does not
+        # request it again
+        spacing = self._spacing_of(experiment_id, experiment)
+        with self._lock:
+            self._spacing.setdefault(experiment_id, spacing)
+
+    def get(self, experiment_id, xnat_connection):
+        with self._lock:
+            if experiment_id in self._spacing:
+                self.hits += 1
+                return self._spacing[experiment_id]
+            event = self._pending.get(experiment_id)
+            owner = event is None
+            if owner:
+                event = self._pending[experiment_id] = threading.Event()
+                self.lookups += 1
+
+        if not owner:
+            event.wait()
+            with self._lock:
+                self.hits += 1
+                return self._spacing.get(experiment_id)
+
+        try:
+            spacing = self._lookup(experiment_id, xnat_connection)
+            with self._lock:
+                self._spacing[experiment_id] = spacing
+            return spacing
+        finally:
+            # A failed request is not remembered, waiting lookups then return None and the next run retries
+            with self._lock:
+                del self._pending[experiment_id]
+            event.set()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            with open(self.path + '.tmp', 'w') as spacing_file:
+                json.dump(self._spacing, spacing_file)
+            os.replace(self.path + '.tmp', self.path)
+
+    def stats(self):
+        return {'lookups': self.lookups, 'hits': self.hits, 'experiments': len(self._spacing)}
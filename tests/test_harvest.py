@@ -0,0 +1,82 @@
+import pytest
+import requests
+
+import get_knee_parameters
+from mock_services import MockDataset, MockServer, MockXNATConnection
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Requests take long enough that the workers of a concurrent harvest always overlap
+    with MockServer(MockDataset(40, max_revisions=3), latency=0.02) as server:
+        monkeypatch.setattr(get_knee_parameters, 'TASKMANAGER', server.url)
+        yield server
+
+
+def harvest(server, workers, **kwargs):
+    server.peak_in_flight = 0
+    with MockXNATConnection(server.url) as xnat_connection:
+        rows = get_knee_parameters.collect_info(requests.Session(), xnat_connection, workers=workers, **kwargs)
+    return rows, server.peak_in_flight
+
+
+def test_concurrent_harvest_keeps_every_worker_busy_with_identical_rows(server):
+    serial, serial_peak = harvest(server, 1)
+    concurrent, concurrent_peak = harvest(server, 8)
+
+    assert len(serial) > 0
+    assert concurrent == serial
+    assert serial_peak == 1
+    assert concurrent_peak == 8
+
+
+@pytest.mark.parametrize('skip', [False, True])
+def test_implausible_markers_are_flagged_for_their_rater(monkeypatch, skip):
+    from knee_marker_batch import PARAMETERS
+    from knee_marker_synthetic import generate_sessions
+
+    monkeypatch.setattr(get_knee_parameters, 'FLAGGED_SESSIONS', [])
+    monkeypatch.setattr(get_knee_parameters, 'SKIP_FLAGGED', skip)
+    task_content = {'_vars': {'LABEL': 'K1', 'EXPERIMENT_ID': 'E1'}, 'fields_file': 'fields.json'}
+    clean, broken = generate_sessions(2, seed=8)
+    markers = {x['name']: x for x in broken['markers']}
+    markers['Lat_Pat_R']['pos'] = list(markers['Med_Pat_R']['pos'])
+
+    assert get_knee_parameters.analyse_task(task_content, clean)['pt_R'] is not None
+    assert get_knee_parameters.FLAGGED_SESSIONS == []
+
+    row = get_knee_parameters.analyse_task(task_content, broken)
+    assert get_knee_parameters.FLAGGED_SESSIONS == [
+        {'label': 'K1', 'id': 'E1', 'user': row['user'], 'timestamp': row['timestamp'], 'screening': 'coincident'}]
+    # The patellar tilt needs the coincident markers and is null, the rest is computed unless skipped
+    assert row['pt_R'] is None
+    assert (row['i_s_L'] is None) == skip
+    assert all(row[name] is None for name in PARAMETERS) == skip
+
+
+@pytest.mark.parametrize('warm', ['checkpoint', 'cache'])
+def test_bulk_harvest_only_archives_changed_field_files(server, tmp_path, warm):
+    from field_file_cache import FieldFileCache
+    from harvest_checkpoint import HarvestCheckpoint
+
+    def run(**kwargs):
+        server.requests.clear()
+        rows, _ = harvest(server, 8, bulk=True, **kwargs)
+        return rows, dict(server.requests)
+
+    expected, _ = harvest(server, 8)
+    if warm == 'checkpoint':
+        checkpoint = HarvestCheckpoint(str(tmp_path / 'checkpoint.jsonl'))
+        first, requests = run(checkpoint=checkpoint)
+        second, again = run(checkpoint=checkpoint)
+        checkpoint.close()
+    else:
+        cache = FieldFileCache(str(tmp_path / 'cache'))
+        first, requests = run(cache=cache)
+        second, again = run(cache=cache)
+
+    assert first == second == expected
+    assert requests['archive'] > 0 and 'listing' not in requests
+    # The second run lists every field file instead of fetching them in archives
+    assert 'archive' not in again and 'field_file' not in again
+    assert again['listing'] == len(expected)
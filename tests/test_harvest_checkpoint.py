@@ -0,0 +1,29 @@
+from harvest_checkpoint import HarvestCheckpoint
+
+
+def test_record_after_torn_line_is_kept(tmp_path):
+    path = str(tmp_path / 'checkpoint.jsonl')
+    checkpoint = HarvestCheckpoint(path)
+    checkpoint.record('/api/v1/tasks/1', {'fields_file': 'a'}, '2021-01-01T00:00:00', None)
+    checkpoint.close()
+    # A run killed while writing leaves half a record
+    with open(path, 'a') as checkpoint_file:
+        checkpoint_file.write('{"uri": "/api/v1/tasks/2", "con')
+
+    checkpoint = HarvestCheckpoint(path)
+    checkpoint.record('/api/v1/tasks/3', {'fields_file': 'c'}, '2021-01-01T00:00:00', None)
+    checkpoint.close()
+
+    tasks = HarvestCheckpoint(path).tasks
+    assert sorted(tasks) == ['/api/v1/tasks/1', '/api/v1/tasks/3']
+
+
+def test_lookup_only_returns_rows_of_the_same_field_file(tmp_path):
+    checkpoint = HarvestCheckpoint(str(tmp_path / 'checkpoint.jsonl'))
+    row = {'id': 'E1', 'user': 'rater1', 'timestamp': '2021-01-01T00:00:00'}
+    checkpoint.record('/api/v1/tasks/1', {}, '2021-01-01T00:00:00', row)
+
+    assert checkpoint.lookup('/api/v1/tasks/1', '2021-01-01T00:00:00') == row
+    assert checkpoint.lookup('/api/v1/tasks/1', '2021-01-02T00:00:00') is None
+    assert checkpoint.reused == 1
+    checkpoint.close()
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from harvest_http import AdaptiveHTTP, HostState
+
+
+def test_unexpected_errors_release_the_slot(monkeypatch):
+    def send(self, request, **kwargs):
+        raise requests.exceptions.ContentDecodingError('broken body')
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    http = AdaptiveHTTP(2, retries=2, backoff=0.0)
+    session = http.mount(requests.Session())
+    for _ in range(5):
+        with pytest.raises(requests.exceptions.ContentDecodingError):
+            session.get('http://mock.invalid/data')
+
+    state = http.hosts['mock.invalid']
+    assert state.in_flight == 0
+    assert state.failures == 5
+    # Not a network error, so the request is not retried
+    assert state.retries == 0
+
+
+def test_unexpected_error_of_a_probe_lets_the_next_request_probe(monkeypatch):
+    def send(self, request, **kwargs):
+        raise RuntimeError('bug in the transport')
+
+    monkeypatch.setattr(HTTPAdapter, 'send', send)
+    http = AdaptiveHTTP(4, retries=0, failure_threshold=1, cooldown=0.1)
+    session = http.mount(requests.Session())
+    with pytest.raises(RuntimeError):
+        session.get('http://mock.invalid/data')
+    state = http.hosts['mock.invalid']
+    assert state.open_until is not None
+
+    with pytest.raises(RuntimeError):
+        session.get('http://mock.invalid/data')
+    assert not state.probing
+    assert state.in_flight == 0
+
+
+def test_requests_stop_waiting_for_a_lost_probe():
+    state = HostState('mock.invalid', 4, cooldown=0.2)
+    now = time.monotonic()
+    # An open circuit whose probe never came back
+    state.open_until = state.opened_at = state.probe_started = now
+    state.probing = True
+
+    probes = []
+    threads = [threading.Thread(target=lambda: probes.append(state.acquire())) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.3)
+
+    # One request takes over the probe after the cooldown, the others wait for it
+    assert probes == [True]
+    state.release(0.01, probe=True)
+    for thread in threads:
+        thread.join(timeout=2)
+    assert sorted(probes) == [False, False, True]
+    assert state.open_until is None
@@ -0,0 +1,31 @@
+import pytest
+
+import knee_marker_analysis
+from get_knee_parameters import METRIC_FUNCTIONS
+from harvest_metrics import Metrics
+from knee_marker_batch import PARAMETERS
+from knee_marker_synthetic import generate_sessions
+
+
+@pytest.fixture
+def metrics():
+    metrics = Metrics()
+    metrics.enabled = True
+    yield metrics
+    metrics.uninstrument()
+
+
+def test_instrumented_functions_are_timed_and_restored(metrics):
+    original = {name: getattr(knee_marker_analysis, name) for name in METRIC_FUNCTIONS}
+    data = generate_sessions(1, seed=2)[0]
+    expected = knee_marker_analysis.knee_marker_analysis(data)
+
+    metrics.instrument(knee_marker_analysis, METRIC_FUNCTIONS)
+    assert knee_marker_analysis.knee_marker_analysis(data) == pytest.approx(expected, nan_ok=True)
+    assert len(expected) == len(PARAMETERS)
+    report = metrics.report()['timers']
+    for name in METRIC_FUNCTIONS:
+        assert report[f'metric/{name}']['count'] >= 1, name
+
+    metrics.uninstrument()
+    assert {name: getattr(knee_marker_analysis, name) for name in METRIC_FUNCTIONS} == original
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from knee_marker_analysis import knee_marker_analysis
+from knee_marker_batch import PARAMETERS, MetricEvaluation, knee_marker_batch_analysis
+from knee_marker_layout import MARKER_INDEX, pack_sessions
+from knee_marker_synthetic import generate_sessions
+
+
+def scalar_columns(sessions, spacing=None):
+    rows = [knee_marker_analysis(data, spacing) for data in sessions]
+    return {name: np.array([np.nan if row[index] is None else row[index] for row in rows])
+            for index, name in enumerate(PARAMETERS)}
+
+
+@pytest.mark.parametrize('spacing', [None, [0.65, 0.65, 0.7]])
+def test_batch_matches_scalar_analysis(spacing):
+    sessions = generate_sessions(200, missing_rate=0.1, seed=1)
+    positions, _ = pack_sessions(sessions)
+
+    batch = knee_marker_batch_analysis(positions, spacing=spacing)
+    scalar = scalar_columns(sessions, spacing)
+
+    for name in PARAMETERS:
+        np.testing.assert_allclose(batch[name], scalar[name], rtol=1e-9, atol=1e-9, equal_nan=True, err_msg=name)
+
+
+def test_update_only_recomputes_dependent_nodes():
+    positions, _ = pack_sessions(generate_sessions(50, seed=2))
+    evaluation = MetricEvaluation(positions)
+    evaluation.compute()
+    computed = evaluation.evaluations
+
+    moved = positions.copy()
+    moved[:, MARKER_INDEX['Tub_Tib_R']] += 1.5
+    evaluation.update('Tub_Tib_R', moved[:, MARKER_INDEX['Tub_Tib_R']])
+    columns = evaluation.compute()
+
+    assert 0 < evaluation.evaluations - computed < computed
+    expected = knee_marker_batch_analysis(moved)
+    for name in PARAMETERS:
+        np.testing.assert_allclose(columns[name], expected[name], equal_nan=True, err_msg=name)
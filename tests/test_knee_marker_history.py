@@ -0,0 +1,45 @@
+import copy
+
+import pytest
+
+from knee_marker_analysis import knee_marker_analysis
+from knee_marker_batch import PARAMETERS
+from knee_marker_history import revision_history
+from knee_marker_synthetic import generate_sessions
+
+
+def revisions(data, moves):
+    # A revision per move, every move shifts one marker of the previous revision
+    result = [('2021-01-01T00:00:00', data)]
+    for number, (name, offset) in enumerate(moves, 1):
+        data = copy.deepcopy(data)
+        for marker in data['markers']:
+            if marker['name'] == name:
+                marker['pos'] = [x + offset for x in marker['pos'][:3]] + marker['pos'][3:]
+        result.append((f'2021-01-01T0{number}:00:00', data))
+    return result
+
+
+def test_history_matches_analysis_of_every_revision():
+    sessions = generate_sessions(2, seed=4)
+    files = [({'id': 'E1', 'user': 'rater1'}, revisions(sessions[0], [('Sulc_R', 2.0), ('Sulc_R', 0.0)]), None),
+             ({'id': 'E2', 'user': 'rater2'}, revisions(sessions[1], [('Tub_Tib_L', -1.0)]), [0.65, 0.65, 0.7])]
+    rows = list(revision_history(files))
+
+    assert [(row['id'], row['revision'], row['previous_revision']) for row in rows] == [
+        ('E1', '2021-01-01T00:00:00', None), ('E1', '2021-01-01T01:00:00', '2021-01-01T00:00:00'),
+        ('E1', '2021-01-01T02:00:00', '2021-01-01T01:00:00'),
+        ('E2', '2021-01-01T00:00:00', None), ('E2', '2021-01-01T01:00:00', '2021-01-01T00:00:00')]
+    assert [row['changed'] for row in rows] == [None, 'Sulc_R', '', None, 'Tub_Tib_L']
+
+    expected = [knee_marker_analysis(data, spacing) for _, file_revisions, spacing in files
+                for _, data in file_revisions]
+    for row, values in zip(rows, expected):
+        for name, value in zip(PARAMETERS, values):
+            assert row[name] == pytest.approx(value, rel=1e-9, abs=1e-9), name
+
+    moved = rows[1]
+    assert moved['Sulc_R_shift'] == pytest.approx(2.0 * 0.7 * 3 ** 0.5)
+    assert moved['Tub_Tib_R_shift'] == 0.0
+    assert moved['tttg_R_delta'] == pytest.approx(moved['tttg_R'] - rows[0]['tttg_R'])
+    assert moved['i_s_L_delta'] == 0.0
@@ -0,0 +1,17 @@
+import pytest
+
+from knee_marker_layout import ALL_MARKERS, MARKERS, load_marker_names, pack_markers
+
+
+def test_markers_match_template():
+    pytest.importorskip('yaml')
+    assert load_marker_names() == MARKERS
+
+
+def test_pack_markers_sets_presence_mask():
+    data = {'markers': [{'name': name, 'pos': [index, 2 * index, 3 * index, 0]} for index, name in enumerate(MARKERS)]
+            + [{'name': 'Unknown', 'pos': [0, 0, 0]}]}
+    positions, mask = pack_markers(data)
+
+    assert mask == ALL_MARKERS
+    assert positions[5].tolist() == [5, 10, 15]
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from knee_marker_analysis import knee_marker_analysis
+from knee_marker_batch import PARAMETERS
+from knee_marker_offline import analyse_archive, find_field_files
+from knee_marker_synthetic import generate_sessions
+
+
+@pytest.fixture
+def field_files(tmp_path):
+    sessions = generate_sessions(20, missing_rate=0.1, seed=3)
+    for index, data in enumerate(sessions):
+        (tmp_path / f'session_{index:02d}.json').write_text(json.dumps(data))
+    (tmp_path / 'session_broken.json').write_text('{"markers": ')
+    return tmp_path, sessions
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_offline_analysis_matches_scalar_analysis(field_files, workers):
+    directory, sessions = field_files
+    rows = list(analyse_archive(list(find_field_files([str(directory)])), workers=workers, chunk_size=8))
+
+    assert [row['id'] for row in rows] == [f'session_{index:02d}' for index in range(20)] + ['session_broken']
+    for row, data in zip(rows, sessions):
+        assert 'error' not in row
+        assert row['user'] == data['__raters__'][-1]['username']
+        for name, value in zip(PARAMETERS, knee_marker_analysis(data)):
+            if value is None:
+                assert row[name] is None, name
+            else:
+                assert row[name] == pytest.approx(value, rel=1e-9, abs=1e-9), name
+
+
+def test_unreadable_file_gets_error_row(field_files):
+    directory, _ = field_files
+    row = list(analyse_archive([str(directory / 'session_broken.json')], workers=1))[0]
+
+    assert row['error']
+    assert all(name not in row for name in PARAMETERS)
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from knee_marker_layout import MARKER_INDEX, MARKERS
+from knee_marker_screening import REASONS, describe, screen_markers
+from knee_marker_synthetic import generate_positions
+
+
+@pytest.fixture
+def positions():
+    return generate_positions(40, missing_rate=0.05, seed=6)[0]
+
+
+def flagged(flags):
+    return {index: describe(x) for index, x in enumerate(flags) if x}
+
+
+def swap(positions, session, a, b):
+    positions[session, [MARKER_INDEX[a], MARKER_INDEX[b]]] = positions[session, [MARKER_INDEX[b], MARKER_INDEX[a]]]
+
+
+def test_clean_sessions_are_not_flagged(positions):
+    assert flagged(screen_markers(positions)) == {}
+    assert flagged(screen_markers(positions, extent=(512, 512, 512))) == {}
+
+
+def test_coincident(positions):
+    positions[3, MARKER_INDEX['Lat_Pat_R']] = positions[3, MARKER_INDEX['Med_Pat_R']]
+    flags = screen_markers(positions)
+    assert set(flagged(flags)) == {3}
+    assert flags[3] & REASONS['coincident']
+
+
+def test_collinear(positions):
+    lateral, medial = positions[7, MARKER_INDEX['Lat_Ant_Cond_L']], positions[7, MARKER_INDEX['Med_Ant_Cond_L']]
+    positions[7, MARKER_INDEX['Sulc_L']] = (lateral + medial) / 2
+    flags = screen_markers(positions)
+    assert set(flagged(flags)) == {7}
+    assert 'collinear' in describe(flags[7])
+
+
+def test_medial_lateral_swapped(positions):
+    for name in ('Pos_Cond', 'Ant_Cond', 'Pat'):
+        swap(positions, 11, f'Med_{name}_R', f'Lat_{name}_R')
+    flags = screen_markers(positions)
+    assert flags[11] & REASONS['medial_lateral_swapped']
+    assert all(not x & REASONS['medial_lateral_swapped'] for index, x in enumerate(flags) if index != 11)
+
+
+def test_sides_swapped(positions):
+    for name in MARKERS:
+        if name.endswith('_R'):
+            swap(positions, 13, name, name[:-2] + '_L')
+    flags = screen_markers(positions)
+    assert flags[13] & REASONS['sides_swapped']
+    assert all(not x & REASONS['sides_swapped'] for index, x in enumerate(flags) if index != 13)
+
+
+def test_sides_of_a_single_session_need_an_orientation(positions):
+    session = positions[13].copy()
+    for name in MARKERS:
+        if name.endswith('_R'):
+            session[[MARKER_INDEX[name], MARKER_INDEX[name[:-2] + '_L']]] = \
+                session[[MARKER_INDEX[name[:-2] + '_L'], MARKER_INDEX[name]]]
+    orientation = {'sides': int(np.sign(np.nanmean(positions[:, MARKER_INDEX['Sulc_L'], 0]
+                                                    - positions[:, MARKER_INDEX['Sulc_R'], 0])))}
+    assert screen_markers(session)[0] == 0
+    assert screen_markers(session, orientation=orientation)[0] & REASONS['sides_swapped']
+
+
+def test_out_of_range(positions):
+    positions[17, MARKER_INDEX['Tub_Tib_R'], 2] = -1.0
+    positions[19, MARKER_INDEX['Sup_Pat_L'], 0] = np.inf
+    positions[23, MARKER_INDEX['Sulc_R'], 1] = 600.0
+    flags = screen_markers(positions, extent=(512, 512, 512))
+    assert {index for index, x in enumerate(flags) if x & REASONS['out_of_range']} == {17, 19, 23}
+    assert not screen_markers(positions)[23] & REASONS['out_of_range']
@@ -0,0 +1,70 @@
+import json
+import urllib.request
+
+import pytest
+
+from knee_marker_analysis import knee_marker_analysis
+from knee_marker_batch import PARAMETERS
+from knee_marker_service import AnalysisServer
+from knee_marker_synthetic import generate_sessions
+
+
+@pytest.fixture(scope='module')
+def service():
+    with AnalysisServer(port=0) as server:
+        yield server
+
+
+def post(service, payload):
+    request = urllib.request.Request(service.url + '/analyse', data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return response.status, json.loads(response.read())
+
+
+def moved(data, name, position):
+    markers = [dict(x) for x in data['markers']]
+    for marker in markers:
+        if marker['name'] == name:
+            marker['pos'] = list(position) + marker['pos'][3:]
+    return dict(data, markers=markers)
+
+
+def position(data, name):
+    return next(x['pos'][:3] for x in data['markers'] if x['name'] == name)
+
+
+def test_clean_marker_set(service):
+    data = generate_sessions(1, seed=5)[0]
+    status, result = post(service, data)
+    assert status == 200
+    assert result['screening'] == []
+    assert all(result['parameters'][name] is not None for name in PARAMETERS)
+
+
+def test_coincident_patella_markers(service):
+    data = generate_sessions(1, seed=5)[0]
+    status, result = post(service, moved(data, 'Lat_Pat_R', position(data, 'Med_Pat_R')))
+    assert status == 200
+    assert 'coincident' in result['screening']
+    # The metrics of the patellar width line cannot be computed, the rest can
+    assert result['parameters']['pt_R'] is None and result['parameters']['bo_R'] is None
+    assert result['parameters']['i_s_R'] is not None and result['parameters']['bo_L'] is not None
+
+
+def test_collinear_patella_markers(service):
+    # The patellar width line runs along the line from the sulcus to the posterior condylar line, the
+    # bisect offset lines do not intersect
+    data = generate_sessions(1, seed=5)[0]
+    z = position(data, 'Sulc_R')[2]
+    for name, (x, y) in {'Med_Pos_Cond_R': (100, 200), 'Lat_Pos_Cond_R': (200, 200), 'Sulc_R': (150, 150),
+                         'Lat_Pat_R': (150, 120), 'Med_Pat_R': (150, 100)}.items():
+        data = moved(data, name, [x, y, z])
+    with pytest.raises(ZeroDivisionError):
+        knee_marker_analysis(data)
+
+    status, result = post(service, data)
+    assert status == 200
+    assert 'collinear' in result['screening']
+    assert result['parameters']['bo_R'] is None
+    assert result['parameters']['bo_L'] is not None
@@ -0,0 +1,60 @@
+import math
+
+import pytest
+
+from knee_marker_history import HISTORY_FIELDNAMES, HISTORY_NUMERIC, revision_history
+from knee_marker_synthetic import generate_sessions
+from knee_output import open_writer
+from knee_reliability import RELIABILITY_FIELDNAMES, RELIABILITY_NUMERIC, reliability
+from test_knee_marker_history import revisions
+
+pyarrow = pytest.importorskip('pyarrow')
+pytest.importorskip('pyarrow.parquet')
+
+
+def read_table(path):
+    if path.suffix == '.parquet':
+        return pyarrow.parquet.read_table(path)
+    with pyarrow.ipc.open_file(path) as reader:
+        return reader.read_all()
+
+
+def same(a, b):
+    return a == b or (a is not None and b is not None and math.isnan(a) and math.isnan(b))
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_history_round_trip_keeps_numeric_columns(tmp_path, extension):
+    sessions = generate_sessions(1, seed=4)
+    rows = list(revision_history([({'id': 'E1', 'label': 'K1', 'user': 'rater1'},
+                                   revisions(sessions[0], [('Sulc_R', 2.0)]), None)]))
+    path = tmp_path / f'history{extension}'
+    with open_writer(str(path), HISTORY_FIELDNAMES, numeric=HISTORY_NUMERIC) as writer:
+        writer.write_rows(rows)
+
+    table = read_table(path)
+    assert table.schema.field('i_s_R_delta').type == pyarrow.float64()
+    assert table.schema.field('Sulc_R_shift').type == pyarrow.float64()
+    assert table.schema.field('changed').type == pyarrow.string()
+    for field in table.schema:
+        assert field.type == (pyarrow.float64() if field.name in HISTORY_NUMERIC else pyarrow.string()), field.name
+
+    for written, read in zip(rows, table.to_pylist()):
+        for name in HISTORY_NUMERIC:
+            assert same(read[name], written[name]), name
+    assert table.column('Sulc_R_shift').to_pylist()[1] == pytest.approx(2.0 * 0.7 * math.sqrt(3))
+
+
+def test_reliability_round_trip_keeps_numeric_columns(tmp_path):
+    results = [{'id': f'E{session}', 'user': user, **{name: float(session + offset) for name in ('i_s_R', 'i_s_L')}}
+               for session in range(6) for user, offset in (('a', 0.0), ('b', 0.1 * session))]
+    rows = list(reliability(results, bootstrap=20, seed=1))
+    path = tmp_path / 'reliability.parquet'
+    with open_writer(str(path), RELIABILITY_FIELDNAMES, numeric=RELIABILITY_NUMERIC) as writer:
+        writer.write_rows(rows)
+
+    table = pyarrow.parquet.read_table(path)
+    assert table.schema.field('rater_a').type == pyarrow.string()
+    for name in RELIABILITY_NUMERIC:
+        assert table.schema.field(name).type == pyarrow.float64(), name
+    assert table.column('sessions').to_pylist() == [row['sessions'] for row in rows]
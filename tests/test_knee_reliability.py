@@ -0,0 +1,31 @@
+import pytest
+
+from knee_output import FIELDNAMES, open_writer
+from knee_reliability import load_results, reliability
+
+
+def result_rows():
+    return [{'label': f'K{session}', 'id': f'E{session}', 'user': user, 'timestamp': '2021-01-01',
+             'i_s_R': float(session + offset), 'tttg_R': None if session == 2 else 10.0 + session * offset}
+            for session in range(6) for user, offset in (('a', 0.0), ('b', 0.1 * session))]
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.xlsx', '.parquet'])
+def test_results_are_read_back_from_every_output_format(tmp_path, extension):
+    pytest.importorskip({'.csv': 'csv', '.xlsx': 'openpyxl', '.parquet': 'pyarrow'}[extension])
+    path = str(tmp_path / f'results{extension}')
+    with open_writer(path, FIELDNAMES) as writer:
+        writer.write_rows(result_rows())
+
+    rows = load_results(path)
+    assert [(row['id'], row['user']) for row in rows] == [(row['id'], row['user']) for row in result_rows()]
+    expected = list(reliability(result_rows(), bootstrap=0))
+    actual = list(reliability(rows, bootstrap=0))
+    assert [row['parameter'] for row in actual] == [row['parameter'] for row in expected]
+    for row, reference in zip(actual, expected):
+        assert row == pytest.approx(reference, nan_ok=True), row['parameter']
+
+
+def test_unsupported_format(tmp_path):
+    with pytest.raises(ValueError, match='Unsupported results format .txt'):
+        load_results(str(tmp_path / 'results.txt'))
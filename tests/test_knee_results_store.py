@@ -0,0 +1,73 @@
+import pytest
+
+from knee_marker_batch import PARAMETERS
+
+pytest.importorskip('pyarrow')
+pytest.importorskip('pyarrow.dataset')
+
+from knee_results_store import ResultsStore  # noqa: E402
+
+USERS = ['rater1', 'o\'brien', 'müller', 'first last', 'a/b', 'x=y', '100%', 'dot.ted']
+
+
+def result_rows(users=USERS, sessions=3, offset=0.0):
+    rows = []
+    for user_index, user in enumerate(users):
+        for session in range(sessions):
+            row = {'label': f'K{session}', 'id': f'E{session}', 'user': user, 'timestamp': f'2021-01-0{session + 1}'}
+            row.update({name: user_index + session + index / 10 + offset for index, name in enumerate(PARAMETERS)})
+            rows.append(row)
+    return rows
+
+
+def by_key(table):
+    return {(row['id'], row['user'], row['timestamp']): row for row in table.to_pylist()}
+
+
+def test_upsert_is_idempotent(tmp_path):
+    rows = result_rows()
+    store = ResultsStore(str(tmp_path))
+    assert store.append(rows, run_date='2021-02-01') == len(rows)
+    assert store.append(rows, run_date='2021-02-01') == 0
+    # A new store reads the digests from disk
+    assert ResultsStore(str(tmp_path)).append(rows, run_date='2021-02-02') == 0
+    assert store.query().num_rows == len(rows)
+    assert store.query(history=True).num_rows == len(rows)
+
+    changed = dict(rows[0], i_s_R=100.0)
+    assert store.append([changed] + rows[1:], run_date='2021-02-03') == 1
+    latest = by_key(store.query())
+    assert len(latest) == len(rows)
+    assert latest[('E0', USERS[0], '2021-01-01')]['i_s_R'] == 100.0
+    assert store.query(history=True).num_rows == len(rows) + 1
+
+
+def test_query_after_compact(tmp_path):
+    store = ResultsStore(str(tmp_path))
+    store.append(result_rows(), run_date='2021-02-01')
+    store.append(result_rows(offset=1.0), run_date='2021-02-02')
+    store.append(result_rows(users=USERS[:2]), run_date='2021-02-03')
+    before = store.query()
+    files = len(store.dataset().files)
+
+    store.compact()
+    after = store.query()
+    assert by_key(after) == by_key(before)
+    assert store.query(history=True).num_rows == after.num_rows
+    assert len(store.dataset().files) < files
+    assert store.query(user=USERS[1]).num_rows == 3
+    assert ResultsStore(str(tmp_path)).append(result_rows(users=USERS[:2]), run_date='2021-02-04') == 0
+
+
+def test_usernames_with_special_characters(tmp_path):
+    rows = result_rows()
+    store = ResultsStore(str(tmp_path))
+    store.append(rows, run_date='2021-02-01')
+
+    assert sorted(set(store.query(['user']).column('user').to_pylist())) == sorted(USERS)
+    for user in USERS:
+        table = store.query(user=user)
+        assert table.num_rows == 3, user
+        assert set(table.column('user').to_pylist()) == {user}
+    # Every user has a partition directory of its own directly under the store
+    assert len([x for x in tmp_path.iterdir() if x.is_dir()]) == len(USERS)